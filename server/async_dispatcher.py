@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from dispatcher import DETACHED
+from scheduler import FairPriorityQueue, DEFAULT_PRIORITY, DEFAULT_TENANT
+
+
+class AsyncDispatcher:
+    """
+    Dispatches queued tasks from an asyncio event loop running in a background thread.
+
+    It has the same interface as Dispatcher, but each in-flight task is a coroutine instead of
+    a thread, so thousands of service calls can be awaited at once. `max_in_flight` bounds the
+    concurrent tasks of each microservice, and the queues are the same FairPriorityQueue.
+    """
+
+    def __init__(self, handler, concurrency: dict, aging: float = 600, on_stop=None):
+        """
+        Initialize the dispatcher.
+
+        :param handler: Coroutine function run for every task, receives the task_id. It may
+                        return DETACHED for asynchronous jobs, released later with `release`.
+        :param concurrency: Maps each microservice name to its maximum number of in-flight tasks.
+        :param aging: Seconds of waiting that promote a queued task by one priority level.
+        :param on_stop: Coroutine function awaited in the loop when it stops, e.g. to close the HTTP sessions.
+        """
+        self.handler = handler
+        self.on_stop = on_stop
+        self.concurrency = dict(concurrency)
+        self._queues = {name: FairPriorityQueue(aging=aging) for name in self.concurrency}
+        self._in_flight = {name: 0 for name in self.concurrency}
+        self._reserved = {name: 0 for name in self.concurrency}
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._slot_free = {}
+        # One thread per microservice blocks on its queue, the tasks themselves run in the loop
+        self._getters = ThreadPoolExecutor(max_workers=len(self.concurrency) or 1, thread_name_prefix="dispatch-get")
+
+    def start(self):
+        """
+        Start the event loop thread and one pump coroutine per microservice.
+        """
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._slot_free = {name: asyncio.Event() for name in self.concurrency}
+            pumps = [self._loop.create_task(self._pump(name)) for name in self.concurrency]
+            ready.set()
+            self._loop.run_until_complete(asyncio.gather(*pumps))
+            pending = asyncio.all_tasks(self._loop)
+            self._loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            if self.on_stop is not None:
+                self._loop.run_until_complete(self.on_stop())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="async-dispatcher", daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def stop(self):
+        """
+        Stop the pumps once the tasks already queued have been handled, and the event loop.
+        """
+        for q in self._queues.values():
+            q.put(None)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, microservice: str, task_id, priority: str = DEFAULT_PRIORITY, tenant: str = DEFAULT_TENANT):
+        """
+        Enqueue a task for the given microservice. Safe to call from any thread.
+        """
+        self._queues[microservice].put(task_id, priority, tenant)
+
+    def cancel(self, microservice: str, task_id) -> bool:
+        """
+        Remove a task from the queue of a microservice before it is dispatched.
+
+        :return: True if the task was still waiting in the queue.
+        """
+        return self._queues[microservice].remove(task_id)
+
+    def release(self, microservice: str):
+        """
+        Free the in-flight slot of a task. Safe to call from any thread.
+        """
+        with self._lock:
+            self._in_flight[microservice] -= 1
+            self._reserved[microservice] -= 1
+        self._loop.call_soon_threadsafe(self._slot_free[microservice].set)
+
+    def adopt(self, microservice: str):
+        """
+        Count as in flight a detached task started before a restart. It must be released later.
+        """
+        with self._lock:
+            self._in_flight[microservice] += 1
+            self._reserved[microservice] += 1
+
+    def join(self):
+        """
+        Block until every queued task has been handled.
+        """
+        for q in self._queues.values():
+            q.join()
+
+    def queue_depth(self, microservice: str) -> int:
+        """
+        :return: Number of tasks waiting for a free in-flight slot of the microservice.
+        """
+        return self._queues[microservice].qsize()
+
+    def queue_depth_by_priority(self, microservice: str) -> dict:
+        """
+        :return: Number of waiting tasks of the microservice per priority class.
+        """
+        return self._queues[microservice].depth_by_priority()
+
+    def in_flight(self, microservice: str) -> int:
+        """
+        :return: Number of tasks currently being processed by the microservice.
+        """
+        with self._lock:
+            return self._in_flight[microservice]
+
+    async def _reserve_slot(self, microservice: str):
+        limit = max(1, self.concurrency[microservice])
+        while True:
+            with self._lock:
+                if self._reserved[microservice] < limit:
+                    self._reserved[microservice] += 1
+                    return
+                self._slot_free[microservice].clear()
+            await self._slot_free[microservice].wait()
+
+    async def _pump(self, microservice: str):
+        task_queue = self._queues[microservice]
+        while True:
+            # Reserva una plaça abans d'agafar la tasca, per respectar max_in_flight
+            await self._reserve_slot(microservice)
+            task_id = await self._loop.run_in_executor(self._getters, task_queue.get)
+            if task_id is None:  # Permet tancar el dispatcher
+                with self._lock:
+                    self._reserved[microservice] -= 1
+                task_queue.task_done()
+                break
+            with self._lock:
+                self._in_flight[microservice] += 1
+            self._loop.create_task(self._run(microservice, task_id))
+
+    async def _run(self, microservice: str, task_id):
+        detached = False
+        try:
+            detached = (await self.handler(task_id)) == DETACHED
+        except Exception:
+            logging.exception(f"Unhandled error processing task {task_id} on {microservice}")
+        finally:
+            if not detached:
+                self.release(microservice)
+            self._queues[microservice].task_done()
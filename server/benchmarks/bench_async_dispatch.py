@@ -0,0 +1,96 @@
+"""
+Maximum sustained throughput of the thread dispatcher and the asyncio dispatcher.
+
+A burst of tasks is dispatched to an asyncio stub that answers every `/run` after DELAY
+seconds, with an increasing number of tasks in flight. The thread design needs one thread
+(and one pooled connection) per task in flight; the asyncio design awaits all of them from
+a single event loop thread, and records their state changes in its default executor.
+
+Run from the server directory:  python -m benchmarks.bench_async_dispatch
+"""
+import itertools
+import logging
+import threading
+import time
+
+import server
+from async_dispatcher import AsyncDispatcher
+from clients import AsyncServiceClients
+from dispatcher import Dispatcher
+from benchmarks.stubs import start_async_stub
+
+DELAY = 0.2
+TASKS_PER_SLOT = 4
+MAX_TASKS = 4000
+
+task_ids = itertools.count(1)
+
+
+def make_tasks(count):
+    ids = []
+    for _ in range(count):
+        task_id = next(task_ids)
+        server.store.add({
+            "task_id": task_id,
+            "microservice": "dummy",
+            "address": None,
+            "status": "queued",
+            "data": {"directory": "bench"},
+            "result": None,
+            "created_at": time.time(),
+            "source_path": "bench",
+        })
+        ids.append(task_id)
+    return ids
+
+
+def run(dispatcher, in_flight):
+    ids = make_tasks(min(MAX_TASKS, in_flight * TASKS_PER_SLOT))
+    dispatcher.start()
+    threads = threading.active_count()
+    start = time.time()
+    for task_id in ids:
+        dispatcher.submit("dummy", task_id)
+    dispatcher.join()
+    elapsed = time.time() - start
+    dispatcher.stop()
+    failed = sum(1 for i in ids if server.store.get(i)["status"] != "completed")
+    return len(ids), elapsed, failed, threads
+
+
+def run_threads(in_flight):
+    server.microservices["dummy"]["pool_size"] = in_flight
+    server.clients.close()  # Recreate the sessions with the new pool size
+    return run(Dispatcher(server.execute_task, {"dummy": in_flight}), in_flight)
+
+
+def run_asyncio(in_flight):
+    server.microservices["dummy"]["pool_size"] = in_flight
+    server.async_clients = AsyncServiceClients(server.microservices)
+    dispatcher = AsyncDispatcher(server.execute_task_async, {"dummy": in_flight}, on_stop=server.async_clients.close)
+    return run(dispatcher, in_flight)
+
+
+def report(label, in_flight, count, elapsed, failed, threads):
+    ideal = in_flight / DELAY
+    print(
+        f"{label:<8} in flight {in_flight:5d}  {count:5d} tasks  {elapsed:6.2f} s  "
+        f"{count / elapsed:7.1f} tasks/s (ideal {ideal:6.0f})  threads {threads:5d}  failed {failed}"
+    )
+
+
+def main():
+    logging.disable(logging.INFO)
+    server.registry.set_replicas("dummy", [start_async_stub(DELAY)])
+    server.microservices["dummy"]["async"] = False  # Synchronous /run, the stub has no callbacks
+    server.microservices["dummy"]["read_timeout"] = 60
+
+    print(f"stub delay {DELAY} s, {TASKS_PER_SLOT} tasks per in-flight slot")
+    for in_flight in (16, 64, 256):
+        report("threads", in_flight, *run_threads(in_flight))
+    for in_flight in (16, 64, 256, 1024):
+        report("asyncio", in_flight, *run_asyncio(in_flight))
+
+
+if __name__ == "__main__":
+    main()
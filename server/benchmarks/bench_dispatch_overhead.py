@@ -0,0 +1,78 @@
+"""
+Per-task dispatch overhead: a fresh connection per request vs the pooled keep-alive sessions.
+
+Both modes send the same `/run` request to a local Flask stub that answers immediately, so
+the measured time is the orchestrator-side cost of dispatching a task.
+
+Run from the server directory:  python -m benchmarks.bench_dispatch_overhead
+"""
+import logging
+import statistics
+import threading
+import time
+
+import requests
+
+from clients import ServiceClients
+from benchmarks.stubs import start_stub
+
+TASKS = 1000
+WORKERS = 8
+
+
+def dispatch_fresh(address):
+    requests.post(f"http://{address}/run", json={"directory": "bench"}, timeout=3600)
+
+
+def make_dispatch_pooled(address):
+    clients = ServiceClients({"stub": {"address": address, "max_in_flight": WORKERS}})
+
+    def dispatch(address):
+        clients.post("stub", address, "/run", json={"directory": "bench"})
+
+    return dispatch
+
+
+def run(dispatch, address):
+    latencies = []
+    lock = threading.Lock()
+    per_worker = TASKS // WORKERS
+
+    def worker():
+        local = []
+        for _ in range(per_worker):
+            start = time.perf_counter()
+            dispatch(address)
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(WORKERS)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return elapsed, latencies
+
+
+def report(label, elapsed, latencies):
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(
+        f"{label:<26} {len(latencies) / elapsed:8.1f} tasks/s  "
+        f"mean {statistics.mean(latencies) * 1000:6.2f} ms  p99 {p99 * 1000:6.2f} ms"
+    )
+
+
+def main():
+    logging.disable(logging.INFO)
+    address = start_stub(0.0)
+    print(f"{TASKS} dispatches with {WORKERS} concurrent workers against {address}")
+    report("fresh connection per task", *run(dispatch_fresh, address))
+    report("pooled keep-alive session", *run(make_dispatch_pooled(address), address))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Concurrent, deduplicated series retrieval in OrchestratorPACS.
+
+A fake RemotePACS sleeps DELAY seconds per series and counts its downloads and the most
+downloads it served at once. REQUESTS_PER_SERIES threads ask for each of SERIES series at the
+same time: every series must be downloaded exactly once, no remote may serve more than
+`max_per_remote` downloads at once, and no partial download may be left behind.
+
+Run from the server directory:  python -m benchmarks.bench_pacs_downloads
+"""
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pacs import DownloadManager, OrchestratorPACS, RemotePACS
+
+DELAY = 0.5
+SERIES = 8
+REQUESTS_PER_SERIES = 4
+
+
+class SleepingRemotePACS(RemotePACS):
+    def __init__(self, remote_url, delay, fail=()):
+        super().__init__(remote_url)
+        self.delay = delay
+        self.fail = set(fail)
+        self.downloads = 0
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def download_series(self, series_instance_uid, destination_folder, manifest=None):
+        if manifest is not None:
+            manifest.expect(2)
+        with self._lock:
+            self.downloads += 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            os.makedirs(destination_folder, exist_ok=True)
+            with open(os.path.join(destination_folder, "1.dcm"), "w") as f:
+                f.write("first half")
+            time.sleep(self.delay)
+            if series_instance_uid in self.fail:
+                return False
+            with open(os.path.join(destination_folder, "2.dcm"), "w") as f:
+                f.write("second half")
+            return True
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+def run(max_workers, max_per_remote, remotes=1):
+    directory = tempfile.mkdtemp(prefix="bench-pacs-")
+    downloads = DownloadManager(max_workers=max_workers, max_per_remote=max_per_remote)
+    for r in range(remotes):
+        os.makedirs(os.path.join(directory, str(r)))
+    pacs = [
+        OrchestratorPACS(os.path.join(directory, str(r)), SleepingRemotePACS(f"pacs-{r}", DELAY), downloads=downloads)
+        for r in range(remotes)
+    ]
+    requests = [(pacs[s % remotes], f"1.2.3.{s}") for s in range(SERIES) for _ in range(REQUESTS_PER_SERIES)]
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=len(requests)) as pool:
+        paths = list(pool.map(lambda request: request[0].get_series(request[1]), requests))
+    elapsed = time.time() - start
+
+    complete = all(sorted(os.listdir(path)) == ["1.dcm", "2.dcm"] for path in paths)
+    leftovers = sum(len(os.listdir(p.partial_directory)) for p in pacs)
+    return {
+        "elapsed": elapsed,
+        "downloads": sum(p.remote_pacs.downloads for p in pacs),
+        "max_active": max(p.remote_pacs.max_active for p in pacs),
+        "complete": complete,
+        "leftovers": leftovers,
+    }
+
+
+def failed_download():
+    directory = tempfile.mkdtemp(prefix="bench-pacs-")
+    pacs = OrchestratorPACS(directory, SleepingRemotePACS("pacs-0", DELAY / 5, fail=("1.2.3.0",)))
+    try:
+        pacs.get_series("1.2.3.0")
+    except RuntimeError:
+        pass
+    visible = os.path.exists(os.path.join(directory, "1.2.3.0"))
+    return visible, len(os.listdir(pacs.partial_directory)), pacs.downloads.in_flight()
+
+
+def main():
+    print(f"{SERIES} series x {REQUESTS_PER_SERIES} concurrent requests, {DELAY}s per download\n")
+    print(f"{'workers':>8} {'per remote':>11} {'remotes':>8} {'downloads':>10} {'max active':>11} {'seconds':>8}  ok")
+    for max_workers, max_per_remote, remotes in ((1, 1, 1), (4, 2, 1), (8, 4, 1), (8, 2, 2)):
+        r = run(max_workers, max_per_remote, remotes)
+        ok = r["downloads"] == SERIES and r["max_active"] <= max_per_remote and r["complete"] and not r["leftovers"]
+        print(f"{max_workers:>8} {max_per_remote:>11} {remotes:>8} {r['downloads']:>10} {r['max_active']:>11} "
+              f"{r['elapsed']:>8.2f}  {'yes' if ok else 'NO'}")
+
+    visible, leftovers, in_flight = failed_download()
+    print(f"\nFailed download: series visible={visible}, partial folders left={leftovers}, in flight={in_flight}")
+
+
+if __name__ == "__main__":
+    main()
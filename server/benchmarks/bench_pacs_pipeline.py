@@ -0,0 +1,60 @@
+"""
+End-to-end time of qa_segmentation pipelines on PACS series, and a regression check that
+chaining the stages of a pipeline on a series that is already local does not stall.
+
+PIPELINES runs of `POST /pipeline/qa_segmentation {"series_instance_uid": ...}` are started on
+SERIES series of a sleeping fake RemotePACS, against stub microservices that answer after
+STAGE_DELAY seconds. The qa stage downloads the series; when it finishes, the segmentation stage
+finds the series local, so its download completes at once from inside the finish of the qa
+stage. Every pipeline must complete within TIMEOUT seconds, each series downloaded once, and
+no series may stay pinned.
+
+Run from the server directory:  python -m benchmarks.bench_pacs_pipeline
+"""
+import logging
+import sys
+import tempfile
+import time
+
+import server
+from pacs import OrchestratorPACS
+from benchmarks.bench_pacs_downloads import SleepingRemotePACS
+from benchmarks.stubs import start_stub
+
+DELAY = 0.3
+STAGE_DELAY = 0.05
+SERIES = 4
+PIPELINES = 16
+TIMEOUT = 30
+
+
+def main():
+    logging.disable(logging.WARNING)
+    server.pacs = OrchestratorPACS(tempfile.mkdtemp(prefix="bench-pipeline-"), SleepingRemotePACS("pacs", DELAY))
+    address = start_stub(STAGE_DELAY)
+    for name in ("process_dicom", "vascular_segmentation"):
+        server.registry.set_replicas(name, [address])
+    client = server.app.test_client()
+
+    start = time.time()
+    runs = [
+        client.post("/pipeline/qa_segmentation", json={"series_instance_uid": f"1.2.3.{i % SERIES}"}).json["task_id"]
+        for i in range(PIPELINES)
+    ]
+    while time.time() - start < TIMEOUT:
+        statuses = [server.store.get(task_id)["status"] for task_id in runs]
+        if all(status in server.FINISHED_STATUSES for status in statuses):
+            break
+        time.sleep(0.05)
+    elapsed = time.time() - start
+
+    completed = statuses.count("completed")
+    print(f"{PIPELINES} pipelines on {SERIES} series, {DELAY}s per download, {STAGE_DELAY}s per stage\n")
+    print(f"completed {completed}/{PIPELINES} in {elapsed:.2f} s, "
+          f"downloads {server.pacs.remote_pacs.downloads}, still pinned {len(server.pinned_series)}")
+    if completed != PIPELINES:
+        sys.exit(f"Pipelines stalled: {sorted(set(statuses))}")
+
+
+if __name__ == "__main__":
+    main()
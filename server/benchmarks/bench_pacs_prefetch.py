@@ -0,0 +1,55 @@
+"""
+Time a task waits for its series, with and without prefetching the worklist.
+
+The studies of a worklist arrive every ARRIVAL seconds and each series takes DELAY seconds to
+download from a sleeping fake RemotePACS. Without prefetching every task pays the download on
+its critical path; with it, the Prefetcher downloads the worklist ahead of the arrivals, within
+a disk budget of BUDGET_SERIES unused series.
+
+Run from the server directory:  python -m benchmarks.bench_pacs_prefetch
+"""
+import contextlib
+import io
+import statistics
+import tempfile
+import time
+
+from pacs import OrchestratorPACS
+from prefetch import Prefetcher
+from benchmarks.bench_pacs_downloads import SleepingRemotePACS
+
+DELAY = 0.3
+ARRIVAL = 0.4
+SERIES = 10
+BUDGET_SERIES = 3
+SERIES_BYTES = len("first half") + len("second half")
+
+
+def run(prefetch):
+    pacs = OrchestratorPACS(tempfile.mkdtemp(prefix="bench-prefetch-"), SleepingRemotePACS("pacs", DELAY))
+    worklist = [f"1.2.3.{i}" for i in range(SERIES)]
+    if prefetch:
+        prefetcher = Prefetcher(pacs, disk_budget=BUDGET_SERIES * SERIES_BYTES, budget_check_interval=0.05)
+        prefetcher.add(worklist)
+
+    waits = []
+    for uid in worklist:
+        time.sleep(ARRIVAL)
+        start = time.time()
+        pacs.get_series(uid)
+        waits.append(time.time() - start)
+    return waits, pacs.stats()
+
+
+def main():
+    print(f"{SERIES} series, one every {ARRIVAL}s, {DELAY}s per download\n")
+    print(f"{'prefetch':>9} {'mean wait':>10} {'max wait':>9} {'hit rate':>9} {'prefetch hits':>14} {'late':>5}")
+    for prefetch in (False, True):
+        with contextlib.redirect_stdout(io.StringIO()):
+            waits, stats = run(prefetch)
+        print(f"{'yes' if prefetch else 'no':>9} {statistics.mean(waits):>10.3f} {max(waits):>9.3f} "
+              f"{stats['hit_rate']:>9.2f} {stats['prefetch_hits']:>14} {stats['prefetch_late']:>5}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Task submission throughput of the `/run/*` endpoints, one task per request vs the batch endpoint,
+with both task store backends.
+
+The dispatcher workers are stopped, so only the cost of accepting and enqueuing tasks is measured.
+
+Run from the server directory:  python -m benchmarks.bench_submission
+"""
+import logging
+import os
+import tempfile
+import time
+
+import server
+from task_store import MemoryTaskStore, SQLiteTaskStore
+
+TASKS = 2000
+BATCH_SIZE = 100
+
+
+def submit_single(client):
+    ids = []
+    for i in range(TASKS):
+        response = client.get(f"/run/process_dicom?directory=Serie{i}")
+        ids.append(response.json["task_id"])
+    return ids
+
+
+def submit_batch(client):
+    ids = []
+    for start in range(0, TASKS, BATCH_SIZE):
+        directories = [f"Serie{i}" for i in range(start, start + BATCH_SIZE)]
+        response = client.post("/run/process_dicom/batch", json={"directories": directories})
+        ids.extend(response.json["task_ids"])
+    return ids
+
+
+def main():
+    logging.disable(logging.INFO)
+    server.dispatcher.stop()
+    client = server.app.test_client()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        stores = {
+            "memory": MemoryTaskStore,
+            "sqlite": lambda: SQLiteTaskStore(os.path.join(tmp, f"tasks_{time.time_ns()}.db")),
+        }
+        print(f"{TASKS} process_dicom submissions")
+        for backend, factory in stores.items():
+            for label, submit in [("single", submit_single), (f"batch of {BATCH_SIZE}", submit_batch)]:
+                server.store = factory()
+                start = time.perf_counter()
+                ids = submit(client)
+                elapsed = time.perf_counter() - start
+                print(
+                    f"{backend:<7} {label:<13} {TASKS / elapsed:9.1f} tasks/s  "
+                    f"unique ids {len(set(ids))}/{len(ids)}  stored {len(server.store.list())}"
+                )
+
+
+if __name__ == "__main__":
+    main()
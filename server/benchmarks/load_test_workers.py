@@ -0,0 +1,120 @@
+"""
+Load test of the per-microservice worker pools against local stub services.
+
+A mixed workload of slow `dummy` jobs and fast `process_dicom` jobs is dispatched with the
+previous single-worker design and with several pool configurations.
+
+Run from the server directory:  python -m benchmarks.load_test_workers
+"""
+import itertools
+import logging
+import queue
+import statistics
+import threading
+import time
+
+import server
+from dispatcher import Dispatcher
+from benchmarks.stubs import start_stub
+
+SLOW_DELAY = 1.0
+FAST_DELAY = 0.05
+SLOW_TASKS = 4
+FAST_TASKS = 60
+
+task_ids = itertools.count(1)
+
+
+def make_tasks():
+    """
+    Create the mixed workload: one slow task every FAST_TASKS // SLOW_TASKS fast ones.
+    """
+    workload = []
+    every = FAST_TASKS // SLOW_TASKS
+    for i in range(FAST_TASKS):
+        if i % every == 0:
+            workload.append("dummy")
+        workload.append("process_dicom")
+
+    ids = []
+    for microservice in workload:
+        task_id = next(task_ids)
+        server.store.add({
+            "task_id": task_id,
+            "microservice": microservice,
+            "address": None,
+            "status": "queued",
+            "data": {"directory": "bench"},
+            "result": None,
+            "created_at": time.time(),
+            "source_path": "bench",
+        })
+        ids.append(task_id)
+    return ids
+
+
+def run_single_worker():
+    """
+    Previous design: one thread draining one FIFO queue for every microservice.
+    """
+    task_queue = queue.Queue()
+
+    def worker():
+        while True:
+            task_id = task_queue.get()
+            if task_id is None:
+                break
+            server.execute_task(task_id)
+            task_queue.task_done()
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    start = time.time()
+    ids = make_tasks()
+    for task_id in ids:
+        task_queue.put(task_id)
+    task_queue.join()
+    task_queue.put(None)
+    return ids, time.time() - start
+
+
+def run_pool(concurrency):
+    for microservice, limit in concurrency.items():
+        server.microservices[microservice]["pool_size"] = limit
+    server.clients.close()  # Recreate the sessions with the new pool sizes
+    dispatcher = Dispatcher(server.execute_task, concurrency)
+    dispatcher.start()
+    start = time.time()
+    ids = make_tasks()
+    for task_id in ids:
+        dispatcher.submit(server.store.get(task_id)["microservice"], task_id)
+    dispatcher.join()
+    elapsed = time.time() - start
+    dispatcher.stop()
+    return ids, elapsed
+
+
+def report(label, ids, elapsed):
+    done = [server.store.get(i) for i in ids]
+    latencies = sorted(t["completed_at"] - t["created_at"] for t in done if t["microservice"] == "process_dicom")
+    failed = sum(1 for t in done if t["status"] != "completed")
+    print(
+        f"{label:<34} {elapsed:7.2f} s  {len(ids) / elapsed:7.1f} tasks/s  "
+        f"fast p50 {statistics.median(latencies):6.2f} s  "
+        f"fast max {latencies[-1]:6.2f} s  failed {failed}"
+    )
+
+
+def main():
+    logging.disable(logging.INFO)
+    server.registry.set_replicas("dummy", [start_stub(SLOW_DELAY)])
+    server.registry.set_replicas("process_dicom", [start_stub(FAST_DELAY)])
+
+    print(f"{SLOW_TASKS} x {SLOW_DELAY} s dummy + {FAST_TASKS} x {FAST_DELAY} s process_dicom")
+    report("single worker (previous design)", *run_single_worker())
+    for slow, fast in [(1, 1), (1, 4), (2, 8), (4, 16)]:
+        report(f"pool dummy={slow} process_dicom={fast}", *run_pool({"dummy": slow, "process_dicom": fast}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Discrete-event simulation of one segmentation worker under a retrospective bulk backlog.
+
+A research tenant submits a batch of 500 studies at t=0 while clinical tenants keep sending
+routine and stat requests. The same arrivals are scheduled with a plain FIFO queue and with
+FairPriorityQueue, and the queue wait per priority class is reported in virtual seconds.
+
+Run from the server directory:  python -m benchmarks.sim_priority_scheduling
+"""
+import collections
+import random
+import statistics
+
+from scheduler import FairPriorityQueue
+
+SERVICE_TIME = 60.0         # Mean segmentation time, in seconds
+BULK_TASKS = 500
+ROUTINE_RATE = 1 / 150.0    # Arrivals per second, per clinical tenant
+STAT_RATE = 1 / 1800.0
+CLINICAL_TENANTS = ("cardiology", "neurology")
+HORIZON = 12 * 3600.0       # Clinical arrivals during the first 12 hours
+AGING = 1800.0
+
+
+def make_arrivals(seed=1):
+    rng = random.Random(seed)
+    arrivals = [(0.0, "batch", "research") for _ in range(BULK_TASKS)]
+    for tenant in CLINICAL_TENANTS:
+        for priority, rate in (("routine", ROUTINE_RATE), ("stat", STAT_RATE)):
+            t = rng.expovariate(rate)
+            while t < HORIZON:
+                arrivals.append((t, priority, tenant))
+                t += rng.expovariate(rate)
+    arrivals.sort(key=lambda a: a[0])
+    service_times = [rng.expovariate(1 / SERVICE_TIME) for _ in arrivals]
+    return arrivals, service_times
+
+
+class FifoQueue:
+    def __init__(self):
+        self._items = collections.deque()
+
+    def put(self, item, priority, tenant):
+        self._items.append(item)
+
+    def get(self):
+        return self._items.popleft()
+
+    def qsize(self):
+        return len(self._items)
+
+
+def simulate(make_queue):
+    arrivals, service_times = make_arrivals()
+    clock = [0.0]
+    task_queue = make_queue(lambda: clock[0])
+    waits = collections.defaultdict(list)
+    next_arrival = 0
+
+    while next_arrival < len(arrivals) or task_queue.qsize():
+        # Enqueue everything that arrived while the worker was busy
+        while next_arrival < len(arrivals) and arrivals[next_arrival][0] <= clock[0]:
+            _, priority, tenant = arrivals[next_arrival]
+            task_queue.put(next_arrival, priority, tenant)
+            next_arrival += 1
+        if not task_queue.qsize():
+            clock[0] = arrivals[next_arrival][0]
+            continue
+        task = task_queue.get()
+        arrived_at, priority, _ = arrivals[task]
+        waits[priority].append(clock[0] - arrived_at)
+        clock[0] += service_times[task]
+    return waits
+
+
+def report(label, waits):
+    print(label)
+    for priority in ("stat", "routine", "batch"):
+        values = sorted(waits[priority])
+        p99 = values[max(0, int(len(values) * 0.99) - 1)]
+        print(
+            f"  {priority:<8} n={len(values):<4} p50 {statistics.median(values) / 60:7.1f} min  "
+            f"p99 {p99 / 60:7.1f} min"
+        )
+
+
+def main():
+    print(f"{BULK_TASKS} bulk studies at t=0, clinical traffic for {HORIZON / 3600:.0f} h, "
+          f"mean service time {SERVICE_TIME:.0f} s, 1 worker")
+    report("FIFO (previous queue.Queue)", simulate(lambda clock: FifoQueue()))
+    report(f"FairPriorityQueue (aging {AGING / 60:.0f} min)",
+           simulate(lambda clock: FairPriorityQueue(aging=AGING, clock=clock)))
+
+
+if __name__ == "__main__":
+    main()
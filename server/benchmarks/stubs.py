@@ -0,0 +1,55 @@
+import asyncio
+import threading
+import time
+
+from aiohttp import web
+from flask import Flask, jsonify
+from werkzeug.serving import make_server
+
+
+def start_stub(delay: float = 0.0) -> str:
+    """
+    Start a local stub microservice that answers `/run` after `delay` seconds.
+
+    :param delay: Simulated processing time of each request, in seconds.
+    :return: The "host:port" address of the stub.
+    """
+    app = Flask(f"stub_{delay}")
+
+    @app.route("/run", methods=["POST"])
+    def run():
+        time.sleep(delay)
+        return jsonify({"status": "success", "result": "ok"}), 200
+
+    @app.route("/health", methods=["GET"])
+    def health():
+        return jsonify({"status": "ok"}), 200
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"127.0.0.1:{server.server_port}"
+
+
+def start_async_stub(delay: float = 0.0) -> str:
+    """
+    Start a local stub microservice on its own asyncio loop, so thousands of concurrent
+    requests can wait `delay` seconds without one thread each.
+
+    :param delay: Simulated processing time of each request, in seconds.
+    :return: The "host:port" address of the stub.
+    """
+    async def run(request):
+        await asyncio.sleep(delay)
+        return web.json_response({"status": "success", "result": "ok"})
+
+    app = web.Application()
+    app.router.add_post("/run", run)
+    app.router.add_get("/health", lambda request: web.json_response({"status": "ok"}))
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(app, access_log=None)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0, backlog=4096)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return f"127.0.0.1:{port}"
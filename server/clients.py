@@ -0,0 +1,177 @@
+import asyncio
+import threading
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 3600
+# Sense read_timeout explícit, s'espera fins a READ_TIMEOUT_FACTOR vegades la durada esperada
+READ_TIMEOUT_FACTOR = 3
+
+
+def connection_failed(error: Exception) -> bool:
+    """
+    :return: True if the error means the microservice could not be reached at all (as opposed
+             to a slow or failed response), for both the requests and the aiohttp clients.
+    """
+    return isinstance(error, (requests.ConnectionError, aiohttp.ClientConnectorError))
+
+
+def transient_error(error: Exception) -> bool:
+    """
+    :return: True if the request failed in a way worth retrying: the microservice could not be
+             reached, dropped the connection or did not answer in time.
+    """
+    return isinstance(error, (
+        requests.ConnectionError, requests.Timeout, aiohttp.ClientConnectionError, asyncio.TimeoutError,
+    ))
+
+
+def read_timeout(config: dict) -> float:
+    """
+    :param config: The configuration of a microservice.
+    :return: Its `read_timeout`, or READ_TIMEOUT_FACTOR times its `expected_duration`.
+    """
+    if "read_timeout" in config:
+        return config["read_timeout"]
+    if "expected_duration" in config:
+        return config["expected_duration"] * READ_TIMEOUT_FACTOR
+    return DEFAULT_READ_TIMEOUT
+
+
+class ServiceClients:
+    """
+    Keeps one pooled, keep-alive HTTP session per microservice.
+
+    The session is shared by all the dispatch workers of the service, so consecutive tasks
+    reuse the same TCP connections instead of opening a new one per request.
+    """
+
+    def __init__(self, config: dict):
+        """
+        Initialize the clients.
+
+        :param config: The microservices configuration. Each entry may define `pool_size`
+                       (connections per replica, defaults to `max_in_flight`), `replicas`,
+                       `connect_timeout` and `read_timeout` (or `expected_duration`).
+        """
+        self.config = config
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session(self, microservice: str) -> requests.Session:
+        """
+        Return the session of a microservice, creating it on first use.
+
+        :param microservice: Name of the microservice.
+        :return: A requests.Session with a connection pool sized for the service.
+        """
+        with self._lock:
+            session = self._sessions.get(microservice)
+            if session is None:
+                config = self.config[microservice]
+                pool_size = config.get("pool_size", config.get("max_in_flight", 1))
+                # Un pool de connexions per rèplica
+                adapter = HTTPAdapter(pool_connections=len(config.get("replicas") or [None]), pool_maxsize=pool_size)
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[microservice] = session
+            return session
+
+    def timeout(self, microservice: str) -> tuple:
+        """
+        :return: The (connect, read) timeout of the microservice, in seconds.
+        """
+        config = self.config[microservice]
+        return config.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT), read_timeout(config)
+
+    def post(self, microservice: str, address: str, path: str, **kwargs) -> requests.Response:
+        """
+        Send a POST request to a microservice through its pooled session.
+
+        :param microservice: Name of the microservice.
+        :param address: The "host:port" of the microservice.
+        :param path: Path of the endpoint, e.g. "/run".
+        :return: The response of the microservice.
+        """
+        kwargs.setdefault("timeout", self.timeout(microservice))
+        return self.session(microservice).post(f"http://{address}{path}", **kwargs)
+
+    def get(self, microservice: str, address: str, path: str, **kwargs) -> requests.Response:
+        """
+        Send a GET request to a microservice through its pooled session.
+
+        :param microservice: Name of the microservice.
+        :param address: The "host:port" of the microservice.
+        :param path: Path of the endpoint, e.g. "/jobs/<job_id>".
+        :return: The response of the microservice.
+        """
+        kwargs.setdefault("timeout", self.timeout(microservice))
+        return self.session(microservice).get(f"http://{address}{path}", **kwargs)
+
+    def close(self):
+        """
+        Close every session and its pooled connections.
+        """
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+
+class AsyncServiceClients:
+    """
+    Asynchronous counterpart of ServiceClients for the asyncio dispatcher: one aiohttp session
+    per microservice, with a keep-alive connection pool of `pool_size` connections per replica.
+
+    The sessions are bound to the event loop that creates them, so they must only be used
+    from the dispatcher loop.
+    """
+
+    def __init__(self, config: dict):
+        """
+        Initialize the clients.
+
+        :param config: The microservices configuration, as in ServiceClients.
+        """
+        self.config = config
+        self._sessions = {}
+
+    def session(self, microservice: str):
+        """
+        Return the aiohttp session of a microservice, creating it on first use.
+        """
+        session = self._sessions.get(microservice)
+        if session is None or session.closed:
+            config = self.config[microservice]
+            pool_size = config.get("pool_size", config.get("max_in_flight", 1))
+            replicas = len(config.get("replicas") or [None])
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=pool_size * replicas, limit_per_host=pool_size),
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=config.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT),
+                    total=read_timeout(config),
+                ),
+            )
+            self._sessions[microservice] = session
+        return session
+
+    async def post(self, microservice: str, address: str, path: str, **kwargs) -> tuple:
+        """
+        Send a POST request to a microservice through its pooled session.
+
+        :return: The HTTP status, the text and the headers of the response.
+        """
+        async with self.session(microservice).post(f"http://{address}{path}", **kwargs) as response:
+            return response.status, await response.text(), response.headers
+
+    async def close(self):
+        """
+        Close every session and its pooled connections.
+        """
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions = {}
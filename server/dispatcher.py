@@ -0,0 +1,163 @@
+import logging
+import threading
+
+from scheduler import FairPriorityQueue, DEFAULT_PRIORITY, DEFAULT_TENANT
+
+# Returned by the handler when the task keeps running on the microservice after the handler
+# returns (asynchronous job). Its in-flight slot is held until `release` is called.
+DETACHED = "detached"
+
+
+class Dispatcher:
+    """
+    Dispatches queued tasks to a pool of worker threads per microservice.
+
+    Each microservice gets its own queue, a pool of worker threads, and a maximum number of
+    tasks in flight against that service. A long job on one service does not block the tasks
+    queued for the others. Each queue is a FairPriorityQueue, so urgent tasks overtake bulk
+    submissions.
+
+    A synchronous task holds its slot while the handler runs. An asynchronous task (handler
+    returns DETACHED) holds it until its completion is reported with `release`, so a few
+    threads can keep many long jobs in flight.
+    """
+
+    def __init__(self, handler, concurrency: dict, aging: float = 600, workers: dict = None):
+        """
+        Initialize the dispatcher.
+
+        :param handler: Callable run by a worker thread for every task, receives the task_id.
+        :param concurrency: Maps each microservice name to its maximum number of in-flight tasks.
+        :param aging: Seconds of waiting that promote a queued task by one priority level.
+        :param workers: Maps each microservice name to its number of worker threads
+                        (defaults to its maximum number of in-flight tasks).
+        """
+        self.handler = handler
+        self.concurrency = dict(concurrency)
+        self.workers = {name: (workers or {}).get(name, limit) for name, limit in self.concurrency.items()}
+        self._queues = {name: FairPriorityQueue(aging=aging) for name in self.concurrency}
+        self._in_flight = {name: 0 for name in self.concurrency}
+        self._reserved = {name: 0 for name in self.concurrency}
+        self._lock = threading.Lock()
+        self._slot_free = threading.Condition(self._lock)
+        self._threads = []
+
+    def start(self):
+        """
+        Start the worker threads of every microservice.
+        """
+        for microservice, count in self.workers.items():
+            for i in range(max(1, count)):
+                thread = threading.Thread(
+                    target=self._worker,
+                    args=(microservice,),
+                    name=f"worker-{microservice}-{i}",
+                    daemon=True,
+                )
+                thread.start()
+                self._threads.append((microservice, thread))
+
+    def stop(self):
+        """
+        Stop all worker threads once they finish the tasks already queued.
+        """
+        for microservice, _ in self._threads:
+            self._queues[microservice].put(None)
+        for _, thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, microservice: str, task_id, priority: str = DEFAULT_PRIORITY, tenant: str = DEFAULT_TENANT):
+        """
+        Enqueue a task for the given microservice.
+
+        :param microservice: Name of the target microservice.
+        :param task_id: Identifier passed to the handler when a worker picks the task.
+        :param priority: Priority class of the task ("stat", "routine" or "batch").
+        :param tenant: Tenant that submitted the task, for fair share inside a priority class.
+        """
+        self._queues[microservice].put(task_id, priority, tenant)
+
+    def cancel(self, microservice: str, task_id) -> bool:
+        """
+        Remove a task from the queue of a microservice before it is dispatched.
+
+        :return: True if the task was still waiting in the queue.
+        """
+        return self._queues[microservice].remove(task_id)
+
+    def release(self, microservice: str):
+        """
+        Free the in-flight slot of a detached task once the microservice reports its completion.
+
+        :param microservice: Name of the microservice that ran the task.
+        """
+        with self._slot_free:
+            self._in_flight[microservice] -= 1
+            self._reserved[microservice] -= 1
+            self._slot_free.notify_all()
+
+    def adopt(self, microservice: str):
+        """
+        Count as in flight a detached task started before a restart. It must be released later.
+
+        :param microservice: Name of the microservice running the task.
+        """
+        with self._lock:
+            self._in_flight[microservice] += 1
+            self._reserved[microservice] += 1
+
+    def join(self):
+        """
+        Block until every queued task has been handled.
+        """
+        for q in self._queues.values():
+            q.join()
+
+    def queue_depth(self, microservice: str) -> int:
+        """
+        :return: Number of tasks waiting for a free worker of the microservice.
+        """
+        return self._queues[microservice].qsize()
+
+    def queue_depth_by_priority(self, microservice: str) -> dict:
+        """
+        :return: Number of waiting tasks of the microservice per priority class.
+        """
+        return self._queues[microservice].depth_by_priority()
+
+    def in_flight(self, microservice: str) -> int:
+        """
+        :return: Number of tasks currently being processed by the microservice.
+        """
+        with self._lock:
+            return self._in_flight[microservice]
+
+    def _worker(self, microservice: str):
+        task_queue = self._queues[microservice]
+        limit = max(1, self.concurrency[microservice])
+        while True:
+            # Reserva una plaça abans d'agafar la tasca, per respectar max_in_flight
+            with self._slot_free:
+                self._slot_free.wait_for(lambda: self._reserved[microservice] < limit)
+                self._reserved[microservice] += 1
+
+            task_id = task_queue.get()
+            if task_id is None:  # Permet tancar el worker
+                with self._slot_free:
+                    self._reserved[microservice] -= 1
+                    self._slot_free.notify_all()
+                task_queue.task_done()
+                break
+
+            with self._lock:
+                self._in_flight[microservice] += 1
+            detached = False
+            try:
+                detached = self.handler(task_id) == DETACHED
+            except Exception:
+                logging.exception(f"Unhandled error processing task {task_id} on {microservice}")
+            finally:
+                if not detached:
+                    self.release(microservice)
+                task_queue.task_done()
@@ -0,0 +1,89 @@
+import queue
+import threading
+
+# Fields of a task sent with each event
+EVENT_FIELDS = (
+    "task_id", "microservice", "status", "source_path", "created_at",
+    "started_at", "completed_at", "ellapsed_time", "result", "version",
+)
+
+
+class Subscriber:
+    """
+    A bounded queue of task events for one client. If the client falls behind and the queue
+    fills up, new events are dropped and `lagged` is set so the client can resynchronise.
+    """
+
+    def __init__(self, max_events: int, task_id=None, microservice=None):
+        self.events = queue.Queue(maxsize=max_events)
+        self.lagged = False
+        self.task_id = task_id
+        self.microservice = microservice
+
+    def wants(self, event: dict) -> bool:
+        if self.task_id is not None and event["task_id"] != self.task_id:
+            return False
+        if self.microservice is not None and event["microservice"] != self.microservice:
+            return False
+        return True
+
+
+class TaskEvents:
+    """
+    Publishes task state transitions to the event stream subscribers and wakes up the
+    long-polling requests waiting for a task to change.
+    """
+
+    def __init__(self, max_events: int = 1000):
+        """
+        :param max_events: Maximum number of pending events per subscriber.
+        """
+        self.max_events = max_events
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition()
+
+    def publish(self, task: dict):
+        """
+        Notify a change of a task.
+
+        :param task: The task record after the change.
+        """
+        event = {field: task[field] for field in EVENT_FIELDS if field in task}
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            if not subscriber.wants(event):
+                continue
+            try:
+                subscriber.events.put_nowait(event)
+            except queue.Full:
+                subscriber.lagged = True
+        with self._changed:
+            self._changed.notify_all()
+
+    def subscribe(self, task_id=None, microservice=None) -> Subscriber:
+        """
+        Register a new subscriber, optionally only interested in one task or microservice.
+
+        :return: The subscriber, to be passed to `unsubscribe` when the client disconnects.
+        """
+        subscriber = Subscriber(self.max_events, task_id, microservice)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def wait(self, predicate, timeout: float) -> bool:
+        """
+        Block until `predicate()` is true, re-evaluating it after every published event.
+
+        :param predicate: Callable without arguments.
+        :param timeout: Maximum time to wait, in seconds.
+        :return: The last value of the predicate.
+        """
+        with self._changed:
+            return self._changed.wait_for(predicate, timeout)
@@ -0,0 +1,117 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+# Buckets from sub-second dispatches to hour-long segmentations
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+
+QUEUE_WAIT = Histogram(
+    "orchestrator_queue_wait_seconds",
+    "Time between the creation of a task and the first time a worker picks it up.",
+    ["microservice", "priority"],
+    buckets=DURATION_BUCKETS,
+)
+EXECUTION_TIME = Histogram(
+    "orchestrator_service_execution_seconds",
+    "Time from the start of the dispatch to the end of the task (ellapsed_time).",
+    ["microservice", "status"],
+    buckets=DURATION_BUCKETS,
+)
+DISPATCH_LATENCY = Histogram(
+    "orchestrator_dispatch_latency_seconds",
+    "Duration of the HTTP request sent to the microservice, including the connection setup.",
+    ["microservice"],
+    buckets=DURATION_BUCKETS,
+)
+TASKS_FINISHED = Counter(
+    "orchestrator_tasks_finished_total",
+    "Finished tasks by final status.",
+    ["microservice", "status"],
+)
+TASK_FAILURES = Counter(
+    "orchestrator_task_failures_total",
+    "Failed tasks by HTTP status of the microservice response ('error' if there was no response).",
+    ["microservice", "http_status"],
+)
+QUEUE_DEPTH = Gauge(
+    "orchestrator_queue_depth",
+    "Tasks waiting for a free worker.",
+    ["microservice", "priority"],
+)
+IN_FLIGHT = Gauge(
+    "orchestrator_in_flight_tasks",
+    "Tasks currently being processed by the microservice.",
+    ["microservice"],
+)
+TASK_RETRIES = Counter(
+    "orchestrator_task_retries_total",
+    "Tasks queued again after a transient failure (connection error, timeout, 502/503/504).",
+    ["microservice"],
+)
+CIRCUIT_OPEN = Gauge(
+    "orchestrator_circuit_open",
+    "1 while the circuit breaker of the microservice is open or half open, 0 when closed.",
+    ["microservice"],
+)
+RESULT_CACHE = Gauge(
+    "orchestrator_result_cache",
+    "Result cache counters (entries, in_flight, hits, misses, coalesced, evictions, hit_rate).",
+    ["stat"],
+)
+PACS_CACHE = Gauge(
+    "orchestrator_pacs_cache",
+    "Local PACS cache counters (hits, misses, hit_rate, prefetched, prefetch_hits, prefetch_late, ...).",
+    ["stat"],
+)
+
+
+def register_gauges(dispatcher, microservices: dict, result_cache, breakers: dict = None, pacs=None):
+    """
+    Bind the gauges to the live state of the dispatcher and the result cache, read at scrape time.
+
+    :param dispatcher: The Dispatcher of the orchestrator.
+    :param microservices: The microservices configuration.
+    :param result_cache: The ResultCache of the orchestrator.
+    :param breakers: The CircuitBreaker of each microservice.
+    :param pacs: The OrchestratorPACS, if the orchestrator downloads series from a PACS.
+    """
+    for microservice in microservices:
+        IN_FLIGHT.labels(microservice).set_function(lambda m=microservice: dispatcher.in_flight(m))
+        for priority in dispatcher.queue_depth_by_priority(microservice):
+            QUEUE_DEPTH.labels(microservice, priority).set_function(
+                lambda m=microservice, p=priority: dispatcher.queue_depth_by_priority(m)[p]
+            )
+    for microservice, breaker in (breakers or {}).items():
+        CIRCUIT_OPEN.labels(microservice).set_function(lambda b=breaker: int(b.state != b.CLOSED))
+    for stat in result_cache.stats():
+        RESULT_CACHE.labels(stat).set_function(lambda s=stat: result_cache.stats()[s])
+    if pacs is not None:
+        for stat in pacs.stats():
+            PACS_CACHE.labels(stat).set_function(lambda s=stat: pacs.stats()[s])
+
+
+def observe_queue_wait(task: dict, started_at: float):
+    """
+    Record the queue wait of a task picked up by a worker for the first time.
+
+    :param task: The task record when it started running.
+    :param started_at: When the dispatch started.
+    """
+    QUEUE_WAIT.labels(task["microservice"], task.get("priority", "routine")).observe(
+        max(0.0, started_at - task["created_at"])
+    )
+
+
+def observe_task(task: dict, started_at: float, update: dict):
+    """
+    Record the metrics of a finished task.
+
+    :param task: The task record when it started running.
+    :param started_at: When the dispatch started.
+    :param update: The final fields of the task (status, result, ellapsed_time).
+    """
+    microservice = task["microservice"]
+    EXECUTION_TIME.labels(microservice, update["status"]).observe(update["ellapsed_time"])
+    TASKS_FINISHED.labels(microservice, update["status"]).inc()
+    if update["status"] == "failed":
+        result = update.get("result")
+        http_status = result.get("http_status", "error") if isinstance(result, dict) else "error"
+        TASK_FAILURES.labels(microservice, str(http_status)).inc()
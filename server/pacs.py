@@ -1,6 +1,15 @@
+import logging
 import os
 import shutil
+import tempfile
+import threading
 import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+from pacs_cache import SeriesCacheIndex, ManifestWriter, build_manifest, check_manifest, series_size
+from result_cache import series_fingerprint
 
 class RemotePACS:
     """
@@ -15,12 +24,13 @@ class RemotePACS:
         """
         self.remote_url = remote_url  # Placeholder, replace with actual PACS connection
 
-    def download_series(self, series_instance_uid: str, destination_folder: str) -> bool:
+    def download_series(self, series_instance_uid: str, destination_folder: str, manifest: ManifestWriter = None) -> bool:
         """
         Simulates downloading a DICOM series from a remote PACS to the local system.
 
         :param series_instance_uid: The Series Instance UID of the requested series.
         :param destination_folder: The local folder where the series will be stored.
+        :param manifest: Receives the number of instances of the series and the files as they are written.
         :return: True if the download is successful, False otherwise.
         """
         print(f"[RemotePACS] Downloading series {series_instance_uid} from {self.remote_url}...")
@@ -32,30 +42,159 @@ class RemotePACS:
         os.makedirs(destination_folder, exist_ok=True)
         fake_dicom_path = os.path.join(destination_folder, f"{series_instance_uid}.dcm")
 
-        with open(fake_dicom_path, "w") as f:
-            f.write("Fake DICOM content")  # Replace with actual DICOM download logic
+        manifest = manifest or ManifestWriter()
+        manifest.expect(1)
+        with manifest.open(fake_dicom_path) as f:
+            f.write(b"Fake DICOM content")  # Replace with actual DICOM download logic
 
         print(f"[RemotePACS] Download complete: {fake_dicom_path}")
         return True
 
 
+class DownloadManager:
+    """
+    Runs series downloads on a thread pool.
+
+    Concurrent requests for the same key share one in-flight download future, and each remote
+    PACS gets at most `max_per_remote` downloads at a time so one slow remote does not take
+    every worker: the downloads over that limit wait in a queue of their remote, outside the
+    pool, and are submitted as the downloads of the same remote finish.
+    """
+
+    def __init__(self, max_workers: int = 4, max_per_remote: int = 2):
+        """
+        Initialize the download manager.
+
+        :param max_workers: Number of download threads.
+        :param max_per_remote: Maximum number of simultaneous downloads from each remote PACS.
+        """
+        self.max_per_remote = max_per_remote
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pacs-download")
+        self._in_flight = {}
+        self._running = {}  # remote -> descàrregues enviades al pool
+        self._pending = {}  # remote -> deque de descàrregues que esperen un lloc
+        self._lock = threading.Lock()
+
+    def submit(self, key: str, remote: str, function, *args):
+        """
+        Start `function(*args)` as the download of `key`, or join the one already in flight.
+
+        :param key: What is downloaded, e.g. the Series Instance UID.
+        :param remote: The remote it is downloaded from, for the per-remote limit.
+        :param function: The download, run in a worker thread.
+        :return: A Future with the result of the download.
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                return future
+            future = Future()
+            self._in_flight[key] = future
+            job = (key, future, function, args)
+            if self._running.get(remote, 0) >= self.max_per_remote:
+                self._pending.setdefault(remote, deque()).append(job)
+                return future
+            self._running[remote] = self._running.get(remote, 0) + 1
+        self._start(remote, job)
+        return future
+
+    def in_flight(self) -> int:
+        """
+        :return: Number of downloads queued or running.
+        """
+        with self._lock:
+            return len(self._in_flight)
+
+    def _start(self, remote, job):
+        self._executor.submit(self._run, *job).add_done_callback(lambda _: self._release(remote))
+
+    def _release(self, remote):
+        """
+        Free the slot of a finished download of `remote`, and give it to the next one waiting.
+        """
+        with self._lock:
+            pending = self._pending.get(remote)
+            if not pending:
+                self._running[remote] -= 1
+                return
+            job = pending.popleft()
+        self._start(remote, job)
+
+    def _run(self, key, future, function, args):
+        if not future.set_running_or_notify_cancel():  # Cancel·lada mentre esperava
+            with self._lock:
+                self._in_flight.pop(key, None)
+            return
+        try:
+            result = function(*args)
+        except BaseException as e:
+            error = e
+        else:
+            error = None
+        # El resultat ja és visible (p. ex. a l'índex) abans que una nova petició no trobi el future
+        with self._lock:
+            self._in_flight.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+
 class OrchestratorPACS:
     """
     Manages DICOM retrieval by first checking the local system, then falling back to RemotePACS.
+
+    The local series are tracked by a SeriesCacheIndex, so a lookup never scans the disk and
+    the least used series are evicted when the cache exceeds its disk quota. Every downloaded
+    series has a manifest (expected instances, size and hash of each file) checked before it
+    is stored and, cheaply, on every lookup; SeriesScrubber re-verifies the hashes.
     """
 
-    def __init__(self, local_directory: str, remote_pacs: RemotePACS):
+    def __init__(self, local_directory: str, remote_pacs: RemotePACS, index: SeriesCacheIndex = None,
+                 quota_bytes: int = None, policy: str = "lru", downloads: DownloadManager = None):
         """
         Initialize the Orchestrator PACS system.
 
         :param local_directory: The base directory where DICOM series are stored locally.
         :param remote_pacs: An instance of RemotePACS for downloading missing series.
+        :param index: The cache index. By default it is stored in `.series_index.db` inside
+                      `local_directory`, with the given quota and policy.
+        :param quota_bytes: Maximum size of the local series, in bytes (None for no limit).
+        :param policy: Eviction policy of the local series, "lru" or "lfu".
+        :param downloads: The DownloadManager, which may be shared by several OrchestratorPACS.
         """
         if not os.path.isdir(local_directory):
             raise ValueError(f"Directory does not exist: {local_directory}")
 
         self.local_directory = local_directory
         self.remote_pacs = remote_pacs
+        if index is None:
+            index = SeriesCacheIndex(os.path.join(local_directory, ".series_index.db"), quota_bytes, policy)
+        self.index = index
+        self.downloads = downloads if downloads is not None else DownloadManager()
+        # Les descàrregues es fan aquí i es mouen a lloc amb un rename atòmic quan acaben
+        self.partial_directory = os.path.join(local_directory, ".partial")
+        shutil.rmtree(self.partial_directory, ignore_errors=True)  # Restes d'una execució anterior
+        os.makedirs(self.partial_directory)
+        # Encerts i errades de la cache local, i sèries precarregades que encara no s'han fet servir
+        self._lock = threading.Lock()
+        self._counters = {
+            "hits": 0, "misses": 0, "prefetched": 0, "prefetch_hits": 0, "prefetch_late": 0, "prefetch_evicted": 0,
+            "invalidated": 0,
+        }
+        self._prefetching = set()
+        self._prefetched = {}
+        if not len(self.index):
+            self._index_existing_series()
+
+    def _index_existing_series(self):
+        """
+        Add to an empty index the valid series already stored in the local directory.
+        """
+        for entry in os.scandir(self.local_directory):
+            if entry.is_dir() and not entry.name.startswith(".") and self._is_series_valid(entry.path):
+                size, count = series_size(entry.path)
+                self.index.add(entry.name, entry.path, size, count, series_fingerprint(entry.path))
 
     def _is_series_valid(self, series_path: str) -> bool:
         """
@@ -74,24 +213,293 @@ class OrchestratorPACS:
 
         return False  # No valid files found
 
-    def get_series(self, series_instance_uid: str) -> str:
+    def get_series(self, series_instance_uid: str, pin: bool = False) -> str:
         """
         Retrieves a DICOM series from the local storage or downloads it from the remote PACS.
 
         :param series_instance_uid: The Series Instance UID of the requested series.
+        :param pin: Protect the series from eviction until `release_series` is called.
         :return: The path to the local folder containing the DICOM series.
         """
-        series_path = os.path.join(self.local_directory, series_instance_uid)
-
-        if self._is_series_valid(series_path):
+        entry = self._lookup(series_instance_uid, pin)
+        if entry is not None:
             print(f"[OrchestratorPACS] Series {series_instance_uid} found locally.")
-            return series_path
+            self._record_lookup(series_instance_uid, hit=True)
+            return entry["path"]
 
         print(f"[OrchestratorPACS] Series {series_instance_uid} not found locally or is incomplete. Fetching from RemotePACS...")
+        self._record_lookup(series_instance_uid, hit=False)
+
+        series_path = self.fetch_series(series_instance_uid).result()
+        if pin and not self.index.pin(series_instance_uid):  # Expulsada just després de descarregar-la
+            return self.get_series(series_instance_uid, pin)
+        return series_path
+
+    def request_series(self, series_instance_uid: str) -> Future:
+        """
+        Non-blocking version of `get_series`: the series is downloaded in the background if it is not local.
+
+        :param series_instance_uid: The Series Instance UID of the requested series.
+        :return: A Future with the path to the local folder of the series, already done if the series is local.
+        """
+        entry = self._lookup(series_instance_uid)
+        if entry is not None:
+            self._record_lookup(series_instance_uid, hit=True)
+            future = Future()
+            future.set_result(entry["path"])
+            return future
+        self._record_lookup(series_instance_uid, hit=False)
+        return self.fetch_series(series_instance_uid)
+
+    def _lookup(self, series_instance_uid: str, pin: bool = False):
+        """
+        Look up a series in the index and check it against its manifest in O(1): the manifest
+        lists every expected instance, and the folder was not changed since it was verified.
+        A series that fails the check is dropped, so it is downloaded again.
+        """
+        entry = self.index.get(series_instance_uid, pin=pin)
+        if entry is None:
+            return None
+        problem = self._quick_check(entry)
+        if problem is None:
+            return entry
+        if pin:
+            self.index.unpin(series_instance_uid)
+        self.invalidate(series_instance_uid, problem)
+        return None
+
+    @staticmethod
+    def _quick_check(entry: dict):
+        manifest = entry.get("manifest")
+        try:
+            mtime_ns = os.stat(entry["path"]).st_mtime_ns
+        except OSError:
+            return "folder not found"
+        if manifest is None:  # Sèrie adoptada sense manifest: el scrubber el crearà
+            return None
+        if manifest["expected_instances"] is not None and len(manifest["files"]) != manifest["expected_instances"]:
+            return f"{len(manifest['files'])} of {manifest['expected_instances']} instances"
+        if manifest.get("mtime_ns") is not None and mtime_ns != manifest["mtime_ns"]:
+            return "folder changed since it was verified"
+        return None
+
+    def invalidate(self, series_instance_uid: str, reason: str):
+        """
+        Drop a local series that does not match its manifest, and delete its files.
+
+        :param series_instance_uid: The Series Instance UID of the series.
+        :param reason: What is wrong with the series.
+        """
+        if self.index.remove(series_instance_uid, delete_files=True) is not None:
+            print(f"[OrchestratorPACS] Series {series_instance_uid} is corrupt ({reason}). It will be downloaded again.")
+            with self._lock:
+                self._counters["invalidated"] += 1
+                self._prefetched.pop(series_instance_uid, None)
+
+    def prefetch_series(self, series_instance_uid: str):
+        """
+        Download a series expected to be requested soon. It counts as prefetched until its first use.
 
-        success = self.remote_pacs.download_series(series_instance_uid, series_path)
+        :param series_instance_uid: The Series Instance UID of the series.
+        :return: A Future with the path to the local folder of the series, or None if it is already local.
+        """
+        if series_instance_uid in self.index:
+            return None
+        with self._lock:
+            self._prefetching.add(series_instance_uid)
+        future = self.fetch_series(series_instance_uid)
+        future.add_done_callback(lambda f: self._record_prefetch(series_instance_uid, f))
+        return future
+
+    def prefetched_bytes(self) -> int:
+        """
+        :return: Size of the prefetched series that have not been used yet, in bytes.
+        """
+        with self._lock:
+            return sum(self._prefetched.values())
+
+    def stats(self) -> dict:
+        """
+        :return: Lookups served from the local cache (hits) or downloaded (misses), the prefetch
+                 counters, and the size of the cache.
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats["prefetch_unused_bytes"] = sum(self._prefetched.values())
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        stats["downloads_in_flight"] = self.downloads.in_flight()
+        index = self.index.stats()
+        stats.update(series=index["series"], size_bytes=index["size_bytes"], evictions=index["evictions"])
+        return stats
+
+    def _record_lookup(self, series_instance_uid: str, hit: bool):
+        with self._lock:
+            if hit:
+                self._counters["hits"] += 1
+                if self._prefetched.pop(series_instance_uid, None) is not None:
+                    self._counters["prefetch_hits"] += 1
+            else:
+                self._counters["misses"] += 1
+                if series_instance_uid in self._prefetching:  # Precàrrega encara en curs
+                    self._prefetching.discard(series_instance_uid)
+                    self._counters["prefetch_late"] += 1
+
+    def _record_prefetch(self, series_instance_uid: str, future: Future):
+        entry = self.index.peek(series_instance_uid) if future.exception() is None else None
+        with self._lock:
+            if series_instance_uid not in self._prefetching:  # Ja s'ha demanat durant la descàrrega
+                return
+            self._prefetching.discard(series_instance_uid)
+            if entry is not None:
+                self._prefetched[series_instance_uid] = entry["size_bytes"]
+                self._counters["prefetched"] += 1
+
+    def fetch_series(self, series_instance_uid: str):
+        """
+        Start downloading a series from the remote PACS, or join its download if it is already in flight.
+
+        :param series_instance_uid: The Series Instance UID of the requested series.
+        :return: A Future with the path to the local folder of the series once it is downloaded and indexed.
+        """
+        return self.downloads.submit(
+            series_instance_uid, self.remote_pacs.remote_url, self._download_series, series_instance_uid,
+        )
+
+    def _download_series(self, series_instance_uid: str) -> str:
+        """
+        Download a series to a temporary folder, move it to its final place with an atomic
+        rename and index it, so a partial download is never visible as a series.
+        """
+        series_path = os.path.join(self.local_directory, series_instance_uid)
+        partial_path = tempfile.mkdtemp(prefix=f"{series_instance_uid}-", dir=self.partial_directory)
+        writer = ManifestWriter()
+        try:
+            if not self.remote_pacs.download_series(series_instance_uid, partial_path, writer):
+                raise RuntimeError(f"Failed to retrieve series {series_instance_uid} from RemotePACS.")
+            manifest = writer.manifest()
+            if not manifest["files"]:  # El remot no ha escrit a través del manifest
+                manifest = build_manifest(partial_path, writer.expected_instances)
+            problems = check_manifest(partial_path, manifest)
+            if problems:
+                raise RuntimeError(f"Series {series_instance_uid} from RemotePACS is incomplete: {'; '.join(problems)}")
+            if os.path.isdir(series_path):  # Una còpia incompleta que no era a l'índex
+                shutil.rmtree(series_path)
+            os.rename(partial_path, series_path)
+        except Exception:
+            shutil.rmtree(partial_path, ignore_errors=True)
+            raise
+
+        manifest["mtime_ns"] = os.stat(series_path).st_mtime_ns
+        size, count = series_size(series_path)
+        evicted = self.index.add(
+            series_instance_uid, series_path, size, count, series_fingerprint(series_path), manifest=manifest,
+        )
+        with self._lock:
+            for entry in evicted:
+                if self._prefetched.pop(entry["series_instance_uid"], None) is not None:
+                    self._counters["prefetch_evicted"] += 1
+        for entry in evicted:
+            print(f"[OrchestratorPACS] Evicted series {entry['series_instance_uid']} ({entry['size_bytes']} bytes).")
+        return series_path
+
+    def release_series(self, series_instance_uid: str):
+        """
+        Release a series pinned by `get_series`, so it can be evicted again.
+
+        :param series_instance_uid: The Series Instance UID of the series.
+        """
+        self.index.unpin(series_instance_uid)
+
+    @contextmanager
+    def use_series(self, series_instance_uid: str):
+        """
+        Retrieve a series and keep it pinned while the block runs:
+
+            with pacs.use_series(uid) as series_path:
+                ...
+
+        :param series_instance_uid: The Series Instance UID of the requested series.
+        """
+        series_path = self.get_series(series_instance_uid, pin=True)
+        try:
+            yield series_path
+        finally:
+            self.release_series(series_instance_uid)
+
+
+class SeriesScrubber:
+    """
+    Re-verifies the files of the local series against their manifests in the background.
+
+    One series is verified at a time, starting with the one verified longest ago, and each
+    series at most once every `interval` seconds. Reading is limited to `rate` bytes per second
+    so the scrubber does not compete with the tasks for the disk. A series whose files no longer
+    match their hashes is dropped and downloaded again on its next request. Series adopted
+    without a manifest get one on their first pass. Pinned series are skipped while in use.
+    """
+
+    def __init__(self, pacs: OrchestratorPACS, interval: float = 24 * 3600, rate: float = None, idle_sleep: float = 60):
+        """
+        :param pacs: The OrchestratorPACS whose series are verified.
+        :param interval: Minimum seconds between two verifications of a series.
+        :param rate: Maximum read rate, in bytes per second (None for no limit).
+        :param idle_sleep: Seconds to wait when every series was verified recently.
+        """
+        self.pacs = pacs
+        self.interval = interval
+        self.rate = rate
+        self.idle_sleep = idle_sleep
+        self.verified = 0
+        self.corrupt = 0
+
+    def start(self):
+        """
+        Verify the series in a background thread.
+        """
+        def run():
+            while True:
+                try:
+                    if self.scrub_one() is None:
+                        time.sleep(self.idle_sleep)
+                except Exception:
+                    logging.exception("Error verifying the local series")
+                    time.sleep(self.idle_sleep)
+
+        threading.Thread(target=run, name="pacs-scrubber", daemon=True).start()
+
+    def scrub_one(self):
+        """
+        Verify the hashes of the series verified longest ago.
+
+        :return: Its Series Instance UID, or None if every series was verified recently.
+        """
+        entry = self.pacs.index.least_recently_verified(before=time.time() - self.interval)
+        if entry is None:
+            return None
+        uid, path = entry["series_instance_uid"], entry["path"]
+        started = time.monotonic()
+        try:
+            if entry["manifest"] is None:
+                manifest = build_manifest(path)
+                manifest["mtime_ns"] = os.stat(path).st_mtime_ns
+                problems = []
+            else:
+                manifest = None
+                problems = check_manifest(path, entry["manifest"], hashes=True)
+        except OSError as e:
+            manifest, problems = None, [str(e)]
 
-        if success:
-            return series_path
+        if uid not in self.pacs.index:  # Expulsada mentre es verificava
+            return uid
+        if problems:
+            if self.pacs.index.is_pinned(uid):  # Una tasca l'ha començat a fer servir: es tornarà a verificar
+                return uid
+            self.corrupt += 1
+            self.pacs.invalidate(uid, "; ".join(problems))
         else:
-            raise RuntimeError(f"Failed to retrieve series {series_instance_uid} from RemotePACS.")
+            self.verified += 1
+            self.pacs.index.set_verified(uid, manifest)
+        if self.rate:
+            time.sleep(max(0.0, entry["size_bytes"] / self.rate - (time.monotonic() - started)))
+        return uid
@@ -0,0 +1,403 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def series_size(series_path: str) -> tuple:
+    """
+    Measure a series folder once, when it enters the cache.
+
+    :param series_path: The folder of the series.
+    :return: The total size in bytes and the number of files.
+    """
+    size, count = 0, 0
+    for entry in os.scandir(series_path):
+        if entry.is_file():
+            size += entry.stat().st_size
+            count += 1
+    return size, count
+
+
+def file_digest(path: str) -> str:
+    """
+    :return: The SHA-256 hex digest of a file, read in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class _HashingFile:
+    def __init__(self, f):
+        self._file = f
+        self.size = 0
+        self.digest = hashlib.sha256()
+
+    def write(self, data: bytes):
+        self._file.write(data)
+        self.size += len(data)
+        self.digest.update(data)
+
+
+class ManifestWriter:
+    """
+    Builds the manifest of a series while it is downloaded: the expected number of instances
+    and the size and SHA-256 of every file, hashed as its bytes are streamed to disk so the
+    files are never read back.
+
+        manifest = ManifestWriter()
+        manifest.expect(instance_count)
+        with manifest.open(os.path.join(folder, name)) as f:
+            f.write(chunk)
+    """
+
+    def __init__(self):
+        self.expected_instances = None
+        self.files = {}
+
+    def expect(self, instance_count: int):
+        """
+        Record the number of instances the remote reported for the series.
+        """
+        self.expected_instances = instance_count
+
+    @contextmanager
+    def open(self, path: str):
+        """
+        Open a file of the series for writing. Its size and hash are recorded when it is closed.
+        """
+        with open(path, "wb") as f:
+            hashing = _HashingFile(f)
+            yield hashing
+        self.files[os.path.basename(path)] = [hashing.size, hashing.digest.hexdigest()]
+
+    def manifest(self) -> dict:
+        return {"expected_instances": self.expected_instances, "files": dict(self.files)}
+
+
+def build_manifest(series_path: str, expected_instances: int = None) -> dict:
+    """
+    Build the manifest of a series already on disk, reading every file.
+
+    :param series_path: The folder of the series.
+    :param expected_instances: Number of instances of the series, if known.
+    """
+    files = {}
+    for entry in os.scandir(series_path):
+        if entry.is_file():
+            files[entry.name] = [entry.stat().st_size, file_digest(entry.path)]
+    return {"expected_instances": expected_instances, "files": files}
+
+
+def check_manifest(series_path: str, manifest: dict, hashes: bool = False) -> list:
+    """
+    Compare a series folder with its manifest.
+
+    :param series_path: The folder of the series.
+    :param manifest: The manifest of the series.
+    :param hashes: Also read the files and compare their hashes, not only their sizes.
+    :return: The problems found, empty if the series matches its manifest.
+    """
+    expected = manifest.get("expected_instances")
+    files = manifest["files"]
+    problems = []
+    if expected is not None and len(files) != expected:
+        problems.append(f"{len(files)} of {expected} instances")
+    try:
+        present = {entry.name: entry for entry in os.scandir(series_path) if entry.is_file()}
+    except OSError as e:
+        return problems + [str(e)]
+    for name in sorted(set(present) - set(files)):
+        problems.append(f"unexpected file {name}")
+    for name, (size, digest) in sorted(files.items()):
+        entry = present.get(name)
+        if entry is None:
+            problems.append(f"missing file {name}")
+        elif entry.stat().st_size != size:
+            problems.append(f"{name} has {entry.stat().st_size} bytes instead of {size}")
+        elif hashes and file_digest(entry.path) != digest:
+            problems.append(f"{name} does not match its hash")
+    return problems
+
+
+class SeriesCacheIndex:
+    """
+    Persistent index of the DICOM series cached on the local disk, with a disk quota.
+
+    Each entry records the series path, byte size, file count, last access, access count,
+    checksum, manifest (see ManifestWriter) and when its files were last verified. The entries
+    are kept in memory, so lookups are O(1) and never scan the disk, and every change is
+    written through to a SQLite database (WAL mode) to survive restarts.
+
+    When the cached series exceed `quota_bytes`, the least recently used ("lru") or least
+    frequently used ("lfu") series are deleted. Pinned series, in use by a task, are never evicted.
+    """
+
+    POLICIES = ("lru", "lfu")
+
+    def __init__(self, path: str, quota_bytes: int = None, policy: str = "lru"):
+        """
+        Open (or create) the index.
+
+        :param path: Path of the SQLite database file.
+        :param quota_bytes: Maximum size of the cached series, in bytes (None for no limit).
+        :param policy: Eviction policy, "lru" or "lfu".
+        """
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown eviction policy: {policy}")
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.quota_bytes = quota_bytes
+        self.policy = policy
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._pins = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS series (
+                series_instance_uid TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                size_bytes INTEGER NOT NULL,
+                file_count INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                access_count INTEGER NOT NULL DEFAULT 0,
+                checksum TEXT,
+                manifest TEXT,
+                verified_at REAL NOT NULL DEFAULT 0
+            );
+            """
+        )
+        # Ordenades de menys a més recent, per trobar la víctima LRU en O(1)
+        self._entries = OrderedDict()
+        rows = self._conn.execute(
+            "SELECT series_instance_uid, path, size_bytes, file_count, last_access, access_count, checksum, "
+            "manifest, verified_at FROM series ORDER BY last_access"
+        )
+        for uid, series_path, size, count, last_access, access_count, checksum, manifest, verified_at in rows:
+            self._entries[uid] = {
+                "series_instance_uid": uid, "path": series_path, "size_bytes": size, "file_count": count,
+                "last_access": last_access, "access_count": access_count, "checksum": checksum,
+                "manifest": json.loads(manifest) if manifest else None, "verified_at": verified_at,
+            }
+        self._total_bytes = sum(entry["size_bytes"] for entry in self._entries.values())
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def __contains__(self, series_instance_uid: str) -> bool:
+        with self._lock:
+            return series_instance_uid in self._entries
+
+    def get(self, series_instance_uid: str, pin: bool = False):
+        """
+        Look up a cached series and record the access.
+
+        :param series_instance_uid: The Series Instance UID.
+        :param pin: Also pin the series, atomically with the lookup. Release it with `unpin`.
+        :return: A copy of the entry, or None if the series is not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(series_instance_uid)
+            if entry is None:
+                return None
+            entry["last_access"] = time.time()
+            entry["access_count"] += 1
+            self._entries.move_to_end(series_instance_uid)
+            self._conn.execute(
+                "UPDATE series SET last_access = ?, access_count = ? WHERE series_instance_uid = ?",
+                (entry["last_access"], entry["access_count"], series_instance_uid),
+            )
+            if pin:
+                self._pins[series_instance_uid] = self._pins.get(series_instance_uid, 0) + 1
+            return dict(entry)
+
+    def peek(self, series_instance_uid: str):
+        """
+        Look up a cached series without recording an access.
+
+        :return: A copy of the entry, or None if the series is not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(series_instance_uid)
+            return dict(entry) if entry is not None else None
+
+    def add(self, series_instance_uid: str, path: str, size_bytes: int, file_count: int,
+            checksum: str = None, pin: bool = False, manifest: dict = None) -> list:
+        """
+        Record a series stored in the cache, then evict other series if the quota is exceeded.
+
+        :param series_instance_uid: The Series Instance UID.
+        :param path: The folder of the series.
+        :param size_bytes: Total size of its files.
+        :param file_count: Number of files.
+        :param checksum: Checksum of the series content.
+        :param pin: Also pin the series.
+        :param manifest: The manifest of the series, verified when it was stored.
+        :return: The entries evicted to make room.
+        """
+        now = time.time()
+        entry = {
+            "series_instance_uid": series_instance_uid, "path": path, "size_bytes": size_bytes,
+            "file_count": file_count, "last_access": now, "access_count": 1, "checksum": checksum,
+            "manifest": manifest, "verified_at": now if manifest is not None else 0,
+        }
+        with self._lock:
+            previous = self._entries.pop(series_instance_uid, None)
+            if previous is not None:
+                self._total_bytes -= previous["size_bytes"]
+            self._entries[series_instance_uid] = entry
+            self._total_bytes += size_bytes
+            self._conn.execute(
+                "INSERT OR REPLACE INTO series (series_instance_uid, path, size_bytes, file_count, last_access, "
+                "access_count, checksum, manifest, verified_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (series_instance_uid, path, size_bytes, file_count, now, 1, checksum,
+                 json.dumps(manifest) if manifest is not None else None, entry["verified_at"]),
+            )
+            if pin:
+                self._pins[series_instance_uid] = self._pins.get(series_instance_uid, 0) + 1
+        return self.evict(keep=(series_instance_uid,))
+
+    def set_verified(self, series_instance_uid: str, manifest: dict = None):
+        """
+        Record that the files of a series were verified now, optionally with a new manifest.
+        """
+        with self._lock:
+            entry = self._entries.get(series_instance_uid)
+            if entry is None:
+                return
+            entry["verified_at"] = time.time()
+            if manifest is not None:
+                entry["manifest"] = manifest
+            self._conn.execute(
+                "UPDATE series SET verified_at = ?, manifest = ? WHERE series_instance_uid = ?",
+                (entry["verified_at"], json.dumps(entry["manifest"]) if entry["manifest"] is not None else None,
+                 series_instance_uid),
+            )
+
+    def least_recently_verified(self, before: float):
+        """
+        :param before: Only consider series last verified before this time.
+        :return: A copy of the unpinned entry verified longest ago, or None.
+        """
+        with self._lock:
+            candidates = [
+                entry for uid, entry in self._entries.items()
+                if uid not in self._pins and entry["verified_at"] < before
+            ]
+            entry = min(candidates, key=lambda e: e["verified_at"], default=None)
+            return dict(entry) if entry is not None else None
+
+    def remove(self, series_instance_uid: str, delete_files: bool = False):
+        """
+        Forget a series, e.g. when its folder turned out to be incomplete.
+
+        :param series_instance_uid: The Series Instance UID.
+        :param delete_files: Also delete the folder of the series.
+        :return: The removed entry, or None if the series was not cached.
+        """
+        with self._lock:
+            entry = self._drop(series_instance_uid)
+        if entry is not None and delete_files:
+            shutil.rmtree(entry["path"], ignore_errors=True)
+        return entry
+
+    def pin(self, series_instance_uid: str) -> bool:
+        """
+        Protect a cached series from eviction while a task uses it. Pins are counted, so every
+        `pin` needs its `unpin`.
+
+        :return: True if the series is cached.
+        """
+        with self._lock:
+            if series_instance_uid not in self._entries:
+                return False
+            self._pins[series_instance_uid] = self._pins.get(series_instance_uid, 0) + 1
+            return True
+
+    def unpin(self, series_instance_uid: str):
+        """
+        Release one pin of a series.
+        """
+        with self._lock:
+            count = self._pins.get(series_instance_uid, 0) - 1
+            if count > 0:
+                self._pins[series_instance_uid] = count
+            else:
+                self._pins.pop(series_instance_uid, None)
+
+    def is_pinned(self, series_instance_uid: str) -> bool:
+        with self._lock:
+            return series_instance_uid in self._pins
+
+    def total_bytes(self) -> int:
+        """
+        :return: Total size of the cached series, in bytes.
+        """
+        with self._lock:
+            return self._total_bytes
+
+    def evict(self, keep=()) -> list:
+        """
+        Delete unpinned series, by the eviction policy, until the cache fits in its quota.
+
+        :param keep: Series that must not be evicted, e.g. the one just added.
+        :return: The evicted entries.
+        """
+        evicted = []
+        with self._lock:
+            while self.quota_bytes is not None and self._total_bytes > self.quota_bytes:
+                victim = self._victim(keep)
+                if victim is None:  # Tot el que queda està en ús
+                    break
+                evicted.append(self._drop(victim))
+                self.evictions += 1
+        for entry in evicted:
+            shutil.rmtree(entry["path"], ignore_errors=True)
+        return evicted
+
+    def stats(self) -> dict:
+        """
+        :return: Number of series, their total size, the quota, pinned series and evictions.
+        """
+        with self._lock:
+            return {
+                "series": len(self._entries),
+                "size_bytes": self._total_bytes,
+                "quota_bytes": self.quota_bytes,
+                "pinned": len(self._pins),
+                "evictions": self.evictions,
+                "policy": self.policy,
+            }
+
+    def _victim(self, keep):
+        candidates = (uid for uid in self._entries if uid not in self._pins and uid not in keep)
+        if self.policy == "lru":
+            return next(candidates, None)  # L'OrderedDict ja està ordenat per últim accés
+        return min(
+            candidates,
+            key=lambda uid: (self._entries[uid]["access_count"], self._entries[uid]["last_access"]),
+            default=None,
+        )
+
+    def _drop(self, series_instance_uid: str):
+        entry = self._entries.pop(series_instance_uid, None)
+        if entry is not None:
+            self._total_bytes -= entry["size_bytes"]
+            self._conn.execute("DELETE FROM series WHERE series_instance_uid = ?", (series_instance_uid,))
+        return entry
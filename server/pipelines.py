@@ -0,0 +1,89 @@
+from task_store import FINISHED_STATUSES
+
+# Stage states that no longer change ("skipped": a stage it depends on failed)
+STAGE_DONE_STATUSES = FINISHED_STATUSES + ("skipped",)
+
+
+class Pipeline:
+    """
+    A DAG of microservice stages run as one pipeline task.
+
+    Each stage names its microservice and the stages it runs `after`. A stage is dispatched as
+    soon as all of them have completed, so independent branches run in parallel, and it receives
+    their results in the `upstream` field of its input. If a stage fails or is cancelled, the
+    stages that depend on it are skipped.
+    """
+
+    def __init__(self, stages: dict, microservices: dict):
+        """
+        Initialize and validate the pipeline.
+
+        :param stages: Maps each stage name to {"microservice": ..., "after": [stage, ...]}.
+        :param microservices: The microservices configuration, to check the stage services exist.
+        """
+        self.stages = {
+            name: {"microservice": stage["microservice"], "after": list(stage.get("after", []))}
+            for name, stage in stages.items()
+        }
+        if not self.stages:
+            raise ValueError("A pipeline needs at least one stage")
+        for name, stage in self.stages.items():
+            if stage["microservice"] not in microservices:
+                raise ValueError(f"Stage {name} uses unknown microservice {stage['microservice']}")
+            for dependency in stage["after"]:
+                if dependency not in self.stages:
+                    raise ValueError(f"Stage {name} runs after unknown stage {dependency}")
+        self.order = self._topological_order()
+
+    def _topological_order(self) -> list:
+        order = []
+        remaining = {name: set(stage["after"]) for name, stage in self.stages.items()}
+        while remaining:
+            ready = sorted(name for name, after in remaining.items() if not after)
+            if not ready:
+                raise ValueError(f"Pipeline stages have a cycle: {sorted(remaining)}")
+            for name in ready:
+                del remaining[name]
+                order.append(name)
+            for after in remaining.values():
+                after.difference_update(ready)
+        return order
+
+    def ready_stages(self, states: dict) -> list:
+        """
+        :param states: Maps each stage name to its status ("pending" if not dispatched yet).
+        :return: The pending stages whose dependencies have all completed.
+        """
+        return [
+            name for name in self.order
+            if states[name] == "pending" and all(states[d] == "completed" for d in self.stages[name]["after"])
+        ]
+
+    def blocked_stages(self, states: dict) -> list:
+        """
+        :param states: Maps each stage name to its status ("pending" if not dispatched yet).
+        :return: The pending stages that can no longer run because a dependency failed, was
+                 cancelled or was skipped.
+        """
+        states = dict(states)
+        blocked = []
+        for name in self.order:  # Els dependents d'una etapa saltada també se salten
+            if states[name] == "pending" and any(states[d] in ("failed", "cancelled", "skipped") for d in self.stages[name]["after"]):
+                states[name] = "skipped"
+                blocked.append(name)
+        return blocked
+
+    def stage_input(self, name: str, data: dict, results: dict) -> dict:
+        """
+        :param name: The stage.
+        :param data: The input of the pipeline.
+        :param results: Maps the completed stages to their results.
+        :return: The input of the stage: the pipeline input plus the results of its dependencies.
+        """
+        stage_data = dict(data)
+        if self.stages[name]["after"]:
+            stage_data["upstream"] = {d: results[d] for d in self.stages[name]["after"]}
+        return stage_data
+
+    def describe(self) -> dict:
+        return {name: dict(self.stages[name]) for name in self.order}
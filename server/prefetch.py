@@ -0,0 +1,140 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+import requests
+
+
+def read_worklist(source: str) -> list:
+    """
+    Read the Series Instance UIDs of a worklist.
+
+    :param source: An http(s) URL answering a JSON list (or {"series": [...]}), a JSON file with
+                   the same content, or a text file with one UID per line ("#" starts a comment).
+    :return: The UIDs, in worklist order.
+    """
+    if source.startswith(("http://", "https://")):
+        response = requests.get(source, timeout=10)
+        response.raise_for_status()
+        content = response.json()
+    else:
+        with open(source) as f:
+            text = f.read()
+        if source.endswith(".json"):
+            content = json.loads(text)
+        else:
+            content = [line.split("#", 1)[0].strip() for line in text.splitlines()]
+    if isinstance(content, dict):
+        content = content.get("series", [])
+    return [str(uid).strip() for uid in content if str(uid).strip()]
+
+
+class Prefetcher:
+    """
+    Warms the local PACS cache with the series of upcoming studies, before their tasks arrive.
+
+    The series of the worklists are downloaded in order by a background thread, one at a time
+    through the DownloadManager of the OrchestratorPACS, so a task that needs a series being
+    prefetched joins its download. Two budgets keep prefetching from competing with the tasks:
+
+    - `bandwidth`: the average download rate, in bytes per second, stays below it.
+    - `disk_budget`: no new download starts while the prefetched series not used yet take this
+      many bytes. Keep it below the cache quota, or prefetching evicts series it prefetched before
+      their tasks arrive. The series of queued and running tasks are pinned and never evicted.
+    """
+
+    def __init__(self, pacs, bandwidth: float = None, disk_budget: int = None, budget_check_interval: float = 5):
+        """
+        Initialize the prefetcher and start its thread.
+
+        :param pacs: The OrchestratorPACS whose cache is warmed.
+        :param bandwidth: Maximum average download rate, in bytes per second (None for no limit).
+        :param disk_budget: Maximum size of the prefetched series not used yet, in bytes (None for no limit).
+        :param budget_check_interval: Seconds between two checks of the disk budget while it is exhausted.
+        """
+        self.pacs = pacs
+        self.bandwidth = bandwidth
+        self.disk_budget = disk_budget
+        self.budget_check_interval = budget_check_interval
+        self._worklist = deque()
+        self._queued = set()
+        self._changed = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="pacs-prefetch", daemon=True)
+        self._thread.start()
+
+    def add(self, series_instance_uids) -> int:
+        """
+        Append series to the worklist. Series already local or already in the worklist are skipped.
+
+        :param series_instance_uids: The Series Instance UIDs, in the order they will be needed.
+        :return: Number of series added.
+        """
+        added = 0
+        with self._changed:
+            for uid in series_instance_uids:
+                if uid in self._queued or uid in self.pacs.index:
+                    continue
+                self._worklist.append(uid)
+                self._queued.add(uid)
+                added += 1
+            self._changed.notify()
+        return added
+
+    def load(self, source: str) -> int:
+        """
+        Append the series of a worklist file or URL (see `read_worklist`).
+
+        :return: Number of series added.
+        """
+        return self.add(read_worklist(source))
+
+    def watch(self, source: str, interval: float):
+        """
+        Reload a worklist file or URL every `interval` seconds in a background thread.
+        """
+        def run():
+            while True:
+                try:
+                    added = self.load(source)
+                    if added:
+                        logging.info(f"Prefetching {added} series from worklist {source}")
+                except Exception as e:
+                    logging.warning(f"Error reading worklist {source}: {e}")
+                time.sleep(interval)
+
+        threading.Thread(target=run, name="worklist-watch", daemon=True).start()
+
+    def pending(self) -> int:
+        """
+        :return: Number of series waiting to be prefetched.
+        """
+        with self._changed:
+            return len(self._worklist)
+
+    def _over_budget(self) -> bool:
+        return self.disk_budget is not None and self.pacs.prefetched_bytes() >= self.disk_budget
+
+    def _run(self):
+        while True:
+            with self._changed:
+                # Amb el pressupost de disc exhaurit, espera que es facin servir sèries precarregades
+                while not self._worklist or self._over_budget():
+                    self._changed.wait(self.budget_check_interval if self._worklist else None)
+                uid = self._worklist.popleft()
+                self._queued.discard(uid)
+
+            started = time.monotonic()
+            future = self.pacs.prefetch_series(uid)
+            if future is None:  # Ja s'ha descarregat mentre esperava
+                continue
+            try:
+                future.result()
+            except Exception as e:
+                logging.warning(f"Error prefetching series {uid}: {e}")
+                continue
+            entry = self.pacs.index.peek(uid)
+            if self.bandwidth and entry is not None:
+                # Espera prou perquè la mitjana no superi l'amplada de banda
+                time.sleep(max(0.0, entry["size_bytes"] / self.bandwidth - (time.monotonic() - started)))
@@ -0,0 +1,197 @@
+import logging
+import threading
+import time
+
+import requests
+
+
+class Replica:
+    """
+    One instance of a microservice, with its number of outstanding requests and health.
+    """
+
+    def __init__(self, address: str):
+        self.address = address
+        self.outstanding = 0
+        self.healthy = True  # Fins que una sonda digui el contrari
+        self.checked_at = None
+        self.error = None
+        self.model_version = None  # El que informa /health, p. ex. el checkpoint carregat
+
+    def describe(self) -> dict:
+        return {
+            "address": self.address,
+            "outstanding": self.outstanding,
+            "healthy": self.healthy,
+            "checked_at": self.checked_at,
+            "error": self.error,
+            "model_version": self.model_version,
+        }
+
+
+class ServiceRegistry:
+    """
+    Registry of the replicas of every microservice, with health-aware load balancing.
+
+    Each task is sent to the healthy replica with the fewest outstanding requests. A background
+    thread probes `GET /health` on every replica and takes the ones that fail out of rotation
+    until they answer again; a connection error while dispatching does the same immediately.
+    If every replica of a service is unhealthy they are all tried anyway, so tasks fail with
+    the actual connection error instead of waiting. A replica whose /health answer includes a
+    `model_version` (e.g. the checkpoint it loaded) has it recorded, for the result cache keys.
+    """
+
+    def __init__(self, microservices: dict, probe_timeout: float = 2):
+        """
+        Initialize the registry.
+
+        :param microservices: The microservices configuration. Each entry lists its `replicas`
+                              ("host:port" addresses), or a single `address`.
+        :param probe_timeout: Timeout of each /health probe, in seconds.
+        """
+        self.probe_timeout = probe_timeout
+        self._replicas = {
+            name: [Replica(address) for address in config.get("replicas") or [config["address"]]]
+            for name, config in microservices.items()
+        }
+        self._lock = threading.Lock()
+
+    def __contains__(self, microservice: str) -> bool:
+        return microservice in self._replicas
+
+    def set_replicas(self, microservice: str, addresses: list):
+        """
+        Replace the replicas of a microservice. The new ones start healthy and idle.
+
+        :param microservice: Name of the microservice.
+        :param addresses: The "host:port" addresses of its replicas.
+        """
+        with self._lock:
+            self._replicas[microservice] = [Replica(address) for address in addresses]
+
+    def replica_count(self, microservice: str) -> int:
+        """
+        :return: Number of replicas of the microservice, healthy or not.
+        """
+        return len(self._replicas[microservice])
+
+    def acquire(self, microservice: str) -> str:
+        """
+        Choose the replica for a new request and count it as outstanding until `release`.
+
+        :param microservice: Name of the microservice.
+        :return: The "host:port" address of the healthy replica with the fewest outstanding requests.
+        """
+        with self._lock:
+            replicas = self._replicas[microservice]
+            candidates = [r for r in replicas if r.healthy] or replicas
+            replica = min(candidates, key=lambda r: r.outstanding)
+            replica.outstanding += 1
+            return replica.address
+
+    def release(self, microservice: str, address: str):
+        """
+        Count a request to a replica as finished.
+
+        :param microservice: Name of the microservice.
+        :param address: Address returned by `acquire`.
+        """
+        with self._lock:
+            replica = self._find(microservice, address)
+            if replica is not None and replica.outstanding > 0:
+                replica.outstanding -= 1
+
+    def adopt(self, microservice: str, address: str):
+        """
+        Count as outstanding an asynchronous job started on a replica before a restart.
+        """
+        with self._lock:
+            replica = self._find(microservice, address)
+            if replica is not None:
+                replica.outstanding += 1
+
+    def mark_down(self, microservice: str, address: str, error: str):
+        """
+        Take a replica out of rotation until its next successful probe.
+
+        :param microservice: Name of the microservice.
+        :param address: Address of the replica.
+        :param error: Why the replica is considered unhealthy.
+        """
+        with self._lock:
+            replica = self._find(microservice, address)
+            if replica is not None and replica.healthy:
+                logging.warning(f"Replica {address} of {microservice} is out of rotation: {error}")
+                replica.healthy = False
+                replica.error = error
+
+    def probe(self):
+        """
+        Probe `GET /health` on every replica and update its health.
+        """
+        with self._lock:
+            targets = [(name, r.address) for name, replicas in self._replicas.items() for r in replicas]
+        for microservice, address in targets:
+            model_version = None
+            try:
+                response = requests.get(f"http://{address}/health", timeout=self.probe_timeout)
+                error = None if response.status_code == 200 else f"HTTP {response.status_code}"
+                if error is None:
+                    try:
+                        body = response.json()
+                        model_version = body.get("model_version") if isinstance(body, dict) else None
+                    except ValueError:
+                        pass
+            except requests.RequestException as e:
+                error = str(e)
+            with self._lock:
+                replica = self._find(microservice, address)
+                if replica is None:
+                    continue
+                if error is None and not replica.healthy:
+                    logging.info(f"Replica {address} of {microservice} is back in rotation")
+                elif error is not None and replica.healthy:
+                    logging.warning(f"Replica {address} of {microservice} is out of rotation: {error}")
+                replica.healthy = error is None
+                replica.error = error
+                replica.checked_at = time.time()
+                if error is None:
+                    replica.model_version = model_version
+
+    def start_probes(self, interval: float):
+        """
+        Probe the replicas every `interval` seconds in a background thread.
+        """
+        def run():
+            while True:
+                try:
+                    self.probe()
+                except Exception:
+                    logging.exception("Error probing the microservice replicas")
+                time.sleep(interval)
+
+        threading.Thread(target=run, name="health-probes", daemon=True).start()
+
+    def model_versions(self, microservice: str) -> set:
+        """
+        :return: The model versions reported by the healthy replicas of a microservice (empty if
+                 none reports one). More than one means a model is being replaced.
+        """
+        with self._lock:
+            return {
+                r.model_version for r in self._replicas.get(microservice, [])
+                if r.healthy and r.model_version is not None
+            }
+
+    def describe(self) -> dict:
+        """
+        :return: The replicas of every microservice with their outstanding requests and health.
+        """
+        with self._lock:
+            return {name: [r.describe() for r in replicas] for name, replicas in self._replicas.items()}
+
+    def _find(self, microservice: str, address: str):
+        for replica in self._replicas.get(microservice, ()):
+            if replica.address == address:
+                return replica
+        return None
@@ -0,0 +1,183 @@
+import heapq
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+
+class RetryPolicy:
+    """
+    How many times a task is retried after a transient failure, and how long it waits before
+    each attempt: exponential backoff with jitter, so the retries of many tasks that failed
+    together do not hit the service at the same moment.
+    """
+
+    def __init__(self, retries: int = 3, backoff: float = 1.0, max_backoff: float = 60.0):
+        """
+        :param retries: Maximum number of retries of a task (0 disables them).
+        :param backoff: Base delay of the first retry, in seconds. It doubles with every retry.
+        :param max_backoff: Maximum delay between two attempts, in seconds.
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    @staticmethod
+    def retry_after(value) -> float:
+        """
+        :param value: Retry-After header of a response: seconds, or an HTTP date.
+        :return: Seconds to wait before retrying, or None if the header is missing or invalid.
+        """
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def delay(self, attempt: int) -> float:
+        """
+        :param attempt: Number of the retry, starting at 1.
+        :return: Seconds to wait before it: half of the exponential delay plus a random part of the other half.
+        """
+        ceiling = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+
+class CircuitBreaker:
+    """
+    Fails fast while a microservice is down.
+
+    After `failure_threshold` consecutive transient failures the circuit opens and no request
+    is sent for `reset_timeout` seconds. Then one trial request is let through (half open):
+    if it succeeds the circuit closes, otherwise it opens again. A trial with no outcome after
+    another `reset_timeout` seconds lets a new one through.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30, clock=time.monotonic):
+        """
+        :param failure_threshold: Consecutive failures that open the circuit.
+        :param reset_timeout: Seconds the circuit stays open before a trial request.
+        :param clock: Time source, replaceable for simulations.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._trial_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def allow(self) -> bool:
+        """
+        :return: True if a request may be sent now. In half open state only one trial request is allowed.
+        """
+        with self._lock:
+            if self._state == self.OPEN and self.clock() - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+                self._trial_running = False
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN and (
+                not self._trial_running or self.clock() - self._trial_at >= self.reset_timeout
+            ):
+                self._trial_running = True
+                self._trial_at = self.clock()
+                return True
+            return False
+
+    def retry_after(self) -> float:
+        """
+        :return: Seconds until the circuit lets a trial request through.
+        """
+        with self._lock:
+            if self._state == self.HALF_OPEN and self._trial_running:
+                return max(0.0, self.reset_timeout - (self.clock() - self._trial_at))
+            if self._state == self.OPEN:
+                return max(0.0, self.reset_timeout - (self.clock() - self._opened_at))
+            return 0.0
+
+    def record_success(self):
+        """
+        Record a request answered by the microservice, which closes the circuit.
+        """
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_running = False
+
+    def record_busy(self):
+        """
+        Record a request the microservice refused because it is saturated (503 with Retry-After).
+        It is up, so this is not a failure; a half open circuit lets the next trial through.
+        """
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self):
+        """
+        Record a transient failure (connection error, timeout or unavailable service).
+        """
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = self.clock()
+                self._trial_running = False
+
+
+class DelayedCalls:
+    """
+    Runs callables after a delay from a single background thread, e.g. to re-queue a task
+    once its backoff has elapsed without holding a dispatch worker meanwhile.
+    """
+
+    def __init__(self):
+        self._calls = []
+        self._counter = 0
+        self._changed = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="delayed-calls", daemon=True)
+        self._thread.start()
+
+    def call_later(self, delay: float, function, *args):
+        """
+        Run `function(*args)` in `delay` seconds.
+        """
+        with self._changed:
+            self._counter += 1  # Desempata les crides amb el mateix instant
+            heapq.heappush(self._calls, (time.monotonic() + delay, self._counter, function, args))
+            self._changed.notify()
+
+    def pending(self) -> int:
+        """
+        :return: Number of calls waiting for their time.
+        """
+        with self._changed:
+            return len(self._calls)
+
+    def _run(self):
+        while True:
+            with self._changed:
+                while not self._calls or self._calls[0][0] > time.monotonic():
+                    self._changed.wait(self._calls[0][0] - time.monotonic() if self._calls else None)
+                _, _, function, args = heapq.heappop(self._calls)
+            try:
+                function(*args)
+            except Exception:
+                logging.exception(f"Error running delayed call {function}")
@@ -0,0 +1,131 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def series_fingerprint(series_path: str):
+    """
+    Fingerprint the content of a DICOM series folder from the name, size and modification time
+    of its files, without reading them.
+
+    :param series_path: The folder of the series.
+    :return: A hex digest, or None if the folder does not exist or is empty.
+    """
+    if not os.path.isdir(series_path):
+        return None
+    digest = hashlib.sha256()
+    count = 0
+    for entry in sorted(os.scandir(series_path), key=lambda e: e.name):
+        if not entry.is_file():
+            continue
+        stat = entry.stat()
+        digest.update(f"{entry.name}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+        count += 1
+    return digest.hexdigest() if count else None
+
+
+def cache_key(microservice: str, model_version: str, fingerprint: str) -> str:
+    """
+    :return: The key of a result: the service, its model version and the input series content.
+    """
+    return hashlib.sha256(f"{microservice}\0{model_version}\0{fingerprint}".encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    Content-addressed cache of task results with LRU and TTL eviction.
+
+    It also tracks the tasks in flight for each key, so identical requests submitted while the
+    first one is still running wait for it instead of running the pipeline again.
+    """
+
+    HIT = "hit"
+    COALESCED = "coalesced"
+    MISS = "miss"
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 7 * 24 * 3600):
+        """
+        :param max_entries: Maximum number of cached results, the least recently used are evicted.
+        :param ttl: Time to live of a cached result, in seconds.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._followers = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def claim(self, key: str, task_id: int):
+        """
+        Look up a key for a new task.
+
+        :param key: The cache key of the task.
+        :param task_id: The new task.
+        :return: (HIT, cached entry), (COALESCED, task_id of the task in flight) or (MISS, None),
+                 in which case the new task becomes the one in flight for the key.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry["stored_at"] > self.ttl:
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self.HIT, dict(entry)
+
+            leader = self._in_flight.get(key)
+            if leader is not None:
+                self._followers[key].append(task_id)
+                self.coalesced += 1
+                return self.COALESCED, leader
+
+            self._in_flight[key] = task_id
+            self._followers[key] = []
+            self.misses += 1
+            return self.MISS, None
+
+    def complete(self, key: str, task_id: int, result=None, success: bool = True) -> list:
+        """
+        Record the end of a task. Successful results are cached.
+
+        :param key: The cache key of the task.
+        :param task_id: The finished task.
+        :param result: The result of the task.
+        :param success: False if the task failed, its result is then not cached.
+        :return: The task_ids coalesced onto this task, which share its outcome.
+        """
+        with self._lock:
+            if success:
+                self._entries[key] = {"result": result, "task_id": task_id, "stored_at": time.time()}
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+            if self._in_flight.get(key) != task_id:
+                return []
+            del self._in_flight[key]
+            return self._followers.pop(key, [])
+
+    def stats(self) -> dict:
+        """
+        :return: The hit, miss and coalescing counters, the hit rate and the number of entries.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "entries": len(self._entries),
+                "in_flight": len(self._in_flight),
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "hit_rate": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+            }
@@ -0,0 +1,136 @@
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Priority classes, from most to least urgent
+PRIORITIES = {"stat": 0, "routine": 1, "batch": 2}
+DEFAULT_PRIORITY = "routine"
+DEFAULT_TENANT = "default"
+
+
+class FairPriorityQueue:
+    """
+    Task queue with priority classes, aging and per-tenant fair share.
+
+    - `stat` tasks are always served first.
+    - The other classes age: every `aging` seconds of waiting lowers the level of a task by one,
+      so a `batch` task that waited long enough is served before fresh `routine` ones.
+    - Inside a class, tenants are served round-robin, so one tenant's bulk submission does not
+      delay the tasks of the others.
+
+    It has the same blocking get / task_done / join interface as queue.Queue.
+    """
+
+    def __init__(self, aging: float = 600, clock=time.monotonic):
+        """
+        :param aging: Seconds of waiting that promote a task by one priority level.
+        :param clock: Time source, replaceable for simulations.
+        """
+        self.aging = aging
+        self.clock = clock
+        # priority class -> tenant -> deque of (enqueued_at, item), tenants in round-robin order
+        self._classes = {level: OrderedDict() for level in PRIORITIES.values()}
+        self._size = 0
+        self._stops = 0
+        self._unfinished = 0
+        self._not_empty = threading.Condition()
+        self._all_done = threading.Condition(self._not_empty)
+
+    def put(self, item, priority: str = DEFAULT_PRIORITY, tenant: str = DEFAULT_TENANT):
+        """
+        Enqueue an item. Putting None asks one consumer to stop once the queue is empty.
+
+        :param item: The item, usually a task_id.
+        :param priority: One of PRIORITIES.
+        :param tenant: The tenant that submitted the task.
+        """
+        with self._not_empty:
+            self._unfinished += 1
+            if item is None:
+                self._stops += 1
+            else:
+                tenants = self._classes[PRIORITIES[priority]]
+                tenants.setdefault(tenant, deque()).append((self.clock(), item))
+                self._size += 1
+            self._not_empty.notify()
+
+    def get(self, block: bool = True, timeout: float = None):
+        """
+        Remove and return the next item to process.
+
+        :raise queue.Empty: If `block` is False (or `timeout` expires) and the queue is empty.
+        """
+        with self._not_empty:
+            if not self._not_empty.wait_for(lambda: self._size or self._stops, timeout if block else 0):
+                raise queue.Empty
+            if not self._size:
+                self._stops -= 1
+                return None
+            return self._pop()
+
+    def _pop(self):
+        now = self.clock()
+        best_level, best_key = None, None
+        for level, tenants in self._classes.items():
+            if not tenants:
+                continue
+            oldest = min(items[0][0] for items in tenants.values())
+            effective = level if level == 0 else max(0.0, level - (now - oldest) / self.aging)
+            key = (effective, level, oldest)
+            if best_key is None or key < best_key:
+                best_level, best_key = level, key
+
+        tenants = self._classes[best_level]
+        tenant, items = next(iter(tenants.items()))
+        _, item = items.popleft()
+        del tenants[tenant]
+        if items:
+            tenants[tenant] = items  # Back to the end of the round-robin
+        self._size -= 1
+        return item
+
+    def remove(self, item) -> bool:
+        """
+        Remove a waiting item, e.g. a cancelled task, as if it had been processed.
+
+        :return: True if the item was waiting in the queue.
+        """
+        with self._not_empty:
+            for tenants in self._classes.values():
+                for tenant, items in tenants.items():
+                    for entry in items:
+                        if entry[1] == item:
+                            items.remove(entry)
+                            if not items:
+                                del tenants[tenant]
+                            self._size -= 1
+                            self._unfinished -= 1
+                            if self._unfinished <= 0:
+                                self._all_done.notify_all()
+                            return True
+        return False
+
+    def task_done(self):
+        with self._all_done:
+            self._unfinished -= 1
+            if self._unfinished <= 0:
+                self._all_done.notify_all()
+
+    def join(self):
+        with self._all_done:
+            self._all_done.wait_for(lambda: self._unfinished <= 0)
+
+    def qsize(self) -> int:
+        with self._not_empty:
+            return self._size
+
+    def depth_by_priority(self) -> dict:
+        """
+        :return: Number of queued items per priority class name.
+        """
+        with self._not_empty:
+            return {
+                name: sum(len(items) for items in self._classes[level].values())
+                for name, level in PRIORITIES.items()
+            }
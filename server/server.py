@@ -1,170 +1,1107 @@
-from flask import Flask, request, jsonify, render_template_string
-import requests
-import threading
+from flask import Flask, Response, request, jsonify, render_template_string
+import asyncio
+import json
 import queue
+import random
+import secrets
+import threading
 import time
 import logging
 import os
+from dispatcher import Dispatcher, DETACHED
+from async_dispatcher import AsyncDispatcher
+from clients import ServiceClients, AsyncServiceClients, connection_failed, transient_error
+from registry import ServiceRegistry
+from resilience import RetryPolicy, CircuitBreaker, DelayedCalls
+from task_store import create_task_store, FINISHED_STATUSES
+from task_ids import SnowflakeIdGenerator, default_worker_id
+from events import TaskEvents, EVENT_FIELDS
+from result_cache import ResultCache, series_fingerprint, cache_key
+from scheduler import PRIORITIES, DEFAULT_PRIORITY, DEFAULT_TENANT
+from pipelines import Pipeline, STAGE_DONE_STATUSES
+from pacs import OrchestratorPACS, RemotePACS, SeriesScrubber
+from prefetch import Prefetcher
+import metrics
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 
 app = Flask(__name__)
 
 logging.basicConfig(level=logging.INFO)
 
-# Inicialitza la cua de tasques i el diccionari de tasques
-task_queue = queue.Queue()
-tasks = {}
+# Magatzem de tasques: "memory" o "sqlite" (persistent, en mode WAL)
+# TASK_TTL: segons que es conserven les tasques acabades abans d'esborrar-les
+store = create_task_store(os.getenv("TASK_STORE", "memory"), os.getenv("TASK_STORE_PATH", "/data/tasks.db"))
+store.start_eviction(ttl=float(os.getenv("TASK_TTL", 7 * 24 * 3600)))
+
+# Notifica els canvis d'estat de les tasques (event stream i long-poll)
+events = TaskEvents()
+
+# Identificadors únics de tasca, també entre diversos processos (ORCHESTRATOR_WORKER_ID, obligatori
+# amb un magatzem compartit com el SQLite)
+task_ids = SnowflakeIdGenerator(default_worker_id(shared_store=os.getenv("TASK_STORE", "memory") != "memory"))
+
+# Directori on es guarden els DICOMs dins del contenidor
+DICOM_DIR = os.getenv("DICOM_DIR", "/dicom")
+
+# URL amb què els microserveis criden l'orquestrador per notificar les tasques asíncrones
+ORCHESTRATOR_URL = os.getenv("ORCHESTRATOR_URL", "http://server:5000")
+# Cada quants segons es consulta /jobs/<job_id> de les tasques asíncrones sense notificar
+ASYNC_POLL_INTERVAL = float(os.getenv("ASYNC_POLL_INTERVAL", 30))
 
 # Configuración de los microservicios
+# replicas: adreces de les rèpliques del microservei (per defecte només `address`), es poden
+# indicar separades per comes a la variable d'entorn <SERVICE>_REPLICAS
+# max_in_flight: nombre màxim de tasques simultànies enviades a cada rèplica
+# (es pot sobreescriure amb la variable d'entorn <SERVICE>_MAX_IN_FLIGHT)
+# pool_size: connexions keep-alive reutilitzades per rèplica (per defecte max_in_flight)
+# connect_timeout / read_timeout: temps màxims en segons de cada petició
+# expected_duration: durada habitual d'una tasca; sense read_timeout, la petició es talla a
+#        READ_TIMEOUT_FACTOR (3) vegades aquesta durada
+# retries / backoff / max_backoff: reintents de les fallades transitòries (connexió, timeout, 502/503/504),
+#        amb una espera exponencial i aleatòria a partir de backoff segons. Un 503 amb Retry-After
+#        (microservei saturat) es reintenta després d'aquest temps, sense gastar reintents
+# breaker_threshold / breaker_reset: fallades seguides que obren el circuit del microservei i segons
+#        que resta obert (mentre està obert les tasques esperen a la cua sense enviar-se)
+# cache / model_version: reutilitza el resultat d'una mateixa sèrie (canviar model_version invalida la cache).
+#        La clau inclou també el model_version que les rèpliques informen a /health (el checkpoint
+#        carregat), de manera que recarregar el model invalida els resultats del model anterior
+# async: el microservei respon 202 amb un job_id i notifica el final a /callback/<task_id>;
+#        workers és llavors el nombre de threads que envien tasques (max_in_flight segueix limitant les tasques en curs)
 microservices = {
-    "dummy": "dummy_service:5001",
-    "process_dicom": "process_dicom:5002",
-    "vascular_segmentation": "vascular_segmentation:5003",
+    "dummy": {
+        "address": "dummy_service:5001", "max_in_flight": 8, "connect_timeout": 5, "expected_duration": 10,
+        "async": True, "workers": 1,
+    },
+    "process_dicom": {
+        "address": "process_dicom:5002", "max_in_flight": 4, "connect_timeout": 5, "expected_duration": 60,
+        "cache": True, "model_version": "1",
+    },
+    "vascular_segmentation": {
+        "address": "vascular_segmentation:5003", "max_in_flight": 2, "connect_timeout": 5, "expected_duration": 900,
+        "retries": 2, "backoff": 10,
+        "async": True, "cache": True, "model_version": "nnUNetTrainer_CE_DC_CLDC__nnUNetResEncUNetMPlans__3d_lowres",
+    },
 }
+for name, config in microservices.items():
+    config["max_in_flight"] = int(os.getenv(f"{name.upper()}_MAX_IN_FLIGHT", config["max_in_flight"]))
+    replicas = os.getenv(f"{name.upper()}_REPLICAS")
+    config["replicas"] = [r.strip() for r in replicas.split(",") if r.strip()] if replicas else [config["address"]]
 
+# Rèpliques de cada microservei: cada tasca va a la rèplica sana amb menys peticions pendents.
+# Es comprova GET /health de totes les rèpliques cada HEALTH_PROBE_INTERVAL segons
+registry = ServiceRegistry(microservices)
+registry.start_probes(float(os.getenv("HEALTH_PROBE_INTERVAL", 10)))
 
-# Worker thread per processar les tasques
-def worker():
-    while True:
-        task_id = task_queue.get()
-        if task_id is None:  # Permet tancar el worker
-            break
-        task = tasks[task_id]
-        task["status"] = "running"
-        task["started_at"] = time.time()
-
-        # Obté la configuració del microservei
-        logging.info(task)
-        microservice = task["microservice"]
-        address = task["address"]
-        data = task["data"]
-        logging.info(f"Inentant processar task {task_id} with microservice {microservice} at {address}")
-        try:
-            # Envia la petició al microservei
-            logging.info(f"Processing task {task_id} with microservice {microservice} at {address}")
-            response = requests.post(f"http://{address}/run", json=data, timeout=3600)
-            print(response)
-            # Gestiona la resposta
-            if response.status_code == 200:
-                result = response.json()
-                logging.info(result)
-                task["status"] = "completed"
-                task["result"] = result.get("result", "ok")  # 🔹 Només guarda el valor numèric o "ok" 
+# Política de reintents i circuit breaker de cada microservei
+retry_policies = {
+    name: RetryPolicy(config.get("retries", 3), config.get("backoff", 1.0), config.get("max_backoff", 60.0))
+    for name, config in microservices.items()
+}
+breakers = {
+    name: CircuitBreaker(config.get("breaker_threshold", 5), config.get("breaker_reset", 30))
+    for name, config in microservices.items()
+}
+# Torna a encuar les tasques quan acaba la seva espera, sense ocupar cap worker
+delayed_calls = DelayedCalls()
+
+# Pipelines: DAG d'etapes que s'executen com una sola tasca. Cada etapa s'envia al seu microservei
+# quan acaben les etapes de què depèn (after), i rep els seus resultats al camp `upstream`
+pipelines = {
+    "qa_segmentation": Pipeline({
+        "qa": {"microservice": "process_dicom"},
+        "segmentation": {"microservice": "vascular_segmentation", "after": ["qa"]},
+    }, microservices),
+}
+
+# Sessions HTTP compartides per tots els workers de cada microservei
+clients = ServiceClients(microservices)
+
+# Cache de resultats per contingut de la sèrie, i agrupació de peticions idèntiques en curs
+result_cache = ResultCache(
+    max_entries=int(os.getenv("RESULT_CACHE_SIZE", 10000)),
+    ttl=float(os.getenv("RESULT_CACHE_TTL", 7 * 24 * 3600)),
+)
+
+# PACS remot d'on es descarreguen les sèries que encara no són a DICOM_DIR (REMOTE_PACS_URL).
+# Una tasca amb `series_instance_uid` processa la carpeta de la sèrie i espera fora de la cua
+# mentre es descarrega, de manera que primer s'envien les tasques que ja tenen la sèrie en local
+# PACS_QUOTA_BYTES / PACS_EVICTION_POLICY: mida màxima de la cache local i política d'expulsió (lru o lfu)
+# PREFETCH_WORKLIST: fitxer o URL amb les sèries que es demanaran aviat, es rellegeix cada PREFETCH_INTERVAL segons
+# PREFETCH_BANDWIDTH / PREFETCH_DISK_BUDGET: bytes per segon de les precàrregues i bytes màxims de
+#        sèries precarregades que encara no s'han fet servir
+# PACS_SCRUB_INTERVAL / PACS_SCRUB_RATE: cada quants segons es tornen a verificar els hashos de cada
+#        sèrie local, i bytes per segon que llegeix la verificació
+pacs = None
+prefetcher = None
+if os.getenv("REMOTE_PACS_URL"):
+    pacs = OrchestratorPACS(
+        DICOM_DIR, RemotePACS(os.environ["REMOTE_PACS_URL"]),
+        quota_bytes=int(os.environ["PACS_QUOTA_BYTES"]) if os.getenv("PACS_QUOTA_BYTES") else None,
+        policy=os.getenv("PACS_EVICTION_POLICY", "lru"),
+    )
+    prefetcher = Prefetcher(
+        pacs,
+        bandwidth=float(os.environ["PREFETCH_BANDWIDTH"]) if os.getenv("PREFETCH_BANDWIDTH") else None,
+        disk_budget=int(os.environ["PREFETCH_DISK_BUDGET"]) if os.getenv("PREFETCH_DISK_BUDGET") else None,
+    )
+    SeriesScrubber(
+        pacs, interval=float(os.getenv("PACS_SCRUB_INTERVAL", 24 * 3600)),
+        rate=float(os.environ["PACS_SCRUB_RATE"]) if os.getenv("PACS_SCRUB_RATE") else None,
+    ).start()
+    if os.getenv("PREFETCH_WORKLIST"):
+        prefetcher.watch(os.environ["PREFETCH_WORKLIST"], float(os.getenv("PREFETCH_INTERVAL", 60)))
+
+
+def task_series(task):
+    """
+    Series Instance UID of the PACS series a task processes, or None.
+    """
+    data = task.get("data")
+    if pacs is None or not isinstance(data, dict):
+        return None
+    return data.get("series_instance_uid")
+
+
+# Sèries PACS fixades a la cache mentre les fa servir una tasca (task_id -> Series Instance UID), perquè
+# una descàrrega posterior no les expulsi mentre el microservei les llegeix
+pinned_series = {}
+pinned_series_lock = threading.Lock()
+
+def pin_task_series(task):
+    """
+    Pin the series of a task, once. Returns False if the series is no longer in the cache.
+    """
+    with pinned_series_lock:
+        if task["task_id"] in pinned_series:
+            return True
+        series = task_series(task)
+        if not pacs.index.pin(series):
+            return False
+        pinned_series[task["task_id"]] = series
+        return True
+
+def unpin_task_series(task_id):
+    """
+    Release the series pinned by a task, if any. Safe to call on every terminal path.
+    """
+    with pinned_series_lock:
+        series = pinned_series.pop(task_id, None)
+    if series is not None:
+        pacs.release_series(series)
+
+
+def result_cache_key(microservice, data):
+    """
+    Cache key of a task, or None if the microservice or the input can not be cached.
+    """
+    config = microservices[microservice]
+    if not config.get("cache") or not isinstance(data, dict) or not data.get("directory"):
+        return None
+    fingerprint = series_fingerprint(os.path.join(DICOM_DIR, data["directory"]))
+    if fingerprint is None:
+        return None
+    reported = registry.model_versions(microservice)
+    if len(reported) > 1:  # Rèpliques amb models diferents (recàrrega en curs): no es fa servir la cache
+        return None
+    model_version = "/".join([str(config.get("model_version", "")), *reported])
+    return cache_key(microservice, model_version, fingerprint)
+
+
+def update_task(task_id, **fields):
+    """
+    Update a task in the store and publish the change.
+    """
+    task = store.update(task_id, **fields)
+    if task is not None:
+        events.publish(task)
+        if task.get("pipeline_id") is not None and "status" in fields:
+            advance_pipeline(task["pipeline_id"])
+    return task
+
+# Serialitza l'avanç de cada pipeline (reentrant: enviar una etapa pot completar-la de la cache)
+pipeline_lock = threading.RLock()
+
+def stage_timings(task):
+    """
+    Status and timings of the task of a pipeline stage.
+    """
+    timings = {
+        "task_id": task["task_id"],
+        "microservice": task["microservice"],
+        "status": task["status"],
+        "created_at": task["created_at"],
+    }
+    if task.get("started_at") is not None:
+        timings["started_at"] = task["started_at"]
+        timings["queue_wait"] = round(task["started_at"] - task["created_at"], 3)
+    if task["status"] in FINISHED_STATUSES:
+        timings["completed_at"] = task.get("completed_at")
+        timings["ellapsed_time"] = task.get("ellapsed_time")
+    return timings
+
+def advance_pipeline(pipeline_id):
+    """
+    Refresh the stage timings of a pipeline task, dispatch the stages whose dependencies have
+    completed, skip the ones that can no longer run, and finish the pipeline when all are done.
+    """
+    with pipeline_lock:
+        run = store.get(pipeline_id)
+        if run is None or run["status"] in FINISHED_STATUSES:
+            return
+        pipeline = pipelines[run["pipeline"]]
+        stages = run["stages"]
+        results = {}
+        for name, stage in stages.items():
+            if stage.get("task_id") is None:
+                continue
+            task = store.get(stage["task_id"])
+            if task is not None:
+                stages[name] = stage_timings(task)
+                if task["status"] == "completed":
+                    results[name] = task["result"]
+
+        states = {name: stage["status"] for name, stage in stages.items()}
+        for name in pipeline.blocked_stages(states):
+            stages[name]["status"] = "skipped"
+        batch = []
+        for name in pipeline.ready_stages(states):
+            if run.get("cancel_requested"):
+                stages[name]["status"] = "skipped"
+                continue
+            task = new_task(
+                pipeline.stages[name]["microservice"], pipeline.stage_input(name, run["data"], results),
+                run["source_path"], run["priority"], run["tenant"],
+            )
+            task.update(pipeline_id=pipeline_id, stage=name)
+            stages[name] = stage_timings(task)
+            batch.append(task)
+
+        update = {"stages": stages}
+        if all(stage["status"] in STAGE_DONE_STATUSES for stage in stages.values()):
+            update["completed_at"] = time.time()
+            update["ellapsed_time"] = round(update["completed_at"] - run["created_at"], 3)
+            statuses = [stage["status"] for stage in stages.values()]
+            if all(status == "completed" for status in statuses):
+                update["status"] = "completed"
+            elif "failed" in statuses:
+                update["status"] = "failed"
             else:
-                task["status"] = "failed"
-                task["result"] = {
-                    "http_status": response.status_code,
-                    "response_text": response.text
-                }
+                update["status"] = "cancelled"
+            update["result"] = {name: results.get(name) for name in pipeline.order}
+        update_task(pipeline_id, **update)
+        # Les etapes s'encuen després de guardar-ne el task_id a la pipeline
+        enqueue_tasks(batch)
+
+def enqueue_tasks(batch):
+    """
+    Store new tasks, publish them and hand them to the dispatcher. Tasks with a cached result
+    are completed immediately, and tasks identical to one in flight wait for its result.
+    """
+    stored = store.add_many(batch)
+    for task in stored:
+        events.publish(task)
+    return dispatch_tasks(stored)
+
+def dispatch_tasks(tasks):
+    """
+    Hand queued tasks to the dispatcher, unless their result is cached or an identical task is
+    already in flight.
+    """
+    enqueued = []
+    for task in tasks:
+        key = task.get("cache_key")
+        if key is not None:
+            outcome, value = result_cache.claim(key, task["task_id"])
+            if outcome == ResultCache.HIT:
+                now = time.time()
+                task = update_task(
+                    task["task_id"], status="completed", result=value["result"], cached_from=value["task_id"],
+                    started_at=now, completed_at=now, ellapsed_time=0.0,
+                )
+                enqueued.append(task)
+                continue
+            if outcome == ResultCache.COALESCED:
+                enqueued.append(update_task(task["task_id"], coalesced_with=value))
+                continue
+        submit_task(task)
+        enqueued.append(task)
+    return enqueued
+
+# Evita que una tasca asíncrona s'acabi dues vegades (callback i polling)
+finish_lock = threading.Lock()
+
+def finish_task(task_id, started_at, update):
+    """
+    Record the final status of a running task and share its result with the identical tasks
+    waiting for it. Returns the task, or None if it was no longer running.
+    """
+    with finish_lock:
+        task = store.get(task_id)
+        if task is None or task["status"] != "running":
+            return None
+        update["completed_at"] = time.time()  # Guardem quan finalitza
+        update["ellapsed_time"] = round(update["completed_at"] - started_at, 3)  # Temps en segons
+        update_task(task_id, **update)
+    unpin_task_series(task_id)
+    metrics.observe_task(task, started_at, update)
+
+    # Comparteix el resultat amb les peticions idèntiques que l'esperaven
+    if task.get("cache_key"):
+        followers = result_cache.complete(
+            task["cache_key"], task_id, update["result"], success=update["status"] == "completed"
+        )
+        for follower in followers:
+            waiting = store.get(follower)
+            if waiting is not None and waiting["status"] == "queued":  # No les cancel·lades ni esborrades
+                update_task(follower, cached_from=task_id, started_at=started_at, **update)
+    return task
+
+def job_update(body):
+    """
+    Final task fields from the completion reported by an asynchronous microservice.
+    """
+    if body.get("status") == "success":
+        return {"status": "completed", "result": body.get("result", "ok")}
+    return {"status": "failed", "result": {"error": body.get("error") or body.get("message") or body}}
+
+def finish_job(task, body):
+    """
+    Finish an asynchronous task and free its in-flight slot.
+    """
+    if finish_task(task["task_id"], task["started_at"], job_update(body)) is not None and task.get("job_id"):
+        registry.release(task["microservice"], task["address"])
+        dispatcher.release(task["microservice"])
+
+def start_task(task_id):
+    """
+    Mark a task as running on the chosen replica of its microservice. Returns the task and the
+    headers of its /run request, or (None, None) if the task no longer exists, was cancelled, or
+    the circuit of its microservice is open (the task is then queued again once it can be tried).
+    """
+    running = {"status": "running", "started_at": time.time()}
+    with finish_lock:
+        task = store.get(task_id)
+        if task is None or task["status"] != "queued":  # La tasca ja no existeix o s'ha cancel·lat
+            return None, None
+        first_start = task.get("started_at") is None
+        series = task_series(task)
+        if series is not None and series not in pacs.index:
+            # Sèrie invalidada mentre la tasca esperava: es torna a descarregar
+            unpin_task_series(task_id)
+            delayed_calls.call_later(0, submit_task, task)
+            return None, None
+        breaker = breakers[task["microservice"]]
+        if not breaker.allow():
+            # Circuit obert: no s'envia, la tasca torna a la cua quan es pugui provar el microservei
+            delay = breaker.retry_after()
+            update_task(task_id, retry_at=time.time() + delay)
+            delayed_calls.call_later(delay, submit_task, task)
+            return None, None
+        running["address"] = registry.acquire(task["microservice"])
+        headers = {"X-Task-ID": str(task_id)}  # Permet cancel·lar la tasca al microservei
+        if microservices[task["microservice"]].get("async"):
+            running["callback_token"] = secrets.token_urlsafe(16)
+            headers["X-Callback-URL"] = f"{ORCHESTRATOR_URL}/callback/{task_id}?token={running['callback_token']}"
+        task = update_task(task_id, **running)
+    if first_start:
+        metrics.observe_queue_wait(task, running["started_at"])
+
+    # Obté la configuració del microservei
+    logging.info(task)
+    logging.info(f"Processing task {task_id} with microservice {task['microservice']} at {task['address']}")
+    return task, headers
+
+def handle_response(task, headers, status_code, text, retry_after=None):
+    """
+    Record the response of the /run request of a task. Returns DETACHED if the microservice
+    accepted it as an asynchronous job.
+    """
+    task_id = task["task_id"]
+    busy_delay = RetryPolicy.retry_after(retry_after) if status_code == 503 else None
+    if busy_delay is not None:
+        # Cua plena del microservei: es torna a provar quan indica, sense comptar-ho com a fallada
+        retry_busy(task, busy_delay, {"http_status": status_code, "response_text": text})
+        return None
+    if status_code in RETRYABLE_STATUSES:
+        retry_or_fail(task, {"http_status": status_code, "response_text": text})
+        return None
+    breakers[task["microservice"]].record_success()
+    try:
+        if status_code == 202 and "X-Callback-URL" in headers:
+            # Tasca asíncrona: el microservei notificarà el final
+            job_id = json.loads(text).get("job_id")
+            with finish_lock:
+                current = store.get(task_id)
+                if current is not None and current["status"] == "running":
+                    update_task(task_id, job_id=job_id, polled_at=time.time())
+                    logging.info(f"Task {task_id} accepted by {task['microservice']} as job {job_id}")
+                    return DETACHED
+            return None  # Ja ha acabat (callback abans de tenir el job_id)
+        if status_code == 200:
+            result = json.loads(text)
+            logging.info(result)
+            update = {
+                "status": "completed",
+                "result": result.get("result", "ok"),  # 🔹 Només guarda el valor numèric o "ok"
+            }
+        else:
+            update = {
+                "status": "failed",
+                "result": {
+                    "http_status": status_code,
+                    "response_text": text
+                },
+            }
+    except Exception as e:
+        logging.error(f"Error processing task {task_id}: {e}")
+        update = {"status": "failed", "result": {"error": str(e)}}
+
+    finish_task(task_id, task["started_at"], update)
+    return None
+
+def handle_error(task, error):
+    """
+    Record a task whose /run request could not be sent or answered. A replica that refuses
+    connections is taken out of rotation.
+    """
+    registry.release(task["microservice"], task["address"])
+    if connection_failed(error):
+        registry.mark_down(task["microservice"], task["address"], str(error))
+    logging.error(f"Error processing task {task['task_id']}: {error}")
+    if transient_error(error):
+        retry_or_fail(task, {"error": str(error)})
+    else:
+        finish_task(task["task_id"], task["started_at"], {"status": "failed", "result": {"error": str(error)}})
+
+# Respostes d'un microservei caigut o saturat, que es reintenten
+RETRYABLE_STATUSES = (502, 503, 504)
+
+def submit_task(task):
+    """
+    Hand a queued task to the dispatcher. A task whose PACS series is not local yet waits
+    outside the queue while it is downloaded, so the tasks with local inputs go first.
+    """
+    series = task_series(task)
+    if series is None:
+        queue_task(task)
+        return
+    # Mai en línia: si la sèrie ja és local el callback s'executaria amb els locks de qui encua
+    # (finish_task -> advance_pipeline) i series_ready tornaria a agafar finish_lock
+    pacs.request_series(series).add_done_callback(
+        lambda download: delayed_calls.call_later(0, series_ready, task, download)
+    )
+
+def series_ready(task, download):
+    """
+    Queue a task once its series is local, pinned until the task finishes, or fail it if the
+    series could not be downloaded.
+    """
+    error = download.exception()
+    if error is not None:
+        fail_queued_task(task, {"error": f"Error retrieving series {task_series(task)}: {error}"})
+        return
+    with finish_lock:  # Una cancel·lació és abans (no es fixa) o després (la deixa anar)
+        current = store.get(task["task_id"])
+        if current is None or current["status"] != "queued":
+            return
+        pinned = pin_task_series(task)
+    if not pinned:
+        # Expulsada just després de descarregar-la: es torna a demanar
+        submit_task(task)
+        return
+    queue_task(task)
+
+def queue_task(task):
+    dispatcher.submit(
+        task["microservice"], task["task_id"],
+        task.get("priority", DEFAULT_PRIORITY), task.get("tenant", DEFAULT_TENANT),
+    )
+
+def fail_queued_task(task, result):
+    """
+    Mark failed a queued task that can not be dispatched.
+    """
+    task_id = task["task_id"]
+    with finish_lock:
+        current = store.get(task_id)
+        if current is None or current["status"] != "queued":
+            return
+        now = time.time()
+        update_task(task_id, status="failed", result=result, started_at=now, completed_at=now, ellapsed_time=0.0)
+    unpin_task_series(task_id)
+    metrics.TASKS_FINISHED.labels(task["microservice"], "failed").inc()
+    logging.error(f"Task {task_id} failed before dispatch: {result}")
+    release_followers(task)
+
+def release_followers(task):
+    """
+    Dispatch on their own the identical tasks that were waiting for a task that did not complete.
+    """
+    if task.get("cache_key"):
+        followers = result_cache.complete(task["cache_key"], task["task_id"], success=False)
+        waiting = [store.get(follower) for follower in followers]
+        dispatch_tasks([follower for follower in waiting if follower is not None and follower["status"] == "queued"])
+
+def retry_or_fail(task, result):
+    """
+    Record a transient failure of a task: queue it again after its backoff, or mark it failed
+    once its microservice's retries are exhausted.
+    """
+    task_id, microservice = task["task_id"], task["microservice"]
+    breakers[microservice].record_failure()
+    policy = retry_policies[microservice]
+    retries = task.get("retries", 0)
+    if retries >= policy.retries:
+        finish_task(task_id, task["started_at"], {"status": "failed", "result": result})
+        return
+    delay = policy.delay(retries + 1)
+    with finish_lock:
+        current = store.get(task_id)
+        if current is None or current["status"] != "running":
+            return
+        task = update_task(
+            task_id, status="queued", address=None, retries=retries + 1, last_error=result,
+            retry_at=time.time() + delay,
+        )
+    # Es torna a fixar quan es torni a encuar, després del backoff
+    unpin_task_series(task_id)
+    metrics.TASK_RETRIES.labels(microservice).inc()
+    logging.warning(f"Retrying task {task_id} on {microservice} in {delay:.1f} s ({retries + 1}/{policy.retries}): {result}")
+    delayed_calls.call_later(delay, submit_task, task)
+
+def retry_busy(task, delay, result):
+    """
+    Queue again, after the Retry-After `delay` of its microservice, a task refused because the
+    microservice is saturated. It does not use up the retries of the task nor count as a failure
+    of the circuit breaker.
+    """
+    task_id, microservice = task["task_id"], task["microservice"]
+    breakers[microservice].record_busy()
+    delay += random.uniform(0, delay / 4)  # Les tasques rebutjades alhora no tornen alhora
+    with finish_lock:
+        current = store.get(task_id)
+        if current is None or current["status"] != "running":
+            return
+        task = update_task(
+            task_id, status="queued", address=None, busy_retries=current.get("busy_retries", 0) + 1,
+            last_error=result, retry_at=time.time() + delay,
+        )
+    unpin_task_series(task_id)
+    metrics.TASK_RETRIES.labels(microservice).inc()
+    logging.warning(f"{microservice} is saturated, retrying task {task_id} in {delay:.1f} s")
+    delayed_calls.call_later(delay, submit_task, task)
+
+def release_replica(task, outcome):
+    """
+    Free the replica of a task once it answered, unless it keeps running as an asynchronous job.
+    """
+    if outcome != DETACHED:
+        registry.release(task["microservice"], task["address"])
+    return outcome
+
+# Processa una tasca dins d'un worker del dispatcher
+def execute_task(task_id):
+    task, headers = start_task(task_id)
+    if task is None:
+        return None
+    microservice = task["microservice"]
+    try:
+        # Envia la petició al microservei
+        with metrics.DISPATCH_LATENCY.labels(microservice).time():
+            response = clients.post(microservice, task["address"], "/run", json=task["data"], headers=headers)
+    except Exception as e:
+        handle_error(task, e)
+        return None
+    return release_replica(
+        task, handle_response(task, headers, response.status_code, response.text, response.headers.get("Retry-After"))
+    )
+
+# Mateix procés, des del bucle asyncio (DISPATCH_MODE=asyncio)
+async def execute_task_async(task_id):
+    # Els canvis d'estat bloquegen (store, locks, pipelines): es fan fora del bucle
+    task, headers = await asyncio.to_thread(start_task, task_id)
+    if task is None:
+        return None
+    microservice = task["microservice"]
+    try:
+        with metrics.DISPATCH_LATENCY.labels(microservice).time():
+            status_code, text, response_headers = await async_clients.post(
+                microservice, task["address"], "/run", json=task["data"], headers=headers
+            )
+    except Exception as e:
+        await asyncio.to_thread(handle_error, task, e)
+        return None
+    outcome = await asyncio.to_thread(
+        handle_response, task, headers, status_code, text, response_headers.get("Retry-After")
+    )
+    return release_replica(task, outcome)
+
+def cancel_task(task_id):
+    """
+    Cancel a task. A queued task is removed from its queue; for a running one the microservice
+    is asked to stop it (POST /cancel) and its in-flight slot is freed. Cancelling a pipeline
+    cancels its unfinished stages. Returns the task, or None if it does not exist.
+    """
+    task = store.get(task_id)
+    if task is None or task["status"] in FINISHED_STATUSES:
+        return task
+    if task.get("pipeline") is not None:
+        with pipeline_lock:
+            task = update_task(task_id, cancel_requested=True)
+        for stage in task["stages"].values():
+            if stage.get("task_id") is not None:
+                cancel_task(stage["task_id"])
+        advance_pipeline(task_id)  # Salta les etapes pendents i tanca la pipeline
+        return store.get(task_id)
+
+    with finish_lock:
+        task = store.get(task_id)
+        if task is None or task["status"] in FINISHED_STATUSES:
+            return task
+        update = {"status": "cancelled", "completed_at": time.time()}
+        if task["status"] == "running":
+            update["ellapsed_time"] = round(update["completed_at"] - task["started_at"], 3)
+        cancelled = update_task(task_id, **update)
+    unpin_task_series(task_id)
+    microservice = task["microservice"]
+    metrics.TASKS_FINISHED.labels(microservice, "cancelled").inc()
+    logging.info(f"Cancelled {task['status']} task {task_id} of {microservice}")
+
+    if task["status"] == "queued":
+        dispatcher.cancel(microservice, task_id)
+    else:
+        try:
+            clients.post(
+                microservice, task["address"], "/cancel",
+                json={"task_id": str(task_id), "job_id": task.get("job_id")}, timeout=5,
+            )
         except Exception as e:
-            logging.error(f"Error processing task {task_id}: {e}")
-            task["status"] = "failed"
-            task["result"] = {"error": str(e)}
-        
-        task["completed_at"] = time.time()  # Guardem quan finalitza
-        task["ellapsed_time"] = round(task["completed_at"] - task["started_at"], 3)  # Temps en segons
-       
-        task_queue.task_done()
-
-# Inicia el worker thread
-worker_thread = threading.Thread(target=worker, daemon=True)
-worker_thread.start()
-
-@app.route("/run/dummy", methods=["POST"])
-def run_task():
-    microservice = "dummy"
-    if microservice not in microservices:
-        return jsonify({"error": "Service not found"}), 404
+            logging.error(f"Error cancelling task {task_id} on {task['address']}: {e}")
+        if task.get("job_id"):
+            # Tasca asíncrona: el seu callback ja no l'acabarà
+            registry.release(microservice, task["address"])
+            dispatcher.release(microservice)
+
+    # Les tasques idèntiques que esperaven aquesta s'envien pel seu compte
+    release_followers(task)
+    return cancelled
+
+# Consulta /jobs/<job_id> de les tasques asíncrones, per si s'ha perdut algun callback
+def poll_async_jobs():
+    while True:
+        time.sleep(ASYNC_POLL_INTERVAL)
+        for task in store.list(status="running"):
+            if not task.get("job_id") or task["microservice"] not in microservices:
+                continue
+            if time.time() - task.get("polled_at", 0) < ASYNC_POLL_INTERVAL:
+                continue
+            microservice = task["microservice"]
+            update_task(task["task_id"], polled_at=time.time())
+            try:
+                response = clients.get(microservice, task["address"], f"/jobs/{task['job_id']}")
+                if response.status_code == 404:
+                    finish_job(task, {"status": "failed", "error": "Job not found on the microservice"})
+                    continue
+                body = response.json()
+                if body.get("status") in ("success", "failed"):
+                    finish_job(task, body)
+                    continue
+            except Exception as e:
+                logging.error(f"Error polling job {task['job_id']} of task {task['task_id']}: {e}")
+            if time.time() - task["started_at"] > clients.timeout(microservice)[1]:
+                finish_job(task, {"status": "failed", "error": "Timed out waiting for the microservice"})
 
-    task_id = int(time.time() * 1000)
-    task = {
-        "task_id": task_id,
+# Inicia un pool de workers per microservei
+# QUEUE_AGING: segons d'espera que pugen un nivell de prioritat a una tasca encuada
+# DISPATCH_MODE: "threads" (un pool de threads per microservei) o "asyncio" (un bucle asyncio amb
+# un client HTTP asíncron, per mantenir milers de peticions en curs amb pocs threads)
+DISPATCH_MODE = os.getenv("DISPATCH_MODE", "threads")
+if DISPATCH_MODE == "asyncio":
+    async_clients = AsyncServiceClients(microservices)
+    dispatcher = AsyncDispatcher(
+        execute_task_async,
+        {name: microservices[name]["max_in_flight"] * registry.replica_count(name) for name in microservices},
+        aging=float(os.getenv("QUEUE_AGING", 600)),
+        on_stop=async_clients.close,
+    )
+else:
+    dispatcher = Dispatcher(
+        execute_task,
+        {name: microservices[name]["max_in_flight"] * registry.replica_count(name) for name in microservices},
+        aging=float(os.getenv("QUEUE_AGING", 600)),
+        workers={name: config["workers"] for name, config in microservices.items() if "workers" in config},
+    )
+metrics.register_gauges(dispatcher, microservices, result_cache, breakers, pacs)
+dispatcher.start()
+
+threading.Thread(target=poll_async_jobs, name="async-job-poller", daemon=True).start()
+
+# Torna a encuar les tasques que no havien acabat abans de reiniciar
+for pending in store.list(status=("queued", "running")):
+    if pending.get("pipeline") is not None:
+        # Envia les etapes que estaven a punt quan es va aturar el servidor
+        if pending["pipeline"] in pipelines:
+            advance_pipeline(pending["task_id"])
+        else:
+            update_task(pending["task_id"], status="failed", result={"error": "Pipeline not found"})
+        continue
+    if pending["microservice"] not in microservices:
+        update_task(pending["task_id"], status="failed", result={"error": "Service not found"})
+        continue
+    if pending["status"] == "running" and pending.get("job_id"):
+        # Tasca asíncrona que segueix en curs al microservei: el poller en recollirà el resultat
+        registry.adopt(pending["microservice"], pending["address"])
+        dispatcher.adopt(pending["microservice"])
+        continue
+    update_task(pending["task_id"], status="queued", address=None)
+    submit_task(pending)
+    logging.info(f"Re-enqueued task {pending['task_id']} for {pending['microservice']}")
+
+def request_priority():
+    """
+    Priority class and tenant of the current request: `priority` query parameter (stat, routine
+    or batch) and `X-Tenant` header or `tenant` query parameter.
+    """
+    priority = request.args.get("priority", DEFAULT_PRIORITY)
+    tenant = request.headers.get("X-Tenant") or request.args.get("tenant") or DEFAULT_TENANT
+    return priority, tenant
+
+def new_task(microservice, data, source_path="N/A", priority=DEFAULT_PRIORITY, tenant=DEFAULT_TENANT):
+    """
+    Build the record of a new queued task for a microservice. A task with a `series_instance_uid`
+    processes the folder of that series, downloaded from the PACS if needed.
+    """
+    if pacs is not None and isinstance(data, dict) and data.get("series_instance_uid") and not data.get("directory"):
+        data = dict(data, directory=data["series_instance_uid"])
+        if source_path == "N/A":
+            source_path = data["directory"]
+    return {
+        "task_id": task_ids.next_id(),
         "microservice": microservice,
-        "address": microservices[microservice],
+        "address": None,  # Rèplica triada en enviar la tasca
         "status": "queued",
-        "data": request.json,
+        "data": data,
         "result": None,
         "created_at": time.time(),
-        "source_path": "N/A",  # 🔹 Guarda el directory si existeix
+        "source_path": source_path,  # 🔹 Guarda el directory si existeix
+        "cache_key": result_cache_key(microservice, data),
+        "priority": priority,
+        "tenant": tenant,
     }
-    tasks[task_id] = task
-    task_queue.put(task_id)
-
-    return jsonify({"microservice": microservice, "task_id": task_id, "status": "queued"}), 202
 
-@app.route("/run/process_dicom", methods=["GET"])
-def run_task_with_directory():
-    microservice = "process_dicom"
-    if microservice not in microservices:
-        return jsonify({"error": "Service not found"}), 404
-    
-    directory = request.args.get('directory').strip()
-    
-    if not directory:
-        return jsonify({"error": "Directory parameter is required"}), 400
-    
-    task_id = int(time.time() * 1000)
-    
-    task = {
-        "task_id": task_id,
-        "microservice": microservice,
-        "address": microservices[microservice],
-        "status": "queued",  # Al principio está en cola
-        "data": {"directory": directory},
+def new_pipeline_task(name, data, source_path="N/A", priority=DEFAULT_PRIORITY, tenant=DEFAULT_TENANT):
+    """
+    Build the record of a new pipeline task. Its stages are dispatched by advance_pipeline.
+    """
+    now = time.time()
+    return {
+        "task_id": task_ids.next_id(),
+        "microservice": "pipeline",
+        "pipeline": name,
+        "status": "running",
+        "data": data,
         "result": None,
-        "created_at": time.time(),
-        "source_path": directory,  # 🔹 Guarda el directory si existeix
+        "created_at": now,
+        "started_at": now,
+        "source_path": source_path,
+        "priority": priority,
+        "tenant": tenant,
+        "stages": {stage: {"status": "pending"} for stage in pipelines[name].order},
     }
-    
-    tasks[task_id] = task
-    task_queue.put(task_id)  # Si tienes una cola de tareas para procesamiento
-    return jsonify({"microservice": microservice, "task_id": task_id, "status": "queued"}), 202
-
-@app.route("/run/vascular_segmentation", methods=["GET"])
-def run_task_with_directory_vascular_segmentation():
-    microservice = "vascular_segmentation"
-    if microservice not in microservices:
+
+@app.route("/run/<microservice>", methods=["GET", "POST"])
+def run_task(microservice):
+    """
+    Enqueue a task for a microservice: GET with the `directory` parameter for the services that
+    process a DICOM directory, or POST with the JSON payload of the task.
+    """
+    if microservice not in registry:
+        return jsonify({"error": "Service not found"}), 404
+
+    if request.method == "POST":
+        data = request.get_json(silent=True)
+        if data is None:
+            return jsonify({"error": "A JSON body is required"}), 400
+        source_path = data.get("directory", "N/A") if isinstance(data, dict) else "N/A"
+    else:
+        directory = (request.args.get('directory') or '').strip()
+        if not directory:
+            return jsonify({"error": "Directory parameter is required"}), 400
+        data, source_path = {"directory": directory}, directory
+
+    priority, tenant = request_priority()
+    if priority not in PRIORITIES:
+        return jsonify({"error": f"Unknown priority: {priority}"}), 400
+
+    task = new_task(microservice, data, source_path, priority, tenant)
+    task = enqueue_tasks([task])[0]
+    task_id = task["task_id"]
+    return jsonify({"microservice": microservice, "task_id": task_id, "status": task["status"]}), 202
+
+@app.route("/run/<microservice>/batch", methods=["POST"])
+def run_batch(microservice):
+    """
+    Enqueue many tasks in one request. The body is {"directories": [...]} for the services
+    that process a DICOM directory, or {"data": [{...}, ...]} with the raw payload of each task.
+    An optional "priority" applies to the whole batch (usually "batch").
+    """
+    if microservice not in registry:
         return jsonify({"error": "Service not found"}), 404
-    
-    directory = request.args.get('directory')
-    
-    if not directory:
-        return jsonify({"error": "Directory parameter is required"}), 400
-    
-    task_id = int(time.time() * 1000)
-    
-    task = {
-        "task_id": task_id,
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({"error": "A JSON object body is required"}), 400
+    priority, tenant = request_priority()
+    priority = body.get("priority", priority)
+    if priority not in PRIORITIES:
+        return jsonify({"error": f"Unknown priority: {priority}"}), 400
+
+    field = "directories" if "directories" in body else "data" if "data" in body else None
+    if field is None or not isinstance(body[field], list):
+        return jsonify({"error": "A 'directories' or 'data' list is required"}), 400
+    if field == "directories":
+        directories = [str(d).strip() for d in body["directories"]]
+        if not all(directories):
+            return jsonify({"error": "Directories must not be empty"}), 400
+        batch = [new_task(microservice, {"directory": d}, d, priority, tenant) for d in directories]
+    else:
+        batch = [new_task(microservice, data, priority=priority, tenant=tenant) for data in body["data"]]
+
+    batch = enqueue_tasks(batch)
+    return jsonify({
         "microservice": microservice,
-        "address": microservices[microservice],
-        "status": "queued",  # Al principio está en cola
-        "data": {"directory": directory},
-        "result": None,
-        "created_at": time.time(),
-        "source_path": directory,  # 🔹 Guarda el directory si existeix
-    }
-    
-    tasks[task_id] = task
-    task_queue.put(task_id)  # Si tienes una cola de tareas para procesamiento
-    return jsonify({"microservice": microservice, "task_id": task_id, "status": "queued"}), 202
+        "task_ids": [task["task_id"] for task in batch],
+        "statuses": [task["status"] for task in batch],
+    }), 202
+
+@app.route("/services", methods=["GET"])
+def list_services():
+    """
+    Circuit state of every microservice, and its replicas with their outstanding requests and health.
+    """
+    replicas = registry.describe()
+    return jsonify({
+        name: {"circuit": breakers[name].state, "replicas": replicas[name]} for name in microservices
+    }), 200
+
+@app.route("/pipelines", methods=["GET"])
+def list_pipelines():
+    return jsonify({name: pipeline.describe() for name, pipeline in pipelines.items()}), 200
+
+@app.route("/pipeline/<name>", methods=["GET", "POST"])
+def run_pipeline(name):
+    """
+    Run a pipeline on a DICOM directory: GET with the `directory` parameter, or POST with the
+    input of the first stages as JSON body. Returns the task_id of the pipeline task, whose
+    status reports the timings of every stage.
+    """
+    if name not in pipelines:
+        return jsonify({"error": "Pipeline not found"}), 404
+
+    if request.method == "POST":
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "A JSON object body is required"}), 400
+    else:
+        data = {"directory": (request.args.get("directory") or "").strip()}
+        if not data["directory"]:
+            return jsonify({"error": "Directory parameter is required"}), 400
+
+    priority, tenant = request_priority()
+    if priority not in PRIORITIES:
+        return jsonify({"error": f"Unknown priority: {priority}"}), 400
+
+    run = new_pipeline_task(name, data, data.get("directory", "N/A"), priority, tenant)
+    store.add(run)
+    events.publish(run)
+    advance_pipeline(run["task_id"])
+    run = store.get(run["task_id"])
+    return jsonify({"pipeline": name, "task_id": run["task_id"], "status": run["status"]}), 202
 
 @app.route("/status/<int:task_id>", methods=["GET"])
 def task_status(task_id):
-    if task_id in tasks:
-        task = tasks[task_id]
-        return jsonify({
+    """
+    Status of a task. With `wait=<seconds>` (at most 60) the request is held until the task
+    status differs from `status` (if given) or until the task finishes.
+    """
+    wait = min(request.args.get("wait", 0, type=float), 60)
+    known_status = request.args.get("status")
+    task = store.get(task_id)
+    if task is not None and wait > 0:
+        def changed():
+            current = store.get(task_id)
+            if current is None:
+                return True
+            if known_status is not None:
+                return current["status"] != known_status
+            return current["status"] in FINISHED_STATUSES
+
+        events.wait(changed, timeout=wait)
+        task = store.get(task_id)
+
+    if task is not None:
+        status = {
             "task_id": task["task_id"],
             "microservice": task["microservice"],
             "status": task["status"],
             "ellapsed_time": task.get("ellapsed_time", "pending"),  # Si no ha acabat, posem "pending"
             "result": task.get("result", "ok"),  # Mostra "ok" si no hi ha cap resultat
             "created_at": task["created_at"]
-        }), 200
+        }
+        if task.get("pipeline") is not None:
+            status.update(pipeline=task["pipeline"], stages=task["stages"])
+        elif task.get("pipeline_id") is not None:
+            status.update(pipeline_id=task["pipeline_id"], stage=task["stage"])
+        return jsonify(status), 200
     else:
         return jsonify({"error": "Task not found or expired"}), 404
 
+@app.route("/callback/<int:task_id>", methods=["POST"])
+def task_callback(task_id):
+    """
+    Completion of an asynchronous task, sent by the microservice to the X-Callback-URL it received.
+    The body is {"status": "success", "result": ...} or {"status": "failed", "error": ...}.
+    """
+    task = store.get(task_id)
+    if task is None:
+        return jsonify({"error": "Task not found or expired"}), 404
+    if not secrets.compare_digest(request.args.get("token", ""), task.get("callback_token", "")):
+        return jsonify({"error": "Invalid callback token"}), 403
+    finish_job(task, request.get_json(silent=True) or {})
+    return jsonify({"task_id": task_id, "status": "received"}), 200
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    return jsonify(result_cache.stats()), 200
+
+@app.route("/pacs/stats", methods=["GET"])
+def pacs_stats():
+    """
+    Hits and misses of the local PACS cache, prefetch counters and pending worklist.
+    """
+    if pacs is None:
+        return jsonify({"error": "PACS not configured"}), 404
+    return jsonify(dict(pacs.stats(), prefetch_pending=prefetcher.pending())), 200
+
+@app.route("/pacs/prefetch", methods=["POST"])
+def pacs_prefetch():
+    """
+    Append series to the prefetch worklist: {"series": [series_instance_uid, ...]} in the
+    order they will be needed.
+    """
+    if pacs is None:
+        return jsonify({"error": "PACS not configured"}), 404
+    series = (request.get_json(silent=True) or {}).get("series")
+    if not isinstance(series, list):
+        return jsonify({"error": "A 'series' list is required"}), 400
+    added = prefetcher.add([str(uid) for uid in series])
+    return jsonify({"added": added, "pending": prefetcher.pending()}), 202
+
+@app.route("/events", methods=["GET"])
+def task_events():
+    """
+    Server-sent events stream of task state transitions, optionally filtered by `task_id` or
+    `microservice`. Each event id is the store version, so a reconnecting client (Last-Event-ID)
+    first receives the changes it missed. A `resync` event means events were dropped and the
+    client should reload /tasks.
+    """
+    task_id = request.args.get("task_id", type=int)
+    microservice = request.args.get("microservice")
+    last_version = request.headers.get("Last-Event-ID", type=int)
+    subscriber = events.subscribe(task_id=task_id, microservice=microservice)
+
+    def stream():
+        try:
+            if last_version is not None:
+                for task in store.list(microservice=microservice, since_version=last_version):
+                    if task_id is None or task["task_id"] == task_id:
+                        yield format_event(task)
+            while True:
+                if subscriber.lagged:
+                    subscriber.lagged = False
+                    yield "event: resync\ndata: {}\n\n"
+                try:
+                    event = subscriber.events.get(timeout=15)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_event(event)
+        finally:
+            events.unsubscribe(subscriber)
+
+    return Response(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+def format_event(task):
+    event = {field: task[field] for field in EVENT_FIELDS if field in task}
+    return f"id: {event['version']}\nevent: task\ndata: {json.dumps(event)}\n\n"
+
+@app.route("/tasks/<int:task_id>", methods=["DELETE"])
+def delete_task(task_id):
+    """
+    Cancel a queued or running task (or pipeline). Finished tasks can not be cancelled.
+    """
+    task = store.get(task_id)
+    if task is None:
+        return jsonify({"error": "Task not found or expired"}), 404
+    if task["status"] in FINISHED_STATUSES:
+        return jsonify({"error": f"Task already {task['status']}", "status": task["status"]}), 409
+    task = cancel_task(task_id)
+    return jsonify({"task_id": task_id, "status": task["status"]}), 200
+
 @app.route("/tasks", methods=["GET"])
 def get_all_tasks():
-    return jsonify({"tasks": list(tasks.values())}), 200
+    """
+    List tasks, `limit` at a time (100 by default, at most 1000).
+
+    Filters: status (comma separated), microservice, created_after, created_before.
+    fields: comma separated list of fields to return for each task.
+    cursor: task_id returned as `next_cursor` by the previous page.
+    since: `version` returned by a previous call, only the tasks changed after it are returned,
+    with the ids of the tasks evicted since then in `removed`. `resync` means the evictions since
+    that version are no longer known, and the client has to reload every task.
+    """
+    args = request.args
+    limit = max(1, min(args.get("limit", 100, type=int), 1000))
+    since = args.get("since", type=int)
+    status = args.get("status")
+    current_version = store.version()
+
+    page = store.list(
+        status=tuple(status.split(",")) if status else None,
+        microservice=args.get("microservice"),
+        created_after=args.get("created_after", type=float),
+        created_before=args.get("created_before", type=float),
+        after_id=args.get("cursor", type=int),
+        since_version=since,
+        limit=limit,
+    )
+    truncated = len(page) == limit
+    next_cursor = page[-1]["task_id"] if truncated and since is None else None
+
+    if since is not None:
+        # Continua des de l'última versió retornada si la pàgina està plena
+        version = page[-1]["version"] if truncated else max([current_version] + [t["version"] for t in page])
+        removed = store.removed_since(since, version)
+    else:
+        version = current_version
+        removed = []
+
+    fields = args.get("fields")
+    if fields:
+        fields = fields.split(",")
+        page = [{field: task[field] for field in fields if field in task} for task in page]
+
+    return jsonify({
+        "tasks": page,
+        "next_cursor": next_cursor,
+        "version": version,
+        "removed": removed or [],
+        "resync": removed is None,
+    }), 200
 
 @app.route("/", methods=["GET"])
 def index():
@@ -233,18 +1170,40 @@ def index():
                 background-color: #d9534f;
                 color: white;
             }
+            .status-cancelled {
+                background-color: #777777;
+                color: white;
+            }
   
         </style>
         <script>
             let tasks = [];
+            let tasksById = {};
+            let version = 0;
             let sortDirection = 1;
             let sortColumn = "task_id";
+            const PAGE_SIZE = 500;
+            const FIELDS = "task_id,microservice,source_path,status,created_at,ellapsed_time,result";
 
             async function fetchTasks() {
                 try {
-                    const response = await fetch('/tasks');
-                    const data = await response.json();
-                    tasks = data.tasks;
+                    // Només demana les tasques que han canviat des de l'última versió
+                    let more = true;
+                    while (more) {
+                        const response = await fetch(`/tasks?since=${version}&limit=${PAGE_SIZE}&fields=${FIELDS}`);
+                        const data = await response.json();
+                        if (data.resync) {
+                            // S'han perdut esborrats: torna a carregar totes les tasques
+                            tasksById = {};
+                            version = 0;
+                            continue;
+                        }
+                        data.removed.forEach(taskId => { delete tasksById[taskId]; });
+                        data.tasks.forEach(task => { tasksById[task.task_id] = task; });
+                        version = data.version;
+                        more = data.tasks.length === PAGE_SIZE;
+                    }
+                    tasks = Object.values(tasksById);
                     sortTasks();
                     displayTasks();
                 } catch (error) {
@@ -296,8 +1255,28 @@ def index():
                 displayTasks();
             }
 
-            setInterval(fetchTasks, 2000);
-            window.onload = fetchTasks;
+            // Rep els canvis d'estat en temps real; si el navegador no suporta EventSource, fa polling
+            function subscribeToEvents() {
+                const source = new EventSource('/events');
+                source.addEventListener('task', (message) => {
+                    const task = JSON.parse(message.data);
+                    tasksById[task.task_id] = Object.assign(tasksById[task.task_id] || {}, task);
+                    version = Math.max(version, task.version);
+                    tasks = Object.values(tasksById);
+                    sortTasks();
+                    displayTasks();
+                });
+                source.addEventListener('resync', fetchTasks);
+            }
+
+            window.onload = async () => {
+                await fetchTasks();
+                if (window.EventSource) {
+                    subscribeToEvents();
+                } else {
+                    setInterval(fetchTasks, 2000);
+                }
+            };
         </script>
     </head>
     <body>
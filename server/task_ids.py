@@ -0,0 +1,67 @@
+import os
+import threading
+import time
+
+# 2025-01-01T00:00:00Z, in milliseconds
+EPOCH_MS = 1735689600000
+
+# 41 bits of milliseconds + 5 bits of worker id + 7 bits of sequence = 53 bits, so the ids
+# are still exact integers in JavaScript (Number.MAX_SAFE_INTEGER) for the dashboard.
+WORKER_BITS = 5
+SEQUENCE_BITS = 7
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+class SnowflakeIdGenerator:
+    """
+    Generates unique, time-ordered integer task ids.
+
+    An id packs the milliseconds since EPOCH_MS, the id of the orchestrator process and a
+    per-millisecond sequence number. Ids never repeat within a process, even if the wall
+    clock goes backwards, and processes with different worker ids never collide.
+    """
+
+    def __init__(self, worker_id: int):
+        """
+        Initialize the generator.
+
+        :param worker_id: Identifier of this orchestrator process, between 0 and MAX_WORKER_ID.
+        """
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker_id must be between 0 and {MAX_WORKER_ID}: {worker_id}")
+        self.worker_id = worker_id
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next_id(self) -> int:
+        """
+        :return: A new unique id.
+        """
+        with self._lock:
+            now_ms = max(int(time.time() * 1000) - EPOCH_MS, self._last_ms)
+            if now_ms == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # Sequence exhausted for this millisecond, borrow the next one
+                    now_ms += 1
+            else:
+                self._sequence = 0
+            self._last_ms = now_ms
+            return (now_ms << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+
+def default_worker_id(shared_store: bool = False) -> int:
+    """
+    :param shared_store: Whether the tasks are kept in a store other processes may share. The process
+                         id cannot tell them apart then: in containers every orchestrator is PID 1.
+    :return: The worker id from ORCHESTRATOR_WORKER_ID, or one derived from the process id.
+    """
+    worker_id = os.getenv("ORCHESTRATOR_WORKER_ID")
+    if worker_id is not None:
+        return int(worker_id)
+    if shared_store:
+        raise ValueError("ORCHESTRATOR_WORKER_ID must be set when the task store is shared "
+                         f"(a different value between 0 and {MAX_WORKER_ID} for each orchestrator)")
+    return os.getpid() & MAX_WORKER_ID
@@ -0,0 +1,417 @@
+import bisect
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+FINISHED_STATUSES = ("completed", "failed", "cancelled")
+REMOVED_LOG_SIZE = 10000
+
+
+def _matches(task, status, microservice, created_after, created_before, after_id) -> bool:
+    if status is not None and task["status"] not in ((status,) if isinstance(status, str) else status):
+        return False
+    if microservice is not None and task["microservice"] != microservice:
+        return False
+    if created_after is not None and task["created_at"] < created_after:
+        return False
+    if created_before is not None and task["created_at"] >= created_before:
+        return False
+    if after_id is not None and task["task_id"] <= after_id:
+        return False
+    return True
+
+
+class TaskStore:
+    """
+    Base class of the task stores. A task is a JSON-serialisable dict identified by `task_id`.
+
+    Every method is thread-safe, and returns copies of the stored tasks so callers never
+    mutate the store without going through `update`.
+    """
+
+    def add(self, task: dict):
+        """
+        Store a new task.
+
+        :param task: The task record, must contain `task_id`, `microservice`, `status` and `created_at`.
+        :return: A copy of the stored task, with its `version`.
+        """
+        raise NotImplementedError
+
+    def add_many(self, tasks: list):
+        """
+        Store several new tasks at once.
+
+        :param tasks: The task records.
+        :return: Copies of the stored tasks, with their `version`.
+        """
+        return [self.add(task) for task in tasks]
+
+    def get(self, task_id: int):
+        """
+        :param task_id: Identifier of the task.
+        :return: A copy of the task, or None if it does not exist or was evicted.
+        """
+        raise NotImplementedError
+
+    def update(self, task_id: int, **fields):
+        """
+        Update some fields of a task.
+
+        :param task_id: Identifier of the task.
+        :param fields: Fields to set on the task record.
+        :return: A copy of the updated task, or None if it does not exist.
+        """
+        raise NotImplementedError
+
+    def list(self, status=None, microservice=None, created_after=None, created_before=None,
+             after_id=None, since_version=None, limit=None) -> list:
+        """
+        :param status: Only return tasks with this status (a string or a tuple of strings).
+        :param microservice: Only return tasks of this microservice.
+        :param created_after: Only return tasks created at or after this timestamp.
+        :param created_before: Only return tasks created before this timestamp.
+        :param after_id: Only return tasks with a greater task_id (pagination cursor).
+        :param since_version: Only return tasks changed after this store version.
+        :param limit: Maximum number of tasks to return.
+        :return: The matching tasks, ordered by task_id, or by version when `since_version` is given.
+        """
+        raise NotImplementedError
+
+    def version(self) -> int:
+        """
+        :return: The current store version. It increases on every change, and each task keeps
+                 the version of its last change in its `version` field.
+        """
+        raise NotImplementedError
+
+    def removed_since(self, since_version: int, until_version: int = None):
+        """
+        :param since_version: Store version known by the client, 0 if it has no task yet.
+        :param until_version: Only return the tasks removed up to this store version.
+        :return: The ids of the tasks removed after `since_version`, or None if the removal log
+                 no longer goes back that far and the client has to reload every task.
+        """
+        with self._lock:
+            if 0 < since_version < self._removed_floor:
+                return None
+            return [
+                task_id for version, task_id in self._removed
+                if version > since_version and (until_version is None or version <= until_version)
+            ]
+
+    def _log_removed(self, task_ids):
+        # Cada tasca esborrada fa avançar la versió, com qualsevol altre canvi
+        for task_id in task_ids:
+            if len(self._removed) == self._removed.maxlen:
+                self._removed_floor = self._removed[0][0]
+            self._version += 1
+            self._removed.append((self._version, task_id))
+
+    def evict_finished(self, ttl: float) -> int:
+        """
+        Delete the completed and failed tasks that finished more than `ttl` seconds ago.
+
+        :param ttl: Time to live of a finished task, in seconds.
+        :return: The number of evicted tasks.
+        """
+        raise NotImplementedError
+
+    def start_eviction(self, ttl: float, interval: float = 300):
+        """
+        Start a background thread that periodically evicts expired finished tasks.
+
+        :param ttl: Time to live of a finished task, in seconds.
+        :param interval: Seconds between two eviction passes.
+        """
+        def evict():
+            while True:
+                time.sleep(interval)
+                try:
+                    evicted = self.evict_finished(ttl)
+                    if evicted:
+                        logging.info(f"Evicted {evicted} finished tasks older than {ttl} s")
+                except Exception as e:
+                    logging.error(f"Error evicting finished tasks: {e}")
+
+        threading.Thread(target=evict, name="task-store-eviction", daemon=True).start()
+
+
+class MemoryTaskStore(TaskStore):
+    """
+    Keeps the tasks in a dict, with a secondary index on status, the task ids in order for
+    pagination, and the tasks in order of last change for the `since_version` queries.
+    Tasks are lost on restart.
+    """
+
+    def __init__(self):
+        self._tasks = {}
+        self._ids = []
+        self._by_status = {}
+        self._changes = OrderedDict()
+        self._version = 0
+        self._removed = deque(maxlen=REMOVED_LOG_SIZE)
+        self._removed_floor = 0
+        self._lock = threading.Lock()
+
+    def _index(self, task_id, old_status, new_status):
+        if old_status == new_status:
+            return
+        if old_status is not None:
+            self._by_status[old_status].discard(task_id)
+        self._by_status.setdefault(new_status, set()).add(task_id)
+
+    def _touch(self, task):
+        self._version += 1
+        task["version"] = self._version
+        self._changes[task["task_id"]] = self._version
+        self._changes.move_to_end(task["task_id"])
+
+    def add(self, task: dict):
+        with self._lock:
+            task = dict(task)
+            old = self._tasks.get(task["task_id"])
+            if old is None:
+                bisect.insort(self._ids, task["task_id"])
+            self._tasks[task["task_id"]] = task
+            self._index(task["task_id"], old["status"] if old else None, task["status"])
+            self._touch(task)
+            return dict(task)
+
+    def get(self, task_id: int):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            return dict(task) if task is not None else None
+
+    def update(self, task_id: int, **fields):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return None
+            old_status = task["status"]
+            task.update(fields)
+            self._index(task_id, old_status, task["status"])
+            self._touch(task)
+            return dict(task)
+
+    def list(self, status=None, microservice=None, created_after=None, created_before=None,
+             after_id=None, since_version=None, limit=None) -> list:
+        with self._lock:
+            if since_version is not None:
+                # Walk back the change log until the requested version: O(changes)
+                changed = []
+                for task_id in reversed(self._changes):
+                    if self._changes[task_id] <= since_version:
+                        break
+                    changed.append(task_id)
+                candidates = reversed(changed)
+            elif status is not None:
+                statuses = (status,) if isinstance(status, str) else status
+                candidates = sorted(i for s in statuses for i in self._by_status.get(s, ()))
+            else:
+                start = bisect.bisect_right(self._ids, after_id) if after_id is not None else 0
+                candidates = self._ids[start:]
+
+            result = []
+            for task_id in candidates:
+                task = self._tasks[task_id]
+                if _matches(task, status, microservice, created_after, created_before, after_id):
+                    result.append(dict(task))
+                    if limit is not None and len(result) >= limit:
+                        break
+        return result
+
+    def version(self) -> int:
+        with self._lock:
+            return self._version
+
+    def evict_finished(self, ttl: float) -> int:
+        limit = time.time() - ttl
+        with self._lock:
+            expired = [
+                task_id
+                for status in FINISHED_STATUSES
+                for task_id in self._by_status.get(status, ())
+                if self._tasks[task_id].get("completed_at", 0) < limit
+            ]
+            for task_id in expired:
+                task = self._tasks.pop(task_id)
+                self._by_status[task["status"]].discard(task_id)
+                self._changes.pop(task_id, None)
+                del self._ids[bisect.bisect_left(self._ids, task_id)]
+            self._log_removed(expired)
+        return len(expired)
+
+
+class SQLiteTaskStore(TaskStore):
+    """
+    Persists the tasks in a SQLite database in WAL mode, so they survive a restart.
+
+    The whole record is stored as JSON, and the fields used to filter are also kept in
+    indexed columns.
+    """
+
+    INSERT = (
+        "INSERT OR REPLACE INTO tasks (task_id, microservice, status, created_at, completed_at, version, record) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)"
+    )
+
+    def __init__(self, path: str):
+        """
+        Open (or create) the database.
+
+        :param path: Path of the SQLite database file.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id INTEGER PRIMARY KEY,
+                microservice TEXT NOT NULL,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                completed_at REAL,
+                version INTEGER NOT NULL,
+                record TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status);
+            CREATE INDEX IF NOT EXISTS idx_tasks_microservice ON tasks (microservice);
+            CREATE INDEX IF NOT EXISTS idx_tasks_created_at ON tasks (created_at);
+            CREATE INDEX IF NOT EXISTS idx_tasks_version ON tasks (version);
+            """
+        )
+        self._version = self._conn.execute("SELECT COALESCE(MAX(version), 0) FROM tasks").fetchone()[0]
+        # Les tasques esborrades abans d'obrir la base de dades no són al registre
+        self._removed = deque(maxlen=REMOVED_LOG_SIZE)
+        self._removed_floor = self._version
+
+    def _row(self, task: dict) -> tuple:
+        self._version += 1
+        task["version"] = self._version
+        return (
+            task["task_id"],
+            task["microservice"],
+            task["status"],
+            task["created_at"],
+            task.get("completed_at"),
+            task["version"],
+            json.dumps(task),
+        )
+
+    def _write(self, task: dict):
+        self._conn.execute(self.INSERT, self._row(task))
+
+    @staticmethod
+    def _load(row) -> dict:
+        task = json.loads(row[0])
+        task["version"] = row[1]
+        return task
+
+    def _read(self, task_id: int):
+        row = self._conn.execute("SELECT record, version FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return self._load(row) if row else None
+
+    def add(self, task: dict):
+        task = dict(task)
+        with self._lock:
+            self._write(task)
+        return task
+
+    def add_many(self, tasks: list):
+        tasks = [dict(task) for task in tasks]
+        with self._lock:
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.executemany(self.INSERT, [self._row(task) for task in tasks])
+        return tasks
+
+    def get(self, task_id: int):
+        with self._lock:
+            return self._read(task_id)
+
+    def update(self, task_id: int, **fields):
+        with self._lock:
+            task = self._read(task_id)
+            if task is None:
+                return None
+            task.update(fields)
+            self._write(task)
+            return task
+
+    def list(self, status=None, microservice=None, created_after=None, created_before=None,
+             after_id=None, since_version=None, limit=None) -> list:
+        query = "SELECT record, version FROM tasks"
+        conditions, params = [], []
+        if status is not None:
+            statuses = (status,) if isinstance(status, str) else tuple(status)
+            conditions.append(f"status IN ({', '.join('?' * len(statuses))})")
+            params.extend(statuses)
+        if microservice is not None:
+            conditions.append("microservice = ?")
+            params.append(microservice)
+        if created_after is not None:
+            conditions.append("created_at >= ?")
+            params.append(created_after)
+        if created_before is not None:
+            conditions.append("created_at < ?")
+            params.append(created_before)
+        if after_id is not None:
+            conditions.append("task_id > ?")
+            params.append(after_id)
+        if since_version is not None:
+            conditions.append("version > ?")
+            params.append(since_version)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY version" if since_version is not None else " ORDER BY task_id"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [self._load(row) for row in rows]
+
+    def version(self) -> int:
+        with self._lock:
+            return self._version
+
+    def evict_finished(self, ttl: float) -> int:
+        with self._lock:
+            with self._conn:
+                self._conn.execute("BEGIN IMMEDIATE")
+                expired = [row[0] for row in self._conn.execute(
+                    f"SELECT task_id FROM tasks WHERE status IN ({', '.join('?' * len(FINISHED_STATUSES))}) "
+                    "AND completed_at < ?",
+                    (*FINISHED_STATUSES, time.time() - ttl),
+                )]
+                self._conn.executemany("DELETE FROM tasks WHERE task_id = ?", [(task_id,) for task_id in expired])
+            self._log_removed(expired)
+            return len(expired)
+
+
+def create_task_store(backend: str, path: str = None) -> TaskStore:
+    """
+    Create the task store selected in the configuration.
+
+    :param backend: "memory" or "sqlite".
+    :param path: Path of the database file, required by the SQLite backend.
+    :return: The task store.
+    """
+    if backend == "memory":
+        return MemoryTaskStore()
+    if backend == "sqlite":
+        if not path:
+            raise ValueError("The SQLite task store requires a database path")
+        return SQLiteTaskStore(path)
+    raise ValueError(f"Unknown task store backend: {backend}")
@@ -0,0 +1,78 @@
+from flask import Flask, request, jsonify
+import os
+import logging
+
+from indexer import DicomIndex
+
+app = Flask(__name__)
+
+logging.basicConfig(level=logging.INFO)
+
+DICOM_DIR = os.getenv("DICOM_DIR", "/dicom")  # Directori on es guarden els DICOMs dins del contenidor
+
+# Índex SQLite dels DICOMs de DICOM_DIR, actualitzat cada SCAN_INTERVAL segons
+index = DicomIndex(DICOM_DIR, os.getenv("INDEX_PATH", "/index/dicom_index.db"))
+# Cada FULL_SCAN_EVERY escanejos, un de complet: troba els fitxers reescrits sense canviar la carpeta
+index.start_polling(float(os.getenv("SCAN_INTERVAL", 30)), int(os.getenv("FULL_SCAN_EVERY", 10)))
+
+
+@app.route('/files', methods=['GET'])
+def directory_files():
+    """
+    DICOM files of a folder (relative to DICOM_DIR, or absolute inside it), grouped by series
+    and ordered by slice position. The folder is refreshed first if it changed since the last scan.
+    """
+    directory = index.resolve(request.args.get('directory', ''))
+    if directory is None:
+        return jsonify({'error': "The directory is outside the DICOM folder"}), 400
+    if not index.refresh(directory):
+        return jsonify({'error': f"Directory not found: {directory}"}), 404
+    return jsonify({'directory': directory, 'files': index.directory_files(directory)}), 200
+
+
+@app.route('/series', methods=['GET'])
+def find_series():
+    """Series filtered by `patient_id`, `study_instance_uid` and `modality`."""
+    series = index.find_series(
+        request.args.get('patient_id'), request.args.get('study_instance_uid'), request.args.get('modality'),
+    )
+    return jsonify({'series': series}), 200
+
+
+@app.route('/series/<series_instance_uid>/files', methods=['GET'])
+def series_files(series_instance_uid):
+    files = index.series_files(series_instance_uid)
+    if not files:
+        return jsonify({'error': "Series not found"}), 404
+    return jsonify({'series_instance_uid': series_instance_uid, 'files': files}), 200
+
+
+@app.route('/studies', methods=['GET'])
+def find_studies():
+    return jsonify({'studies': index.find_studies(request.args.get('patient_id'))}), 200
+
+
+@app.route('/patients', methods=['GET'])
+def patients():
+    return jsonify({'patients': index.patients()}), 200
+
+
+@app.route('/scan', methods=['POST'])
+def scan():
+    """Bring the whole index up to date now; with ?full=1, also find files rewritten in place."""
+    full = request.args.get('full', '').lower() in ('1', 'true', 'yes')
+    return jsonify(index.scan(full=full)), 200
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify(index.stats()), 200
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({'status': 'ok'}), 200
+
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=5004)
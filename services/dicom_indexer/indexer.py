@@ -0,0 +1,391 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import pydicom
+from pydicom.errors import InvalidDicomError
+
+# Només es llegeixen aquests elements de la capçalera de cada fitxer
+TAGS = [
+    "PatientID", "PatientName", "PatientBirthDate",
+    "StudyInstanceUID", "StudyDate", "StudyDescription", "AccessionNumber",
+    "SeriesInstanceUID", "SeriesNumber", "SeriesDescription", "Modality",
+    "SOPInstanceUID", "InstanceNumber", "ImagePositionPatient", "ImageOrientationPatient", "SliceLocation",
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS directories_parent ON directories(parent);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sop_instance_uid TEXT,
+    series_instance_uid TEXT,
+    instance_number INTEGER,
+    slice_position REAL
+);
+CREATE INDEX IF NOT EXISTS files_directory ON files(directory);
+CREATE INDEX IF NOT EXISTS files_series ON files(series_instance_uid);
+CREATE TABLE IF NOT EXISTS series (
+    series_instance_uid TEXT PRIMARY KEY,
+    study_instance_uid TEXT,
+    modality TEXT,
+    series_number INTEGER,
+    series_description TEXT
+);
+CREATE INDEX IF NOT EXISTS series_study ON series(study_instance_uid);
+CREATE TABLE IF NOT EXISTS studies (
+    study_instance_uid TEXT PRIMARY KEY,
+    patient_id TEXT,
+    study_date TEXT,
+    study_description TEXT,
+    accession_number TEXT
+);
+CREATE INDEX IF NOT EXISTS studies_patient ON studies(patient_id);
+CREATE TABLE IF NOT EXISTS patients (
+    patient_id TEXT PRIMARY KEY,
+    patient_name TEXT,
+    birth_date TEXT
+);
+"""
+
+
+def _text(dataset, keyword):
+    value = dataset.get(keyword)
+    return str(value) if value is not None and str(value) != "" else None
+
+
+def _int(dataset, keyword):
+    try:
+        return int(dataset.get(keyword))
+    except (TypeError, ValueError):
+        return None
+
+
+def slice_position(dataset):
+    """
+    Position of a slice along the normal of its plane (ImagePositionPatient projected on the
+    cross product of ImageOrientationPatient), or SliceLocation if the geometry is missing.
+    """
+    try:
+        position = [float(v) for v in dataset.ImagePositionPatient]
+        orientation = [float(v) for v in dataset.ImageOrientationPatient]
+        row, column = orientation[:3], orientation[3:]
+        normal = (
+            row[1] * column[2] - row[2] * column[1],
+            row[2] * column[0] - row[0] * column[2],
+            row[0] * column[1] - row[1] * column[0],
+        )
+        return sum(p * n for p, n in zip(position, normal))
+    except (AttributeError, TypeError, ValueError, IndexError):
+        pass
+    try:
+        return float(dataset.SliceLocation)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def read_header(path: str):
+    """
+    Parse the indexed elements of a DICOM file, whatever its extension.
+
+    :return: The dataset, or None if the file is not DICOM.
+    """
+    try:
+        return pydicom.dcmread(path, stop_before_pixels=True, specific_tags=TAGS)
+    except (InvalidDicomError, EOFError, OSError):
+        return None
+
+
+class DicomIndex:
+    """
+    SQLite index of the DICOM files under a root folder: patients, studies, series and
+    instances with their file paths and slice positions.
+
+    Scans are incremental. A quick scan only lists the folders whose modification time
+    changed, so it finds files added, removed or renamed. A file rewritten in place does not
+    change its folder, so a full scan lists every folder and compares the modification time
+    and size of each file. Either way only new or modified files are parsed, reading just the
+    indexed header elements. Files that are not DICOM are remembered too, so they are not
+    parsed again.
+    Hidden files and folders (such as the PACS cache `.partial` folder) are ignored.
+    """
+
+    def __init__(self, root: str, path: str):
+        """
+        Open (or create) the index.
+
+        :param root: The folder to index.
+        :param path: Path of the SQLite database file.
+        """
+        self.root = os.path.abspath(root)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self.last_scan = None
+
+    def scan(self, full: bool = False) -> dict:
+        """
+        Bring the whole index up to date.
+
+        :param full: List every folder, also the unchanged ones, to find files rewritten in place.
+        :return: Number of folders listed, files parsed and files removed.
+        """
+        stats = {"directories": 0, "parsed": 0, "removed": 0}
+        started = time.time()
+        pending = [self.root]
+        while pending:
+            pending.extend(self._scan_directory(pending.pop(), stats, full))
+        with self._lock:
+            self._remove_orphans()
+        self.last_scan = {"at": started, "seconds": round(time.time() - started, 3), "full": full, **stats}
+        return stats
+
+    def refresh(self, directory: str) -> bool:
+        """
+        Bring one folder (not its subfolders) up to date, e.g. just before it is queried.
+
+        :return: False if the folder does not exist.
+        """
+        stats = {"directories": 0, "parsed": 0, "removed": 0}
+        exists = os.path.isdir(directory)
+        self._scan_directory(directory, stats)
+        if stats["removed"]:
+            with self._lock:
+                self._remove_orphans()
+        return exists
+
+    def start_polling(self, interval: float, full_every: int = 10):
+        """
+        Scan the root folder every `interval` seconds in a background thread.
+
+        :param full_every: Every how many scans one is a full scan (0 for never).
+        """
+        def run():
+            scans = 0
+            while True:
+                try:
+                    stats = self.scan(full=full_every > 0 and scans % full_every == 0)
+                    scans += 1
+                    if stats["parsed"] or stats["removed"]:
+                        logging.info(f"DICOM index updated: {stats}")
+                except Exception:
+                    logging.exception("Error scanning the DICOM folder")
+                time.sleep(interval)
+
+        threading.Thread(target=run, name="dicom-index-scan", daemon=True).start()
+
+    def resolve(self, directory: str):
+        """
+        :param directory: A folder relative to the root, or an absolute path inside it.
+        :return: Its absolute path, or None if it is outside the root.
+        """
+        path = os.path.abspath(os.path.join(self.root, directory))
+        if path != self.root and not path.startswith(self.root + os.sep):
+            return None
+        return path
+
+    def _scan_directory(self, path: str, stats: dict, full: bool = False) -> list:
+        """
+        Update the files of one folder if it changed, or always with `full`. Returns its subfolders.
+        """
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            with self._lock:
+                stats["removed"] += self._forget_directory(path)
+            return []
+
+        with self._lock:
+            row = self._conn.execute("SELECT mtime_ns FROM directories WHERE path = ?", (path,)).fetchone()
+            known_subdirs = [r[0] for r in self._conn.execute("SELECT path FROM directories WHERE parent = ?", (path,))]
+        if not full and row is not None and row[0] == mtime_ns:
+            return known_subdirs
+
+        stats["directories"] += 1
+        subdirs, files = [], {}
+        for entry in os.scandir(path):
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file():
+                stat = entry.stat()
+                files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            known = {
+                r[0]: (r[1], r[2])
+                for r in self._conn.execute("SELECT path, mtime_ns, size FROM files WHERE directory = ?", (path,))
+            }
+        changed = [p for p, signature in files.items() if known.get(p) != signature]
+        headers = [(p, read_header(p)) for p in changed]  # Fora del lock: és la part lenta
+
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for file_path, dataset in headers:
+                    self._store_file(file_path, path, files[file_path], dataset)
+                removed = [p for p in known if p not in files]
+                self._conn.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in removed])
+                for subdir in set(known_subdirs) - set(subdirs):
+                    stats["removed"] += self._forget_directory(subdir)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO directories (path, parent, mtime_ns) VALUES (?, ?, ?)",
+                    (path, os.path.dirname(path) if path != self.root else None, mtime_ns),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        stats["parsed"] += len(headers)
+        stats["removed"] += len(removed)
+        return subdirs
+
+    def _store_file(self, path: str, directory: str, signature: tuple, dataset):
+        mtime_ns, size = signature
+        if dataset is None or _text(dataset, "SeriesInstanceUID") is None:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (path, directory, mtime_ns, size) VALUES (?, ?, ?, ?)",
+                (path, directory, mtime_ns, size),
+            )
+            return
+        series_uid = _text(dataset, "SeriesInstanceUID")
+        study_uid = _text(dataset, "StudyInstanceUID")
+        patient_id = _text(dataset, "PatientID")
+        self._conn.execute(
+            "INSERT OR REPLACE INTO files (path, directory, mtime_ns, size, sop_instance_uid, series_instance_uid, "
+            "instance_number, slice_position) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, directory, mtime_ns, size, _text(dataset, "SOPInstanceUID"), series_uid,
+             _int(dataset, "InstanceNumber"), slice_position(dataset)),
+        )
+        self._conn.execute(
+            "INSERT OR REPLACE INTO series (series_instance_uid, study_instance_uid, modality, series_number, "
+            "series_description) VALUES (?, ?, ?, ?, ?)",
+            (series_uid, study_uid, _text(dataset, "Modality"), _int(dataset, "SeriesNumber"),
+             _text(dataset, "SeriesDescription")),
+        )
+        if study_uid is not None:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO studies (study_instance_uid, patient_id, study_date, study_description, "
+                "accession_number) VALUES (?, ?, ?, ?, ?)",
+                (study_uid, patient_id, _text(dataset, "StudyDate"), _text(dataset, "StudyDescription"),
+                 _text(dataset, "AccessionNumber")),
+            )
+        if patient_id is not None:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO patients (patient_id, patient_name, birth_date) VALUES (?, ?, ?)",
+                (patient_id, _text(dataset, "PatientName"), _text(dataset, "PatientBirthDate")),
+            )
+
+    def _forget_directory(self, path: str) -> int:
+        """
+        Drop a folder that no longer exists, its subfolders and their files.
+        """
+        pattern = path.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + os.sep + "%"
+        removed = self._conn.execute(
+            "DELETE FROM files WHERE directory = ? OR directory LIKE ? ESCAPE '\\'", (path, pattern)
+        ).rowcount
+        self._conn.execute("DELETE FROM directories WHERE path = ? OR path LIKE ? ESCAPE '\\'", (path, pattern))
+        return removed
+
+    def _remove_orphans(self):
+        self._conn.execute(
+            "DELETE FROM series WHERE series_instance_uid NOT IN "
+            "(SELECT series_instance_uid FROM files WHERE series_instance_uid IS NOT NULL)"
+        )
+        self._conn.execute(
+            "DELETE FROM studies WHERE study_instance_uid NOT IN "
+            "(SELECT study_instance_uid FROM series WHERE study_instance_uid IS NOT NULL)"
+        )
+        self._conn.execute(
+            "DELETE FROM patients WHERE patient_id NOT IN (SELECT patient_id FROM studies WHERE patient_id IS NOT NULL)"
+        )
+
+    def _query(self, sql: str, params=()) -> list:
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor]
+
+    def directory_files(self, directory: str) -> list:
+        """
+        :param directory: Absolute path of a folder.
+        :return: Its DICOM files, grouped by series and ordered by slice position.
+        """
+        return self._query(
+            "SELECT path, series_instance_uid, sop_instance_uid, instance_number, slice_position FROM files "
+            "WHERE directory = ? AND series_instance_uid IS NOT NULL "
+            "ORDER BY series_instance_uid, slice_position, instance_number, path",
+            (directory,),
+        )
+
+    def series_files(self, series_instance_uid: str) -> list:
+        """
+        :return: The files of a series, ordered by slice position.
+        """
+        return self._query(
+            "SELECT path, sop_instance_uid, instance_number, slice_position FROM files "
+            "WHERE series_instance_uid = ? ORDER BY slice_position, instance_number, path",
+            (series_instance_uid,),
+        )
+
+    def find_series(self, patient_id: str = None, study_instance_uid: str = None, modality: str = None) -> list:
+        """
+        :return: The series matching every given filter, with their study, patient and number of instances.
+        """
+        conditions, params = [], []
+        for column, value in (("st.patient_id", patient_id), ("s.study_instance_uid", study_instance_uid),
+                              ("s.modality", modality)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self._query(
+            "SELECT s.series_instance_uid, s.study_instance_uid, st.patient_id, s.modality, s.series_number, "
+            "s.series_description, (SELECT COUNT(*) FROM files f WHERE f.series_instance_uid = s.series_instance_uid) "
+            "AS instances, (SELECT MIN(directory) FROM files f WHERE f.series_instance_uid = s.series_instance_uid) "
+            f"AS directory FROM series s LEFT JOIN studies st ON st.study_instance_uid = s.study_instance_uid {where} "
+            "ORDER BY st.patient_id, s.study_instance_uid, s.series_number",
+            params,
+        )
+
+    def find_studies(self, patient_id: str = None) -> list:
+        """
+        :return: The studies, optionally of one patient, with their number of series.
+        """
+        where, params = ("WHERE st.patient_id = ?", (patient_id,)) if patient_id is not None else ("", ())
+        return self._query(
+            "SELECT st.*, (SELECT COUNT(*) FROM series s WHERE s.study_instance_uid = st.study_instance_uid) AS series "
+            f"FROM studies st {where} ORDER BY st.patient_id, st.study_date",
+            params,
+        )
+
+    def patients(self) -> list:
+        return self._query("SELECT * FROM patients ORDER BY patient_id")
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = {
+                table: self._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                for table in ("patients", "studies", "series", "directories")
+            }
+            counts["instances"] = self._conn.execute(
+                "SELECT COUNT(*) FROM files WHERE series_instance_uid IS NOT NULL"
+            ).fetchone()[0]
+            counts["files"] = self._conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        counts["last_scan"] = self.last_scan
+        return counts
@@ -1,20 +1,120 @@
 from flask import Flask, request, jsonify
-import time
+from collections import OrderedDict
+import threading
+import uuid
 import logging
+import requests
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# Jobs asíncrons: job_id -> estat, es guarden els últims MAX_JOBS
+MAX_JOBS = 1000
+jobs = OrderedDict()
+jobs_lock = threading.Lock()
+
+# Tasques en curs: X-Task-ID de l'orquestrador -> Event que s'activa en cancel·lar-la
+cancel_events = {}
+
+
+class Cancelled(Exception):
+    pass
+
+
+def register_task(task_id):
+    """Return the cancel event of a task, registered while it runs."""
+    cancelled = threading.Event()
+    if task_id:
+        with jobs_lock:
+            cancel_events[task_id] = cancelled
+    return cancelled
+
+
+def unregister_task(task_id):
+    with jobs_lock:
+        cancel_events.pop(task_id, None)
+
+
+def work(data, cancelled):
+    if cancelled.wait(8):  # Simula temps de processament
+        raise Cancelled()
+    return 'success'
+
+
+def run_job(job_id, data, callback_url, task_id, cancelled):
+    """Run an asynchronous job and notify the orchestrator when it finishes."""
+    try:
+        outcome = {'status': 'success', 'result': work(data, cancelled)}
+    except Cancelled:
+        outcome = {'status': 'cancelled'}
+    except Exception as e:
+        logging.error(f"Error in dummy service job {job_id}: {e}")
+        outcome = {'status': 'failed', 'error': str(e)}
+    unregister_task(task_id)
+    with jobs_lock:
+        jobs[job_id] = outcome
+    try:
+        requests.post(callback_url, json=dict(outcome, job_id=job_id), timeout=10)
+    except Exception as e:
+        # L'orquestrador consultarà /jobs/<job_id> si no rep el callback
+        logging.error(f"Error notifying job {job_id} to {callback_url}: {e}")
+
+
 @app.route('/run', methods=['POST'])
 def predict():
     try:
         logging.info("Dummy service received a request")
         logging.info(f"Request data: {request.json}")
-        time.sleep(8)  # Simula temps de processament
-        return jsonify({'result': 'success'}), 200
+        callback_url = request.headers.get('X-Callback-URL')
+        task_id = request.headers.get('X-Task-ID')
+        cancelled = register_task(task_id)
+        if callback_url:
+            # Mode asíncron: respon de seguida i notifica el final al callback
+            job_id = uuid.uuid4().hex
+            with jobs_lock:
+                jobs[job_id] = {'status': 'running'}
+                while len(jobs) > MAX_JOBS:
+                    jobs.popitem(last=False)
+            threading.Thread(
+                target=run_job, args=(job_id, request.json, callback_url, task_id, cancelled), daemon=True
+            ).start()
+            return jsonify({'job_id': job_id, 'status': 'accepted'}), 202
+        try:
+            return jsonify({'result': work(request.json, cancelled)}), 200
+        finally:
+            unregister_task(task_id)
+    except Cancelled:
+        return jsonify({'status': 'cancelled'}), 409
     except Exception as e:
         logging.error(f"Error in dummy service: {e}")
         return jsonify({'error': str(e)}), 500
 
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(dict(job, job_id=job_id)), 200
+
+
+@app.route('/cancel', methods=['POST'])
+def cancel():
+    """Stop a running task, identified by the X-Task-ID it was sent with."""
+    task_id = str((request.get_json(silent=True) or {}).get('task_id'))
+    with jobs_lock:
+        cancelled = cancel_events.get(task_id)
+    if cancelled is None:
+        return jsonify({'error': 'Task not running'}), 404
+    cancelled.set()
+    return jsonify({'task_id': task_id, 'status': 'cancelling'}), 202
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({'status': 'ok'}), 200
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5001)
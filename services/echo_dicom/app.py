@@ -1,41 +1,171 @@
 from flask import Flask, request, jsonify
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import pydicom
+import requests
 
 app = Flask(__name__)
 
-@app.route('/run', methods=['POST'])
-def run():
-    """Receive a request with a series path, read the first DICOM file, and return its metadata."""
-    data = request.json
+# Els elements més grans que això no es llegeixen del disc: es retornen com "<deferred: N bytes>"
+DEFER_SIZE = os.getenv("DEFER_SIZE", "64 KB")
+# Metadades de les últimes METADATA_CACHE_SIZE sèries, invalidades si canvia la carpeta o el fitxer llegit
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", 1024))
+# Threads que llegeixen les sèries d'una petició /run/batch, i màxim de sèries per petició
+READ_WORKERS = int(os.getenv("READ_WORKERS", 8))
+MAX_BATCH = int(os.getenv("MAX_BATCH", 1000))
+
+# Servei dicom_indexer: si està configurat, dona els fitxers de cada sèrie sense escanejar el directori
+DICOM_INDEX_URL = os.getenv("DICOM_INDEX_URL")
+
+read_pool = ThreadPoolExecutor(READ_WORKERS, thread_name_prefix="dicom-read")
+
+
+class MetadataCache:
+    """
+    LRU cache of the metadata of each series, keyed by its path. An entry is only used while
+    the modification times of the series folder and of the file it was read from are unchanged,
+    which costs two stat calls instead of listing the folder and parsing the file.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, series_path: str):
+        with self._lock:
+            entry = self._entries.get(series_path)
+        if entry is not None:
+            try:
+                current = (os.stat(series_path).st_mtime_ns, os.stat(entry["file"]).st_mtime_ns)
+            except OSError:
+                current = None
+            if current == entry["mtimes"]:
+                with self._lock:
+                    self._entries.move_to_end(series_path)
+                    self.hits += 1
+                return entry["metadata"]
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, series_path: str, dicom_path: str, mtimes: tuple, metadata: dict):
+        with self._lock:
+            self._entries[series_path] = {"file": dicom_path, "mtimes": mtimes, "metadata": metadata}
+            self._entries.move_to_end(series_path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+metadata_cache = MetadataCache(METADATA_CACHE_SIZE)
+
+
+def read_metadata(dicom_path):
+    """
+    Read the header of a DICOM file, without its pixel data, and stringify its elements.
+    Elements larger than DEFER_SIZE are not read.
+    """
+    dicom_data = pydicom.dcmread(dicom_path, stop_before_pixels=True, defer_size=DEFER_SIZE)
+    metadata = {}
+    for elem in dicom_data.elements():
+        if elem.tag == (0x7FE0, 0x0010):
+            continue
+        if elem.value is None and elem.length:  # Element diferit: no el llegim
+            metadata[elem.tag] = f"<deferred: {elem.length} bytes>"
+        else:
+            metadata[elem.tag] = str(dicom_data[elem.tag].value)
+    return metadata
 
-    # Ensure the request contains "series_path"
-    series_path = data.get("series_path")
+
+def series_files(series_path):
+    """
+    Names of the DICOM files of a series, from the dicom_indexer service if it is configured
+    (it also finds files without the .dcm extension), or from a directory scan.
+    """
+    if DICOM_INDEX_URL:
+        try:
+            response = requests.get(f"{DICOM_INDEX_URL}/files", params={"directory": series_path}, timeout=5)
+            if response.status_code == 200:
+                return [os.path.basename(f["path"]) for f in response.json()["files"]]
+        except (requests.RequestException, ValueError, KeyError):
+            pass
+    return [f for f in os.listdir(series_path) if f.lower().endswith(".dcm")]
+
+
+def series_metadata(series_path):
+    """
+    Metadata of the first DICOM file of a series, from the cache if the series did not change.
+    Returns the response body and its HTTP status.
+    """
     if not series_path:
-        return jsonify({'error': "Missing 'series_path' in request data"}), 400
+        return {'error': "Missing 'series_path' in request data"}, 400
+
+    metadata = metadata_cache.get(series_path)
+    if metadata is not None:
+        return {'metadata': metadata}, 200
 
     # Validate that the directory exists
     if not os.path.isdir(series_path):
-        return jsonify({'error': f"Series path not found: {series_path}"}), 404
+        return {'error': f"Series path not found: {series_path}"}, 404
 
     # Find the first DICOM file in the directory
-    dicom_files = sorted([f for f in os.listdir(series_path) if f.lower().endswith(".dcm")])
+    dicom_files = sorted(series_files(series_path))
     if not dicom_files:
-        return jsonify({'error': "No DICOM files found in the series directory"}), 404
+        return {'error': "No DICOM files found in the series directory"}, 404
 
     dicom_path = os.path.join(series_path, dicom_files[0])
 
     try:
-        # Read the DICOM file
-        dicom_data = pydicom.dcmread(dicom_path)
+        # Modification times before reading, so a change during the read invalidates the entry
+        mtimes = (os.stat(series_path).st_mtime_ns, os.stat(dicom_path).st_mtime_ns)
+        metadata = read_metadata(dicom_path)
+    except Exception as e:
+        return {'error': f"Failed to read DICOM: {str(e)}"}, 500
 
-        # Extract metadata (excluding pixel data)
-        metadata = {tag: str(dicom_data[tag].value) for tag in dicom_data.keys() if tag != (0x7FE0, 0x0010)}
+    metadata_cache.put(series_path, dicom_path, mtimes, metadata)
+    return {'metadata': metadata}, 200
 
-        return jsonify({'metadata': metadata}), 200
 
-    except Exception as e:
-        return jsonify({'error': f"Failed to read DICOM: {str(e)}"}), 500
+@app.route('/run', methods=['POST'])
+def run():
+    """Receive a request with a series path, read the first DICOM file, and return its metadata."""
+    data = request.json
+    body, status = series_metadata(data.get("series_path"))
+    return jsonify(body), status
+
+@app.route('/run/batch', methods=['POST'])
+def run_batch():
+    """
+    Return the metadata of many series in one call: {"series_paths": [...]}. The series are read
+    in parallel, and each result carries its own status, so one bad path does not fail the batch.
+    """
+    series_paths = (request.get_json(silent=True) or {}).get("series_paths")
+    if not isinstance(series_paths, list):
+        return jsonify({'error': "Missing 'series_paths' list in request data"}), 400
+    if len(series_paths) > MAX_BATCH:
+        return jsonify({'error': f"At most {MAX_BATCH} series per request"}), 400
+
+    results = []
+    for series_path, (body, status) in zip(series_paths, read_pool.map(series_metadata, series_paths)):
+        results.append(dict(body, series_path=series_path, status=status))
+    return jsonify({'results': results}), 200
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(metadata_cache.stats()), 200
+
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({'status': 'ok'}), 200
+
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5003)
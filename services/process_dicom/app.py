@@ -1,15 +1,33 @@
 from flask import Flask, request, jsonify
-import pydicom
-import numpy as np
 import os
 import logging
+import threading
 import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from series_reader import ReadCancelled, indexed_dicom_files, list_dicom_files, mean_pixel_value
 
 app = Flask(__name__)
 DICOM_DIR = "/dicom"  # Directori on es guarden els DICOMs dins del contenidor
 
 logging.basicConfig(level=logging.INFO)
 
+# Pool compartit que descodifica els fitxers DICOM: READ_WORKERS threads, o processos amb
+# READ_PROCESSES=1 (per a sèries comprimides). Cada petició llegeix com a molt READ_WINDOW fitxers alhora
+READ_WORKERS = int(os.getenv("READ_WORKERS", os.cpu_count() or 4))
+READ_WINDOW = int(os.getenv("READ_WINDOW", 2 * READ_WORKERS))
+if os.getenv("READ_PROCESSES") == "1":
+    read_pool = ProcessPoolExecutor(READ_WORKERS)
+else:
+    read_pool = ThreadPoolExecutor(READ_WORKERS, thread_name_prefix="dicom-read")
+
+# Servei dicom_indexer: si està configurat, dona els fitxers de cada sèrie sense escanejar el directori
+DICOM_INDEX_URL = os.getenv("DICOM_INDEX_URL")
+
+# Tasques en curs: X-Task-ID de l'orquestrador -> Event que s'activa en cancel·lar-la
+cancel_events = {}
+cancel_lock = threading.Lock()
+
 @app.route('/run', methods=['POST'])
 def process_dicom():
     logging.info("Process service received a request")
@@ -27,30 +45,60 @@ def process_dicom():
         logging.info(f"directory field not found: {dicom_dir}")
         return jsonify({"status": "failed", "message": "Directory not found"}), 404
 
+    task_id = request.headers.get('X-Task-ID')
+    cancelled = threading.Event()
+    if task_id:
+        with cancel_lock:
+            cancel_events[task_id] = cancelled
     try:
         # Processar tots els fitxers dins del directori
-        dicom_files = [f for f in os.listdir(dicom_dir) if f.lower().endswith('.dcm')]
+        dicom_files = None
+        if DICOM_INDEX_URL:
+            dicom_files = indexed_dicom_files(DICOM_INDEX_URL, dicom_dir)
+        if dicom_files is None:  # Sense índex, o no respon
+            dicom_files = list_dicom_files(dicom_dir)
         if not dicom_files:
             logging.info(f"No DICOM files found in directory: {dicom_dir}")
             return jsonify({"status": "failed", "message": "No DICOM files found in directory"}), 404
         
         logging.info(f"reading files: {dicom_dir}")
-        pixel_values = []
-        for dicom_file in dicom_files:
-            dicom_path = os.path.join(dicom_dir, dicom_file)
-            dicom_data = pydicom.dcmread(dicom_path)
-            pixel_array = dicom_data.pixel_array.astype(np.float32)
-            pixel_values.append(np.mean(pixel_array))
-
-        # Calcular la mitjana de tots els píxels
-        mean_pixel_value = float(np.mean(pixel_values))
-        logging.info(f"returning mean value: {mean_pixel_value}")
-        return jsonify({"status": "success", "result": mean_pixel_value}), 200
+        # Mitjana de les mitjanes de cada fitxer, llegits en paral·lel
+        mean_value = mean_pixel_value(dicom_files, read_pool, READ_WINDOW, should_cancel=cancelled.is_set)
+        if mean_value is None:
+            logging.info(f"No DICOM images found in directory: {dicom_dir}")
+            return jsonify({"status": "failed", "message": "No DICOM images found in directory"}), 404
+        logging.info(f"returning mean value: {mean_value}")
+        return jsonify({"status": "success", "result": mean_value}), 200
+
+    except ReadCancelled:
+        logging.info(f"Task {task_id} cancelled")
+        return jsonify({"status": "cancelled"}), 409
 
     except Exception as e:
         error_trace = traceback.format_exc()  # ⬅️ Captura el error detallado
         logging.error(f"❌ Error in process_dicom:\n{error_trace}")  # ⬅️ Muestra el error
         return jsonify({"error": str(e)}), 500
-    
+    finally:
+        with cancel_lock:
+            cancel_events.pop(task_id, None)
+
+
+@app.route('/cancel', methods=['POST'])
+def cancel():
+    """Stop a running task, identified by the X-Task-ID it was sent with."""
+    task_id = str((request.get_json(silent=True) or {}).get('task_id'))
+    with cancel_lock:
+        cancelled = cancel_events.get(task_id)
+    if cancelled is None:
+        return jsonify({"error": "Task not running"}), 404
+    cancelled.set()
+    return jsonify({"task_id": task_id, "status": "cancelling"}), 202
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({"status": "ok"}), 200
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5002)
\ No newline at end of file
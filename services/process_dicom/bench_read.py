@@ -0,0 +1,106 @@
+"""
+Reading time and peak memory of process_dicom on a synthetic CT series.
+
+Compares the previous serial loop (full dcmread, float32 copy of every image, list of means)
+with the series reader using thread and process pools of several sizes. The series is
+written once to a temporary folder: SLICES images of SIZE x SIZE int16 pixels.
+
+Run from the services/process_dicom folder:  python bench_read.py [slices]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pydicom
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from series_reader import list_dicom_files, mean_pixel_value
+
+SLICES = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+SIZE = 512
+
+
+def write_series(directory, slices):
+    series_uid = generate_uid()
+    rng = np.random.default_rng(0)
+    for i in range(slices):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.2"  # CT Image Storage
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        path = os.path.join(directory, f"{i:05d}.dcm")
+        ds = FileDataset(path, {}, file_meta=meta, preamble=b"\0" * 128)
+        ds.SOPClassUID = meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.SeriesInstanceUID = series_uid
+        ds.Modality = "CT"
+        ds.InstanceNumber = i + 1
+        ds.Rows = ds.Columns = SIZE
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.PixelData = rng.integers(-1024, 3000, (SIZE, SIZE), dtype=np.int16).tobytes()
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.save_as(path, write_like_original=False)
+
+
+def serial_mean(directory):
+    """
+    The previous implementation of /run.
+    """
+    pixel_values = []
+    for dicom_file in [f for f in os.listdir(directory) if f.lower().endswith('.dcm')]:
+        dicom_data = pydicom.dcmread(os.path.join(directory, dicom_file))
+        pixel_array = dicom_data.pixel_array.astype(np.float32)
+        pixel_values.append(np.mean(pixel_array))
+    return float(np.mean(pixel_values))
+
+
+def measure(function, repeat=3):
+    """
+    Best time of `repeat` runs, and the peak memory of another run (tracemalloc slows it down).
+    """
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = function()
+        elapsed.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return value, min(elapsed), peak
+
+
+def main():
+    directory = tempfile.mkdtemp(prefix="bench-read-")
+    write_series(directory, SLICES)
+    print(f"{SLICES} slices of {SIZE}x{SIZE} int16 ({os.cpu_count()} CPUs), best of 3 runs, "
+          f"peak = traced Python allocations\n")
+    print(f"{'reader':>16} {'seconds':>8} {'slices/s':>9} {'peak MB':>8} {'mean':>12}")
+
+    serial_mean(directory)  # Escalfa la cache de pàgines
+    value, elapsed, peak = measure(lambda: serial_mean(directory))
+    print(f"{'serial float32':>16} {elapsed:>8.2f} {SLICES / elapsed:>9.0f} {peak / 2**20:>8.1f} {value:>12.4f}")
+
+    for kind, pool_class in (("threads", ThreadPoolExecutor), ("processes", ProcessPoolExecutor)):
+        for workers in (1, 4, 8):
+            with pool_class(workers) as pool:
+                value, elapsed, peak = measure(
+                    lambda: mean_pixel_value(list_dicom_files(directory), pool, 2 * workers)
+                )
+            label = f"{workers} {kind}"
+            print(f"{label:>16} {elapsed:>8.2f} {SLICES / elapsed:>9.0f} {peak / 2**20:>8.1f} {value:>12.4f}")
+
+
+if __name__ == "__main__":
+    main()
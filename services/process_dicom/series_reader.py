@@ -0,0 +1,100 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import numpy as np
+import pydicom
+import requests
+
+class ReadCancelled(Exception):
+    """
+    Raised when the task reading the series is cancelled.
+    """
+
+
+def list_dicom_files(directory: str) -> list:
+    """
+    List the DICOM files of a series folder with a single directory scan.
+
+    :param directory: The folder of the series.
+    :return: The paths of its .dcm files.
+    """
+    return [
+        entry.path for entry in os.scandir(directory)
+        if entry.is_file() and entry.name.lower().endswith('.dcm')
+    ]
+
+
+def indexed_dicom_files(index_url: str, directory: str):
+    """
+    Ask the dicom_indexer service for the DICOM files of a series folder. Unlike the directory
+    scan it also finds files without the .dcm extension, and their headers were parsed once.
+
+    :param index_url: Base URL of the dicom_indexer service.
+    :param directory: The folder of the series.
+    :return: The paths of its DICOM files, or None if the indexer could not answer.
+    """
+    try:
+        response = requests.get(f"{index_url}/files", params={"directory": directory}, timeout=5)
+        if response.status_code != 200:
+            return None
+        return [f["path"] for f in response.json()["files"]]
+    except (requests.RequestException, ValueError, KeyError):
+        return None
+
+
+def slice_sum(path: str):
+    """
+    Sum the pixels of one DICOM file.
+
+    The header is checked before decoding, so files without pixels (reports, presentation
+    states) are skipped instead of failing the series. The pixels are summed in their stored
+    type with a 64-bit accumulator (exact for integer images), without a float32 copy.
+
+    :param path: The DICOM file.
+    :return: The sum and the number of pixels, or None if the file has no pixel data.
+    """
+    dataset = pydicom.dcmread(path)
+    if 'PixelData' not in dataset:
+        return None
+    pixels = dataset.pixel_array
+    accumulator = np.int64 if np.issubdtype(pixels.dtype, np.integer) else np.float64
+    return float(pixels.sum(dtype=accumulator)), pixels.size
+
+
+def mean_pixel_value(paths: list, executor, window: int, should_cancel=None):
+    """
+    Mean of the per-file mean pixel values of a series, decoding the files in parallel.
+
+    At most `window` files are read at a time, so memory does not grow with the length of the
+    series: each file is reduced to its sum and pixel count as soon as it is decoded.
+
+    :param paths: The DICOM files of the series.
+    :param executor: The thread or process pool that decodes the files (a process pool suits
+                     compressed series whose decoders hold the GIL).
+    :param window: Maximum number of files read at a time.
+    :param should_cancel: Callable checked as files complete; raises ReadCancelled when it returns True.
+    :return: The mean value, or None if no file has pixel data.
+    """
+    total, count = 0.0, 0
+    pending = set()
+    files = iter(paths)
+    try:
+        while True:
+            for path in files:
+                pending.add(executor.submit(slice_sum, path))
+                if len(pending) >= window:
+                    break
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if result is not None and result[1]:
+                    total += result[0] / result[1]
+                    count += 1
+            if should_cancel is not None and should_cancel():
+                raise ReadCancelled()
+    finally:
+        for future in pending:
+            future.cancel()
+    return total / count if count else None
@@ -1,98 +1,377 @@
 import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import torch
 import warnings
-from modules.nnUNet.nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from modules.nnUNet.nnunetv2.inference.predict_from_raw_data import nnUNetPredictor, PredictionCancelled
+from modules.nnUNet.nnunetv2.inference.export_prediction import convert_predicted_logits_to_segmentation_with_correct_shape
+from modules.nnUNet.nnunetv2.utilities.label_handling.label_handling import determine_num_input_channels
 import logging
 import nibabel as nib
+import numpy as np
 import shutil
-from utils.image import DICOMProcessor
+from utils.image import DICOMProcessor, save_segmentation
 
-def delete_folder_contents(folder_path):
+# Configuración para reducir los mensajes de advertencia y texto innecesario (una sola vez, al importar)
+logging.basicConfig(level=logging.ERROR)  # Solo mostrar errores importantes
+logging.getLogger("nnunetv2").setLevel(logging.ERROR)
+warnings.filterwarnings("ignore", category=FutureWarning)  # Ignorar FutureWarnings
+warnings.filterwarnings("ignore", module="timm")  # Ignorar advertencias de timm
+warnings.filterwarnings("ignore", module="tqdm")
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"  # Reducir verbosidad de TensorFlow si está presente
+
+torch.multiprocessing.set_start_method('spawn', force=True)
+# Definir variables de entorno para evitar errores
+os.environ["nnUNet_raw"] = os.getenv("NNUNET_RAW", "/app/modules/Model/nnUNet_raw")
+os.environ["nnUNet_preprocessed"] = os.getenv("NNUNET_PREPROCESSED", "/app/modules/Model/nnUNet_preprocessed")
+os.environ["nnUNet_results"] = os.getenv("NNUNET_RESULTS", "/app/modules/Model/nnUNet_results")
+
+# Model entrenat: es carrega una sola vegada i es recarrega si canvia el checkpoint
+TRAINED_MODEL_DIR = os.getenv(
+    "TRAINED_MODEL_DIR",
+    "/app/modules/Model/nnUNet_results/nnUNetTrainer_CE_DC_CLDC__nnUNetResEncUNetMPlans__3d_lowres"
+)
+CHECKPOINT_NAME = os.getenv("CHECKPOINT_NAME", "checkpoint_final.pth")
+DEVICE = os.getenv("DEVICE", "cuda")
+# Predicció d'un patch buit en carregar el model: mou els pesos al dispositiu i tria els algorismes de cuDNN
+WARMUP = os.getenv("MODEL_WARMUP", "1").lower() in ("1", "true", "yes")
+
+# Cada segmentació pel camí de fitxers té la seva carpeta temporal aquí, amb IN i OUT, esborrada en acabar
+WORKSPACE_DIR = os.getenv("WORKSPACE_DIR", "/app/work")
+
+# Les segmentacions en memòria s'escriuen a disc en segon pla, si es demana, sense fer esperar la resposta
+export_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="segmentation-export")
+
+class WarmPredictor:
     """
-    Deletes all files and subfolders inside the specified folder.
+    A long-lived nnUNetPredictor: the checkpoint is loaded once and its weights stay on the
+    device between requests, so a request only pays for the prediction.
 
-    :param folder_path: Path to the folder whose contents need to be deleted
+    When the checkpoint file changes (modification time or size), `reload_if_changed` loads the
+    new one while requests keep using the old predictor, and swaps them between two requests.
+    If the new checkpoint cannot be loaded the old predictor stays in use.
     """
-    if not os.path.exists(folder_path):
-        raise FileNotFoundError(f"The folder '{folder_path}' does not exist.")
-
-    # Iterate through all items in the folder
-    for item in os.listdir(folder_path):
-        item_path = os.path.join(folder_path, item)
-        try:
-            # Remove directory or file
-            if os.path.isdir(item_path):
-                shutil.rmtree(item_path)  # Remove directory and its contents
+
+    def __init__(self, model_dir: str, checkpoint_name: str = 'checkpoint_final.pth', device: str = 'cuda',
+                 warmup: bool = True):
+        """
+        :param model_dir: Training output folder of the model, with its fold_all subfolder.
+        :param checkpoint_name: The checkpoint file inside fold_all.
+        :param device: Torch device of the prediction.
+        :param warmup: Whether to predict one empty patch after each load.
+        """
+        self.model_dir = model_dir
+        self.checkpoint_name = checkpoint_name
+        self.device = device
+        self.warmup = warmup
+        self.checkpoint_path = os.path.join(model_dir, 'fold_all', checkpoint_name)
+
+        self._predictor = None
+        self._signature = None
+        self._load_lock = threading.Lock()  # Una sola càrrega alhora
+        self._predict_lock = threading.Lock()  # Una sola predicció alhora a la GPU
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "loaded_at": None, "load_seconds": None, "warmup_seconds": None, "loads": 0,
+            "load_errors": 0, "last_error": None, "predictions": 0, "cold_predict_seconds": None,
+            "last_predict_seconds": None, "warm_predict_seconds_total": 0.0, "warm_predictions": 0,
+        }
+        self._cold = True
+
+    def _checkpoint_signature(self):
+        stat = os.stat(self.checkpoint_path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _build(self):
+        """
+        Build a predictor from the checkpoint and, with warmup, run it once on an empty patch.
+
+        :return: The predictor, and the seconds spent loading and warming it up.
+        """
+        started = time.perf_counter()
+        predictor = nnUNetPredictor(
+            tile_step_size=0.8,
+            use_gaussian=True,
+            use_mirroring=False,
+            perform_everything_on_device=True,  # Cambia a 'True' si tienes GPU
+            device=torch.device(self.device),  # Cambia a 'cuda' si tienes GPU disponible
+            verbose=False,
+            verbose_preprocessing=False,
+            allow_tqdm=True
+        )
+        # Inicializa el predictor usando el checkpoint parcheado
+        predictor.initialize_from_trained_model_folder(
+            self.model_dir,
+            use_folds='all',
+            checkpoint_name=self.checkpoint_name
+        )
+        load_seconds = time.perf_counter() - started
+
+        warmup_seconds = None
+        if self.warmup:
+            started = time.perf_counter()
+            channels = determine_num_input_channels(predictor.plans_manager, predictor.configuration_manager,
+                                                    predictor.dataset_json)
+            patch = torch.zeros((channels, *predictor.configuration_manager.patch_size))
+            predictor.predict_logits_from_preprocessed_data(patch)
+            warmup_seconds = time.perf_counter() - started
+        return predictor, load_seconds, warmup_seconds
+
+    def load(self, if_missing: bool = False):
+        """
+        Load the checkpoint and replace the current predictor with it.
+
+        :param if_missing: Only load it if no predictor is loaded yet (another request may have loaded it).
+        """
+        with self._load_lock:
+            if if_missing and self._predictor is not None:
+                return
+            signature = self._checkpoint_signature()
+            try:
+                predictor, load_seconds, warmup_seconds = self._build()
+            except Exception as e:
+                with self._stats_lock:
+                    self._stats["load_errors"] += 1
+                    self._stats["last_error"] = str(e)
+                raise
+            # Canvia de predictor entre dues prediccions; l'antic s'allibera quan acaba la que l'usa
+            with self._predict_lock:
+                self._predictor = predictor
+                self._signature = signature
+                self._cold = not self.warmup
+            with self._stats_lock:
+                self._stats.update(loaded_at=time.time(), load_seconds=load_seconds,
+                                   warmup_seconds=warmup_seconds, loads=self._stats["loads"] + 1,
+                                   last_error=None)
+            logging.warning(f"Model {self.checkpoint_path} loaded in {load_seconds:.2f} s"
+                            + (f", warmed up in {warmup_seconds:.2f} s" if warmup_seconds is not None else ""))
+
+    def loaded(self) -> bool:
+        return self._predictor is not None
+
+    def version(self):
+        """
+        :return: Signature of the loaded checkpoint ("<mtime_ns>-<size>"), which changes on every
+                 reload of a new checkpoint, or None if no model is loaded.
+        """
+        signature = self._signature
+        return f"{signature[0]}-{signature[1]}" if signature is not None else None
+
+    def current(self):
+        """
+        The loaded predictor, loading it first if needed, without waiting for a running prediction.
+        Only for the CPU work that reads its plans (preprocessing, resampling), not for predicting.
+        """
+        if self._predictor is None:
+            self.load(if_missing=True)
+        return self._predictor
+
+    def reads_sitk_arrays(self) -> bool:
+        """
+        :return: Whether the model reads its images with SimpleITKIO, the axis order of the arrays
+                 built by DICOMProcessor.to_npy (other readers, like NibabelIO, transpose them).
+        """
+        return self.current().plans_manager.plans.get('image_reader_writer') == 'SimpleITKIO'
+
+    def reload_if_changed(self) -> bool:
+        """
+        Reload the checkpoint if its file changed since it was loaded.
+
+        :return: Whether it was reloaded.
+        """
+        if self._predictor is not None and self._checkpoint_signature() == self._signature:
+            return False
+        self.load()
+        return True
+
+    def watch(self, interval: float):
+        """
+        Check the checkpoint every `interval` seconds in a background thread, and reload it when
+        it changes. A checkpoint still being written fails to load and is retried at the next check.
+        """
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reload_if_changed()
+                except Exception as e:
+                    logging.error(f"Error reloading model {self.checkpoint_path}: {e}")
+
+        threading.Thread(target=run, name="model-watch", daemon=True).start()
+
+    @contextmanager
+    def use(self, should_cancel=None):
+        """
+        Hold the predictor for one prediction, loading it first if it is not loaded yet.
+
+        :param should_cancel: Callable set as the predictor's `should_cancel` during the prediction.
+        :return: Context manager yielding the nnUNetPredictor.
+        """
+        self.current()
+        with self._predict_lock:
+            predictor = self._predictor
+            predictor.should_cancel = should_cancel
+            started = time.perf_counter()
+            try:
+                yield predictor
+            finally:
+                predictor.should_cancel = None
+            self._record_prediction(time.perf_counter() - started)
+
+    def _record_prediction(self, seconds: float):
+        with self._stats_lock:
+            self._stats["predictions"] += 1
+            self._stats["last_predict_seconds"] = seconds
+            if self._cold:
+                # Primera predicció sense escalfament: inclou moure els pesos i triar els algorismes de cuDNN
+                self._stats["cold_predict_seconds"] = seconds
             else:
-                os.remove(item_path)  # Remove file
-        except Exception as e:
-            raise IOError(f"Error deleting '{item_path}': {e}")
-
-def run_segmentation(folder_path):
-
-    # Configuración para reducir los mensajes de advertencia y texto innecesario
-    logging.basicConfig(level=logging.ERROR)  # Solo mostrar errores importantes
-    logging.getLogger("nnunetv2").setLevel(logging.ERROR)
-    warnings.filterwarnings("ignore", category=FutureWarning)  # Ignorar FutureWarnings
-    warnings.filterwarnings("ignore", module="timm")  # Ignorar advertencias de timm
-    warnings.filterwarnings("ignore", module="tqdm")
-    os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"  # Reducir verbosidad de TensorFlow si está presente
-
-    torch.multiprocessing.set_start_method('spawn', force=True)
-    # Definir variables de entorno para evitar errores
-    os.environ["nnUNet_raw"] = os.getenv("NNUNET_RAW", "/app/modules/Model/nnUNet_raw")
-    os.environ["nnUNet_preprocessed"] = os.getenv("NNUNET_PREPROCESSED", "/app/modules/Model/nnUNet_preprocessed")
-    os.environ["nnUNet_results"] = os.getenv("NNUNET_RESULTS", "/app/modules/Model/nnUNet_results")
-
-    # Define tus directorios de entrada y salida dentro del contenedor
-    unidad = 'cuda'
-    input_dir = r"/app/IN"
-    output_dir = r"/app/OUT"
-    trained_model_dir = r"/app/modules/Model/nnUNet_results/nnUNetTrainer_CE_DC_CLDC__nnUNetResEncUNetMPlans__3d_lowres"
-
-    delete_folder_contents(input_dir)
-    delete_folder_contents(output_dir)
+                self._stats["warm_predict_seconds_total"] += seconds
+                self._stats["warm_predictions"] += 1
+        self._cold = False
+
+    def stats(self) -> dict:
+        """
+        :return: Load and prediction timings. The cold latency of the first request after a start
+                 is `load_seconds` + `warmup_seconds`, or `cold_predict_seconds` without warmup;
+                 `warm_predict_seconds` is the mean prediction time of the next requests.
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        warm = stats.pop("warm_predictions")
+        total = stats.pop("warm_predict_seconds_total")
+        stats["warm_predict_seconds"] = total / warm if warm else None
+        stats.update(checkpoint=self.checkpoint_path, device=self.device, loaded=self.loaded(),
+                     version=self.version())
+        return stats
+
+
+model = WarmPredictor(TRAINED_MODEL_DIR, CHECKPOINT_NAME, DEVICE, WARMUP)
 
-    #Image processing
 
+def run_segmentation(folder_path, should_cancel=None, timings=None):
+    """
+    Segment a DICOM series with the nnUNet model.
+
+    :param folder_path: Folder of the DICOM series.
+    :param should_cancel: Optional callable checked before the prediction and between its
+                          sliding-window tiles; returning True raises PredictionCancelled.
+    :param timings: Optional dict that receives the seconds spent converting the series
+                    ("preprocess_seconds") and predicting it ("predict_seconds").
+    :return: The segmentation as a nibabel image.
+    """
+    timings = {} if timings is None else timings
+
+    # Directorios de entrada y salida propios de esta petición, para poder segmentar varias a la vez
+    os.makedirs(WORKSPACE_DIR, exist_ok=True)
+    workspace = tempfile.mkdtemp(prefix="segmentation-", dir=WORKSPACE_DIR)
+    try:
+        return _run_segmentation(folder_path, os.path.join(workspace, "IN"), os.path.join(workspace, "OUT"),
+                                 should_cancel, timings)
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
+def _run_segmentation(folder_path, input_dir, output_dir, should_cancel, timings):
+    #Image processing
+    started = time.perf_counter()
     processor = DICOMProcessor(folder_path, input_dir)
     processor.process()
+    timings["preprocess_seconds"] = time.perf_counter() - started
 
     print(f"Imagen procesada. Archivo final: {processor.nifti_path}")
-    
-    # Configura el predictor
-    predictor = nnUNetPredictor(
-        tile_step_size=0.8,
-        use_gaussian=True,
-        use_mirroring=False,
-        perform_everything_on_device=True,  # Cambia a 'True' si tienes GPU
-        device=torch.device(unidad),  # Cambia a 'cuda' si tienes GPU disponible
-        verbose=False,
-        verbose_preprocessing=False,
-        allow_tqdm=True
-    )
-    
-    
-    # Inicializa el predictor usando el checkpoint parcheado
-    predictor.initialize_from_trained_model_folder(
-        trained_model_dir,
-        use_folds='all',
-        checkpoint_name='checkpoint_final.pth'
-    )
-    
-    
-    # Realizar la predicción
-    predictor.predict_from_files(
-        input_dir,
-        output_dir,
-        save_probabilities=False,
-        overwrite=True,
-        num_processes_preprocessing=6,
-        num_processes_segmentation_export=3,
-        folder_with_segs_from_prev_stage=None,
-        num_parts=1,
-        part_id=0
-    )
+    if should_cancel is not None and should_cancel():
+        raise PredictionCancelled('Prediction cancelled')
+
+    # Realizar la predicción con el predictor ya cargado
+    with model.use(should_cancel) as predictor:
+        started = time.perf_counter()
+        predictor.predict_from_files(
+            input_dir,
+            output_dir,
+            save_probabilities=False,
+            overwrite=True,
+            num_processes_preprocessing=6,
+            num_processes_segmentation_export=3,
+            folder_with_segs_from_prev_stage=None,
+            num_parts=1,
+            part_id=0
+        )
+        timings["predict_seconds"] = time.perf_counter() - started
 
+    # Carga los datos en memoria antes de borrar la carpeta de la petición
     result = nib.load(os.path.join(output_dir, 'image.nii.gz'))
+    result = nib.Nifti1Image(np.asanyarray(result.dataobj), result.affine, result.header)
     return result
+
+
+def segment_in_memory(folder_path, should_cancel=None, timings=None, export_path=None):
+    """
+    Segment a DICOM series without the NIfTI files of run_segmentation: the SimpleITK array and
+    geometry of the series go straight to the predictor, and the segmentation comes back as an array.
+
+    Only the prediction holds the model, so the CPU stages of concurrent calls overlap with it.
+
+    :param folder_path: Folder of the DICOM series.
+    :param should_cancel: Optional callable checked before the prediction and between its
+                          sliding-window tiles; returning True raises PredictionCancelled.
+    :param timings: Optional dict that receives the seconds spent reading and preprocessing the
+                    series ("preprocess_seconds"), predicting it on the device ("predict_seconds")
+                    and resampling the segmentation to the series shape ("postprocess_seconds").
+    :param export_path: Optional .nii.gz file where the segmentation is written in the background.
+    :return: The segmentation (z, y, x) array, its image properties, and the Future of the export
+             (None without export_path).
+    """
+    timings = {} if timings is None else timings
+
+    # Lectura i preprocessament a la CPU, mentre la GPU segmenta la sèrie d'una altra petició
+    started = time.perf_counter()
+    array, image_properties = DICOMProcessor(folder_path).to_npy()
+    predictor = model.current()
+    data, properties = preprocess_case(predictor, array, image_properties)
+    timings["preprocess_seconds"] = time.perf_counter() - started
+
+    if should_cancel is not None and should_cancel():
+        raise PredictionCancelled('Prediction cancelled')
+
+    with model.use(should_cancel) as current:
+        if current is not predictor:  # Model recarregat mentre es preprocessava: potser amb uns altres plans
+            predictor = current
+            data, properties = preprocess_case(predictor, array, image_properties)
+        started = time.perf_counter()
+        logits = predictor.predict_logits_from_preprocessed_data(data).cpu()
+        timings["predict_seconds"] = time.perf_counter() - started
+    del data
+
+    # Remostreig a la forma original, també fora de la GPU
+    started = time.perf_counter()
+    segmentation = convert_predicted_logits_to_segmentation_with_correct_shape(
+        logits, predictor.plans_manager, predictor.configuration_manager, predictor.label_manager, properties,
+        return_probabilities=False
+    )
+    timings["postprocess_seconds"] = time.perf_counter() - started
+
+    export = None
+    if export_path is not None:
+        export = export_pool.submit(save_segmentation, segmentation, properties, export_path)
+    return segmentation, properties, export
+
+
+def preprocess_case(predictor, array, image_properties):
+    """
+    Crop, normalize and resample an image with the plans of the model, as predict_single_npy_array
+    does, but without holding the model.
+
+    :param predictor: The nnUNetPredictor whose plans are used.
+    :param array: The (1, z, y, x) image.
+    :param image_properties: Its properties (see DICOMProcessor.to_npy); not modified.
+    :return: The preprocessed tensor, and the properties completed by the preprocessing.
+    """
+    properties = dict(image_properties)
+    preprocessor = predictor.configuration_manager.preprocessor_class(verbose=False)
+    data, _ = preprocessor.run_case_npy(array, None, properties, predictor.plans_manager,
+                                        predictor.configuration_manager, predictor.dataset_json)
+    return torch.from_numpy(data), properties
@@ -1,14 +1,132 @@
 from flask import Flask, request, jsonify
 import os
 import logging
-from algorithm import run_segmentation
+from algorithm import run_segmentation, segment_in_memory, PredictionCancelled, model
 import traceback
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
 
 app = Flask(__name__)
 DICOM_DIR = "/dicom" # Directori on es guarden els DICOMs dins del contenidor
 
 logging.basicConfig(level=logging.INFO)
 
+# Jobs asíncrons: es guarden els últims MAX_JOBS
+MAX_JOBS = 1000
+jobs = OrderedDict()
+jobs_lock = threading.Lock()
+
+# Segmentacions (síncrones i asíncrones): se n'executen SEGMENTATION_WORKERS alhora. El model només
+# en prediu una a la vegada, però la lectura i el preprocessament d'una es fan mentre la GPU segmenta
+# una altra. N'esperen com a molt MAX_QUEUED_JOBS més; la resta es rebutgen amb un 503
+SEGMENTATION_WORKERS = int(os.getenv("SEGMENTATION_WORKERS", 2))
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", 8))
+executor = ThreadPoolExecutor(max_workers=SEGMENTATION_WORKERS, thread_name_prefix="segmentation")
+pending_jobs = 0  # En curs o a la cua, protegit per jobs_lock
+
+# Tasques en curs o encuades: X-Task-ID de l'orquestrador -> Event que s'activa en cancel·lar-la.
+# La predicció el comprova entre les finestres del sliding window, per alliberar la GPU de seguida
+cancel_events = {}
+
+# Segons entre dues comprovacions del checkpoint, per recarregar el model si canvia (0 per no comprovar-lo)
+MODEL_RELOAD_INTERVAL = float(os.getenv("MODEL_RELOAD_INTERVAL", 60))
+# La sèrie va de SimpleITK al predictor en memòria, sense fitxers NIfTI intermedis (0 per desactivar-ho)
+IN_MEMORY = os.getenv("IN_MEMORY", "1").lower() in ("1", "true", "yes")
+# Carpeta on s'escriuen les segmentacions en segon pla (<sèrie>.nii.gz); sense definir, no s'escriuen
+SEGMENTATION_EXPORT_DIR = os.getenv("SEGMENTATION_EXPORT_DIR")
+
+
+def register_task(task_id):
+    """Return the cancel event of a task, registered until it finishes."""
+    cancelled = threading.Event()
+    if task_id:
+        with jobs_lock:
+            cancel_events[task_id] = cancelled
+    return cancelled
+
+
+def unregister_task(task_id):
+    with jobs_lock:
+        cancel_events.pop(task_id, None)
+
+
+def reserve_slot():
+    """Count a new segmentation, unless SEGMENTATION_WORKERS + MAX_QUEUED_JOBS are already pending."""
+    global pending_jobs
+    with jobs_lock:
+        if pending_jobs >= SEGMENTATION_WORKERS + MAX_QUEUED_JOBS:
+            return False
+        pending_jobs += 1
+        return True
+
+
+def release_slot(_=None):
+    global pending_jobs
+    with jobs_lock:
+        pending_jobs -= 1
+
+
+def segment(dicom_dir, cancelled):
+    """Run the segmentation and return the response body and HTTP status."""
+    try:
+        # Processar tots els fitxers dins del directori
+        timings = {}
+        if IN_MEMORY and model.reads_sitk_arrays():
+            export_path = None
+            if SEGMENTATION_EXPORT_DIR:
+                export_path = os.path.join(SEGMENTATION_EXPORT_DIR, os.path.basename(os.path.normpath(dicom_dir)) + ".nii.gz")
+            segmentation, _, _ = segment_in_memory(dicom_dir, should_cancel=cancelled.is_set, timings=timings,
+                                                   export_path=export_path)
+            labels, voxels = np.unique(segmentation, return_counts=True)
+            body = {"status": "success", "result": dicom_dir, "timings": timings,
+                    "shape": list(segmentation.shape),
+                    "voxels_per_label": {str(label): int(count) for label, count in zip(labels, voxels)}}
+            if export_path:
+                body["export"] = export_path
+            return body, 200
+
+        result = run_segmentation(dicom_dir, should_cancel=cancelled.is_set, timings=timings)
+        return {"status": "success", "result": dicom_dir, "timings": timings}, 200
+
+    except PredictionCancelled:
+        logging.info(f"Segmentation of {dicom_dir} cancelled")
+        return {"status": "cancelled"}, 409
+
+    except Exception as e:
+        error_trace = traceback.format_exc()  # ⬅️ Captura el error detallado
+        logging.error(f"❌ Error in process_dicom:\n{error_trace}")  # ⬅️ Muestra el error
+        return {"status": "failed", "error": str(e)}, 500
+
+
+def segment_queued(dicom_dir, cancelled):
+    """Run a synchronous segmentation from the queue, unless it was cancelled while waiting."""
+    if cancelled.is_set():
+        return {"status": "cancelled"}, 409
+    return segment(dicom_dir, cancelled)
+
+
+def run_job(job_id, dicom_dir, callback_url, task_id, cancelled):
+    """Run an asynchronous segmentation and notify the orchestrator when it finishes."""
+    if cancelled.is_set():  # Cancel·lada mentre esperava a la cua
+        outcome = {"status": "cancelled"}
+    else:
+        with jobs_lock:
+            jobs[job_id] = {"status": "running"}
+        outcome, _ = segment(dicom_dir, cancelled)
+    unregister_task(task_id)
+    with jobs_lock:
+        jobs[job_id] = outcome
+    try:
+        requests.post(callback_url, json=dict(outcome, job_id=job_id), timeout=10)
+    except Exception as e:
+        # L'orquestrador consultarà /jobs/<job_id> si no rep el callback
+        logging.error(f"Error notifying job {job_id} to {callback_url}: {e}")
+
+
 @app.route('/run', methods=['POST'])
 def predict():
     logging.info("Vascular Segmenter service received a request")
@@ -23,20 +141,97 @@ def predict():
     directory = directory.strip()
 
     dicom_dir = os.path.abspath(os.path.join(DICOM_DIR, directory))
-    
+
     if not os.path.exists(dicom_dir):
         logging.info(f"directory field not found: {dicom_dir}")
         return jsonify({"status": "failed", "message": "Directory not found"}), 404
 
+    if not reserve_slot():
+        # Cua plena: l'orquestrador torna a encuar la tasca i la reintenta més tard
+        logging.info(f"Segmentation queue full, rejecting {dicom_dir}")
+        return jsonify({"status": "failed", "message": "Segmentation queue is full"}), 503, {"Retry-After": "30"}
+
+    callback_url = request.headers.get('X-Callback-URL')
+    task_id = request.headers.get('X-Task-ID')
+    cancelled = register_task(task_id)
+    if callback_url:
+        # Mode asíncron: respon de seguida i notifica el final al callback
+        job_id = uuid.uuid4().hex
+        with jobs_lock:
+            jobs[job_id] = {"status": "queued"}
+            while len(jobs) > MAX_JOBS:
+                jobs.popitem(last=False)
+        executor.submit(run_job, job_id, dicom_dir, callback_url, task_id, cancelled).add_done_callback(release_slot)
+        return jsonify({"job_id": job_id, "status": "accepted"}), 202
+
+    future = executor.submit(segment_queued, dicom_dir, cancelled)
+    future.add_done_callback(release_slot)
     try:
-        # Processar tots els fitxers dins del directori
-        result = run_segmentation(dicom_dir)
-        return jsonify({"status": "success", "result": dicom_dir}), 200
+        body, status = future.result()
+    finally:
+        unregister_task(task_id)
+    return jsonify(body), status
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(dict(job, job_id=job_id)), 200
+
+
+@app.route('/cancel', methods=['POST'])
+def cancel():
+    """Stop a running or queued segmentation, identified by the X-Task-ID it was sent with."""
+    task_id = str((request.get_json(silent=True) or {}).get('task_id'))
+    with jobs_lock:
+        cancelled = cancel_events.get(task_id)
+    if cancelled is None:
+        return jsonify({"error": "Task not running"}), 404
+    cancelled.set()
+    return jsonify({"task_id": task_id, "status": "cancelling"}), 202
+
+
+@app.route('/model', methods=['GET'])
+def model_stats():
+    """Checkpoint of the resident model, and its load (cold) and prediction (warm) timings."""
+    return jsonify(model.stats()), 200
 
+
+@app.route('/model/reload', methods=['POST'])
+def model_reload():
+    """Reload the checkpoint now, even if its file did not change."""
+    try:
+        model.load()
     except Exception as e:
-        error_trace = traceback.format_exc()  # ⬅️ Captura el error detallado
-        logging.error(f"❌ Error in process_dicom:\n{error_trace}")  # ⬅️ Muestra el error
-        return jsonify({"error": str(e)}), 500
-    
+        logging.error(f"Error reloading model: {e}")
+        return jsonify({"status": "failed", "error": str(e), "model": model.stats()}), 500
+    return jsonify({"status": "reloaded", "model": model.stats()}), 200
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    with jobs_lock:
+        pending = pending_jobs
+    # model_version: l'orquestrador l'inclou a la clau de la cache de resultats
+    return jsonify({"status": "ok", "model_loaded": model.loaded(), "model_version": model.version(),
+                    "pending_jobs": pending,
+                    "max_pending_jobs": SEGMENTATION_WORKERS + MAX_QUEUED_JOBS}), 200
+
+
+def preload_model():
+    """Load the model once at startup, so the first request does not pay for it."""
+    try:
+        model.load(if_missing=True)
+    except Exception as e:
+        # La primera petició ho tornarà a intentar
+        logging.error(f"Error loading model {model.checkpoint_path}: {e}")
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5003)
\ No newline at end of file
+    threading.Thread(target=preload_model, name="model-load", daemon=True).start()
+    if MODEL_RELOAD_INTERVAL > 0:
+        model.watch(MODEL_RELOAD_INTERVAL)
+    app.run(host='0.0.0.0', port=5003)
@@ -0,0 +1,75 @@
+"""
+End-to-end latency of a segmentation through intermediate NIfTI files (run_segmentation) and
+through the in-memory path, on one DICOM series.
+
+The model is loaded (and warmed up) once before the runs, so both paths are measured warm:
+the times are the DICOM read and conversion, the nnUNet preprocessing and the prediction, and
+for the file path the NIfTI writes and reads. Also checks that both paths give the same labels,
+and measures the throughput of CASES in-memory segmentations run one at a time and two at a
+time (the preprocessing of one case then overlaps with the prediction of the other).
+
+Run inside the container, from /app:  python bench_segmentation.py <series folder> [repeats]
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from algorithm import model, run_segmentation, segment_in_memory
+
+SERIES = os.path.abspath(os.path.join("/dicom", sys.argv[1])) if len(sys.argv) > 1 else None
+REPEATS = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+CASES = 4
+
+
+def measure(function):
+    """
+    Best end-to-end time of REPEATS runs, with the timings and result of the best one.
+    """
+    best = None
+    for _ in range(REPEATS):
+        timings = {}
+        start = time.perf_counter()
+        result = function(timings)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best[0]:
+            best = elapsed, timings, result
+    return best
+
+
+def main():
+    if SERIES is None or not os.path.isdir(SERIES):
+        sys.exit(__doc__)
+    model.load()
+    stats = model.stats()
+    print(f"model loaded in {stats['load_seconds']:.2f} s, warm-up {stats['warmup_seconds'] or 0:.2f} s; "
+          f"best of {REPEATS} runs\n")
+    print(f"{'path':>10} {'total s':>8} {'read s':>8} {'predict s':>10}")
+
+    elapsed, timings, image = measure(lambda timings: run_segmentation(SERIES, timings=timings))
+    # El NIfTI de sortida està en ordre (x, y, z); l'array en memòria, en (z, y, x)
+    from_files = np.asarray(image.dataobj).transpose(2, 1, 0)
+    print(f"{'files':>10} {elapsed:>8.2f} {timings['preprocess_seconds']:>8.2f} {timings['predict_seconds']:>10.2f}")
+
+    elapsed, timings, (in_memory, _, _) = measure(lambda timings: segment_in_memory(SERIES, timings=timings))
+    print(f"{'in memory':>10} {elapsed:>8.2f} {timings['preprocess_seconds']:>8.2f} {timings['predict_seconds']:>10.2f}")
+
+    if from_files.shape != in_memory.shape:
+        print(f"\nshapes differ: files {from_files.shape}, in memory {in_memory.shape}")
+    else:
+        print(f"\nvoxels with a different label: {int(np.count_nonzero(from_files != in_memory))} "
+              f"of {in_memory.size}")
+
+    print(f"\n{CASES} cases, in memory:")
+    for workers in (1, 2):
+        with ThreadPoolExecutor(workers) as pool:
+            start = time.perf_counter()
+            list(pool.map(lambda _: segment_in_memory(SERIES), range(CASES)))
+            elapsed = time.perf_counter() - start
+        print(f"{workers} at a time: {elapsed:>8.2f} s, {CASES / elapsed * 60:.1f} cases/min")
+
+
+if __name__ == "__main__":
+    main()
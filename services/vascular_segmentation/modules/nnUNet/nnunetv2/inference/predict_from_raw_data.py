@@ -35,6 +35,14 @@ from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, Config
 from nnunetv2.utilities.utils import create_lists_from_splitted_dataset_folder
 
 
+class PredictionCancelled(Exception):
+    """
+    Raised when `should_cancel` asks to stop a prediction between two sliding-window tiles.
+    Not a RuntimeError, so it does not trigger the fallback to a CPU results device.
+    """
+    pass
+
+
 class nnUNetPredictor(object):
     def __init__(self,
                  tile_step_size: float = 0.5,
@@ -62,6 +70,12 @@ class nnUNetPredictor(object):
             perform_everything_on_device = False
         self.device = device
         self.perform_everything_on_device = perform_everything_on_device
+        # Callable without arguments checked between sliding-window tiles; returning True aborts
+        # the prediction with PredictionCancelled
+        self.should_cancel = None
+        # Parameters currently loaded in the network. With a single fold they stay loaded between
+        # predictions, instead of being copied again from the CPU state dict on every call
+        self.loaded_parameters = None
 
     def initialize_from_trained_model_folder(self, model_training_output_dir: str,
                                              use_folds: Union[Tuple[Union[int, str]], None],
@@ -117,6 +131,7 @@ class nnUNetPredictor(object):
         self.trainer_name = trainer_name
         self.allowed_mirroring_axes = inference_allowed_mirroring_axes
         self.label_manager = plans_manager.get_label_manager(dataset_json)
+        self.loaded_parameters = None
         if ('nnUNet_compile' in os.environ.keys()) and (os.environ['nnUNet_compile'].lower() in ('true', '1', 't')) \
                 and not isinstance(self.network, OptimizedModule):
             print('Using torch.compile')
@@ -137,6 +152,7 @@ class nnUNetPredictor(object):
         self.trainer_name = trainer_name
         self.allowed_mirroring_axes = inference_allowed_mirroring_axes
         self.label_manager = plans_manager.get_label_manager(dataset_json)
+        self.loaded_parameters = None
         allow_compile = True
         allow_compile = allow_compile and ('nnUNet_compile' in os.environ.keys()) and (
                     os.environ['nnUNet_compile'].lower() in ('true', '1', 't'))
@@ -485,10 +501,12 @@ class nnUNetPredictor(object):
         for params in self.list_of_parameters:
 
             # messing with state dict names...
-            if not isinstance(self.network, OptimizedModule):
-                self.network.load_state_dict(params)
-            else:
-                self.network._orig_mod.load_state_dict(params)
+            if params is not self.loaded_parameters:
+                if not isinstance(self.network, OptimizedModule):
+                    self.network.load_state_dict(params)
+                else:
+                    self.network._orig_mod.load_state_dict(params)
+                self.loaded_parameters = params
 
             # why not leave prediction on device if perform_everything_on_device? Because this may cause the
             # second iteration to crash due to OOM. Grabbing that with try except cause way more bloated code than
@@ -591,6 +609,8 @@ class nnUNetPredictor(object):
             if not self.allow_tqdm and self.verbose:
                 print(f'running prediction: {len(slicers)} steps')
             for sl in tqdm(slicers, disable=not self.allow_tqdm):
+                if self.should_cancel is not None and self.should_cancel():
+                    raise PredictionCancelled('Prediction cancelled')
                 workon = data[sl][None]
                 workon = workon.to(self.device)
 
@@ -1,4 +1,5 @@
 import os
+import numpy as np
 import SimpleITK as sitk
 
 
@@ -6,31 +7,39 @@ class DICOMProcessor:
     """
     Clase para procesar imágenes DICOM:
     - Convierte DICOM a NIfTI (.nii.gz) usando SimpleITK.
+    - O la convierte en memoria al array y las propiedades que espera nnUNet, sin escribir a disco.
     """
 
-    def __init__(self, input_directory, output_directory):
+    def __init__(self, input_directory, output_directory=None):
         self.input_directory = input_directory
         self.output_directory = output_directory
-        self.nifti_path = os.path.join(self.output_directory, "image_0000.nii.gz")
+        self.nifti_path = os.path.join(self.output_directory, "image_0000.nii.gz") if output_directory else None
 
         # Asegurar que el directorio de salida existe
-        os.makedirs(self.output_directory, exist_ok=True)
+        if output_directory:
+            os.makedirs(self.output_directory, exist_ok=True)
+
+    def read_image(self):
+        """
+        Lee la serie DICOM y la reorienta a RAS+.
+        """
+        # Configurar el lector de series DICOM
+        reader = sitk.ImageSeriesReader()
+        dicom_names = reader.GetGDCMSeriesFileNames(self.input_directory)
+        reader.SetFileNames(dicom_names)
+
+        # Leer la imagen DICOM
+        image = reader.Execute()
+
+        # Reorientar la imagen a RAS+
+        return self.reorient_to_ras(image)
 
     def dicom_to_nifti(self):
         """
         Convierte una serie DICOM a un archivo NIfTI usando SimpleITK.
         """
         try:
-            # Configurar el lector de series DICOM
-            reader = sitk.ImageSeriesReader()
-            dicom_names = reader.GetGDCMSeriesFileNames(self.input_directory)
-            reader.SetFileNames(dicom_names)
-
-            # Leer la imagen DICOM
-            image = reader.Execute()
-
-            # Reorientar la imagen a RAS+
-            ras_image = self.reorient_to_ras(image)
+            ras_image = self.read_image()
 
             # Guardar la imagen como NIfTI
             sitk.WriteImage(ras_image, self.nifti_path)
@@ -38,6 +47,29 @@ class DICOMProcessor:
         except Exception as e:
             raise RuntimeError(f"Error en la conversión DICOM a NIfTI: {e}")
 
+    def to_npy(self):
+        """
+        Convierte la serie DICOM al array y las propiedades que nnUNet obtiene al leer el NIfTI con
+        SimpleITKIO: array (1, z, y, x) float32, spacing en orden (z, y, x) y la geometría de SimpleITK.
+
+        :return: El array y el diccionario de propiedades.
+        """
+        try:
+            ras_image = self.read_image()
+        except Exception as e:
+            raise RuntimeError(f"Error en la lectura DICOM: {e}")
+
+        array = sitk.GetArrayFromImage(ras_image)[None].astype(np.float32, copy=False)
+        properties = {
+            'sitk_stuff': {
+                'spacing': ras_image.GetSpacing(),
+                'origin': ras_image.GetOrigin(),
+                'direction': ras_image.GetDirection()
+            },
+            'spacing': list(np.abs(ras_image.GetSpacing()[::-1]))
+        }
+        return array, properties
+
     def reorient_to_ras(self, image):
         """
         Reorienta una imagen al espacio de coordenadas RAS+.
@@ -60,4 +92,20 @@ class DICOMProcessor:
         Ejecuta el pipeline completo:
         - Convierte DICOM a NIfTI.
         """
-        self.dicom_to_nifti()
\ No newline at end of file
+        self.dicom_to_nifti()
+
+
+def save_segmentation(segmentation, properties, path):
+    """
+    Guarda una segmentación (z, y, x) como NIfTI comprimido, con la geometría de la imagen original.
+
+    :param segmentation: Array de etiquetas devuelto por nnUNet.
+    :param properties: Propiedades de la imagen, con su 'sitk_stuff'.
+    :param path: Fichero .nii.gz de salida.
+    """
+    image = sitk.GetImageFromArray(segmentation.astype(np.uint8, copy=False))
+    image.SetSpacing(properties['sitk_stuff']['spacing'])
+    image.SetOrigin(properties['sitk_stuff']['origin'])
+    image.SetDirection(properties['sitk_stuff']['direction'])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    sitk.WriteImage(image, path, True)